@@ -0,0 +1,280 @@
+#
+# An asyncio front end for the API, used with server=asyncio in api.conf.
+#
+# The event loop accepts connections and parses requests, and hands each
+# one to the unchanged WSGI app on a pool of threads, so that a slow
+# database round trip or fingerprint scan only ties up its own thread.
+# (The matrix scans in fpmatrix.py release the GIL, so they run in
+# parallel too.) Requests are divided into classes by path, and each
+# class has its own limit on how many of them run at once, so a burst
+# of lookups can't starve /works and the rest. The limits add up to at
+# most threads, so that every request let in has a thread to run on. A
+# request that has waited busy_timeout seconds for its class gets a 503.
+#
+# Request bodies are spooled to a temporary file beyond 1 MB. Responses
+# are written as the app produces them: with a Content-Length when the
+# app gives one or returns the whole body at once, and chunked otherwise
+# (closing the connection after HTTP/1.0 requests instead), so streamed
+# results go out while they are being serialized. Chunked request bodies
+# are not supported.
+#
+import asyncio
+import logging
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from bottle import ServerAdapter
+
+log = logging.getLogger('aioserve')
+
+# Bytes of a streamed response collected before they are sent
+BUFFER = 65536
+
+# First matching path prefix -> class of endpoints with a shared limit
+CLASSES = (
+    ('/lookup/', 'lookup'),
+    ('/works/', 'works'),
+    ('', 'other'),
+)
+
+
+def endpoint_class(path):
+    for prefix, name in CLASSES:
+        if path.startswith(prefix):
+            return name
+
+
+class AsyncioServer(ServerAdapter):
+
+    def run(self, handler):
+        asyncio.run(serve(handler, self.host, self.port, **self.options))
+
+
+#
+# Runs app on host:port. limits maps each class to the number of its
+# requests run at once; classes not in it get an equal share of threads.
+#
+async def serve(app, host, port, threads=16, limits=None, busy_timeout=10):
+    limits = dict((name, (limits or {}).get(name, max(1, threads // len(CLASSES))))
+                  for prefix, name in CLASSES)
+    if sum(limits.values()) > threads:
+        raise ValueError('the limits of the endpoint classes add up to more than %d threads' % threads)
+    executor = ThreadPoolExecutor(threads)
+    semaphores = dict((name, asyncio.Semaphore(limit)) for name, limit in limits.items())
+
+    async def connection(reader, writer):
+        try:
+            await handle(app, executor, semaphores, busy_timeout, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            log.exception('Error handling connection')
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(connection, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def handle(app, executor, semaphores, busy_timeout, reader, writer):
+    loop = asyncio.get_running_loop()
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            return
+        try:
+            method, target, protocol = line.decode('latin-1').split()
+        except ValueError:
+            await respond(writer, '400 Bad Request', [], [b'bad request line'], False)
+            return
+        headers = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers.append((name.strip().lower(), value.strip()))
+        fields = dict(headers)
+        connection = fields.get('connection', '').lower()
+        keep_alive = connection != 'close' if protocol == 'HTTP/1.1' else connection == 'keep-alive'
+
+        if 'chunked' in fields.get('transfer-encoding', '').lower():
+            await respond(writer, '411 Length Required', [], [b'chunked request bodies are not supported'], False)
+            return
+        try:
+            length = int(fields.get('content-length') or 0)
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            await respond(writer, '400 Bad Request', [], [b'bad content-length'], False)
+            return
+        if fields.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        body = tempfile.SpooledTemporaryFile(1 << 20)
+        while length > 0:
+            chunk = await reader.read(min(length, 65536))
+            if not chunk:
+                return
+            body.write(chunk)
+            length -= len(chunk)
+        body.seek(0)
+
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, 'latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': writer.get_extra_info('sockname')[0],
+            'SERVER_PORT': str(writer.get_extra_info('sockname')[1]),
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': (writer.get_extra_info('peername') or ('',))[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers:
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name == 'content-length':
+                environ['CONTENT_LENGTH'] = value
+            else:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+                environ[key] = environ[key] + ',' + value if key in environ else value
+
+        semaphore = semaphores[endpoint_class(environ['PATH_INFO'])]
+        try:
+            await asyncio.wait_for(semaphore.acquire(), busy_timeout)
+        except asyncio.TimeoutError:
+            await respond(writer, '503 Service Unavailable', [('Retry-After', '1')], [b'too busy'], keep_alive, method == 'HEAD')
+            body.close()
+            continue
+        out = ResponseWriter(loop, writer, protocol, method == 'HEAD', keep_alive)
+        try:
+            await loop.run_in_executor(executor, call, app, environ, out)
+        finally:
+            semaphore.release()
+            body.close()
+        if not out.keep_alive:
+            return
+
+
+#
+# Writes a response to the connection from the thread running the app.
+# The body is sent in pieces of at least BUFFER bytes, and the thread
+# waits for every piece to be sent, so a slow client holds up the app
+# rather than filling memory.
+#
+class ResponseWriter(object):
+
+    def __init__(self, loop, writer, protocol, head, keep_alive):
+        self.loop = loop
+        self.writer = writer
+        self.protocol = protocol
+        self.head = head
+        self.keep_alive = keep_alive
+        self.chunked = False
+        self.started = False
+        self.buffer = []
+        self.buffered = 0
+
+    def _send(self, data):
+        asyncio.run_coroutine_threadsafe(self._write(data), self.loop).result()
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    # length is that of the whole body if known, None if it is streamed
+    def start(self, status, headers, length=None):
+        self.started = True
+        names = set(name.lower() for name, value in headers)
+        lines = ['HTTP/1.1 %s' % status]
+        lines.extend('%s: %s' % header for header in headers)
+        # A HEAD response has no body to measure, so it only has the
+        # Content-Length the app gave
+        if not self.head and 'content-length' not in names:
+            if length is not None:
+                lines.append('Content-Length: %d' % length)
+            elif self.protocol == 'HTTP/1.1':
+                lines.append('Transfer-Encoding: chunked')
+                self.chunked = True
+            else:
+                self.keep_alive = False
+        lines.append('Connection: %s' % ('keep-alive' if self.keep_alive else 'close'))
+        self._send(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    def write(self, chunk):
+        if self.head or not chunk:
+            return
+        self.buffer.append(chunk)
+        self.buffered += len(chunk)
+        if self.buffered >= BUFFER:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if self.chunked:
+            data = b'%x\r\n%s\r\n' % (len(data), data)
+        self._send(data)
+
+    def end(self):
+        self.flush()
+        if self.chunked and not self.head:
+            self._send(b'0\r\n\r\n')
+
+
+# Runs the WSGI app on one request, writing the response to out
+def call(app, environ, out):
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+        return write
+
+    def write(chunk):
+        if not out.started:
+            out.start(*started)
+        out.write(chunk)
+
+    result = app(environ, start_response)
+    try:
+        if isinstance(result, (list, tuple)):
+            out.start(started[0], started[1], sum(len(chunk) for chunk in result))
+            for chunk in result:
+                out.write(chunk)
+        else:
+            for chunk in result:
+                if chunk:
+                    write(chunk)
+            if not out.started:
+                out.start(started[0], started[1], 0)
+        out.end()
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+
+# Writes a response of the server's own
+async def respond(writer, status, headers, chunks, keep_alive, head=False):
+    length = sum(len(c) for c in chunks)
+    lines = ['HTTP/1.1 %s' % status]
+    lines.extend('%s: %s' % header for header in headers)
+    lines.append('Content-Length: %d' % length)
+    lines.append('Connection: %s' % ('keep-alive' if keep_alive else 'close'))
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    if not head:
+        for chunk in chunks:
+            writer.write(chunk)
+    await writer.drain()
@@ -2,24 +2,23 @@
 from bottle import default_app
 from bottle.ext import sqlalchemy
 
-from sqlalchemy import create_engine, Column, Integer, Sequence, String, func, ForeignKey, LargeBinary
-from sqlalchemy.dialects.mysql import DATETIME, TIMESTAMP, TEXT, INTEGER
-from sqlalchemy.ext.declarative import declarative_base
-from datetime import datetime
-from sqlalchemy.orm import relationship, sessionmaker
-from datetime import datetime
+from sqlalchemy import create_engine, func, or_
+from datetime import datetime, timedelta
+from sqlalchemy.orm import sessionmaker
 
 import time
-import random
-import subprocess
-import os
+import signal
+import argparse
+import multiprocessing
 import fasteners
-import mimetypes
 import magic
 import logging
+import threading
 
-from json import dumps
-import string
+from models import Base, Queue, QueueResults
+from hashers import hashers, backends, hash_files
+from lookup import find_similar
+import metrics
 
 app = default_app()
 
@@ -27,8 +26,16 @@ app.config.load_config('api.conf')
 app.config.setdefault('api.db', 'sqlite:///:memory:')
 app.config.setdefault('api.base', 'http://localhost:8080')
 app.config.setdefault('api.queuedir', '/tmp')
+app.config.setdefault('api.create_tables', 'yes')
+app.config.setdefault('api.queue_workers', '4')
+app.config.setdefault('api.queue_poll', '2')
+app.config.setdefault('api.queue_timeout', '3600')
+app.config.setdefault('api.hasher_backend', 'subprocess')
+app.config.setdefault('api.hasher_workers', '4')
+app.config.setdefault('api.hasher_parallelism', '4')
+app.config.setdefault('api.hasher_timeout', '600')
+app.config.setdefault('api.queue_metrics', '0')
 
-Base = declarative_base()
 engine = create_engine(app.config['api.db'], echo=False)
 
 plugin = sqlalchemy.Plugin(
@@ -40,91 +47,10 @@ plugin = sqlalchemy.Plugin(
 
 app.install(plugin)
 
-class Expression(Base):
-    __tablename__ = 'expression'
-    id = Column(INTEGER(unsigned=True, zerofill=True),
-                Sequence('expression_id_seq', start=1, increment=1),
-                primary_key = True)
-    title = Column(String(500))
-    description = Column(String(2048))
-    # 
-    # Allowed:  Any CC URI + defined by rightsstatements.org
-    #
-    rights_statement = Column(String(128))
-    credit = Column(String(500))
-    credit_url = Column(String(1024))
-    #
-    # http://wikimedia.org/
-    #
-    collection_url = Column(String(128))
-    source_id = Column(String(256))
-    updated_date = Column(TIMESTAMP, default=datetime.utcnow,
-                          nullable=False, onupdate=datetime.utcnow)
-    manifestation = relationship('Manifestation', backref="expression")
-
-class Manifestation(Base):
-    __tablename__ = 'manifestation'
-    id = Column(INTEGER(unsigned=True, zerofill=True),
-                Sequence('manifestation_id_seq', start=1, increment=1),
-                primary_key = True)
-    url = Column(String(500))
-    # 
-    # media_type:  image/jpeg image/gif  image/png video/mpeg video/mp4
-    #              video/ogg  video/webm audio/ogg
-    #
-    media_type = Column(String(64))
-    expression_id = Column(INTEGER(unsigned=True, zerofill=True), 
-                     ForeignKey('expression.id'))
-    fingerprint = relationship('Fingerprint', backref="manifestation")
-
-class Fingerprint(Base):
-    __tablename__ = 'fingerprint'
-    id = Column(INTEGER(unsigned=True, zerofill=True),
-                Sequence('fingerprint_id_seq', start=1, increment=1),
-                primary_key = True)
-    #
-    #
-    type = Column(String(64))
-    hash = Column(String(256))
-    updated_date = Column(TIMESTAMP, default=datetime.utcnow,
-                          nullable=False, onupdate=datetime.utcnow)
-    manifestation_id = Column(INTEGER(unsigned=True, zerofill=True), 
-                     ForeignKey('manifestation.id'))
-
-class Queue(Base):
-    __tablename__ = 'queue'
-    id = Column(INTEGER(unsigned=True, zerofill=True),
-               Sequence('queue_id_seq', start=1, increment=1),
-               primary_key = True)
-    queryhash = Column(String(256))
-    requested_date = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
-    completed_date = Column(TIMESTAMP)
-    status = Column(INTEGER, default=0) # 0 = unprocessed, 1 = working, 2 = done
-    email = Column(String(256))
-    results = relationship('QueueResults', backref="queue")
-
-class QueueResults(Base):
-    __tablename__ = 'queue_results'
-    id = Column(INTEGER(unsigned=True, zerofill=True),
-               Sequence('queue_results_id_seq', start=1, increment=1),
-               primary_key = True)
-    qid = Column(INTEGER(unsigned=True, zerofill=True),
-                ForeignKey('queue.id'))
-    distance = Column(INTEGER)
-    expression_id = Column(INTEGER(unsigned=True, zerofill=True))
-
-Base.metadata.create_all(engine)
-
-hashers = {  
-             'http://videorooter.org/ns/blockhash': {
-                'command': '/home/api/algorithms/commonsmachinery-blockhash/build/blockhash',   
-                'types': ['image/png', 'image/jpg'],
-              },
-             'http://videorooter.org/ns/x-blockhash-video-cv': {
-                'command': '/home/api/algorithms/jonasob-blockhash-master/build/blockhash_video',
-                'types': ['video/mp4', 'video/mpeg', 'video/ogg', 'video/webm'],
-              },
-          }
+# Creating missing tables costs a round trip per table at every start,
+# set create_tables=no once the schema exists
+if app.config['api.create_tables'] != 'no':
+    Base.metadata.create_all(engine)
 
 def lock_me():
   a_lock = fasteners.InterProcessLock('/tmp/backend-queue.lock')
@@ -135,44 +61,257 @@ def lock_me():
     else:
        time.sleep(10)
 
-lock_me()
-
-dbsession = sessionmaker(bind=engine)
-db = dbsession()
-
-m = magic.Magic(flags=magic.MAGIC_MIME_TYPE)
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)8s  %(message)s')
 log = logging.getLogger('queuerun')
 
-entity = db.query(Queue).filter_by(status=0).limit(10).all()
-for row in entity:
-   log.debug("%d: Starting identification" % row.id)
-   db.query(Queue).filter(Queue.id==row.id).update({ Queue.status: 1 })
+#
+# With queue_metrics set to a port, the daemon serves these at /metrics
+# on it; the worker processes forward their updates to the daemon.
+#
+QUEUE_DEPTH = metrics.REGISTRY.gauge('apicode_queue_jobs', 'Jobs in the queue, by status', ('status',))
+JOB_WAIT = metrics.REGISTRY.histogram('apicode_queue_wait_seconds', 'Time from upload until a worker starts on a job',
+                                      buckets=(1, 5, 10, 30, 60, 300, 900, 3600, 14400, 86400))
+HASH_SECONDS = metrics.REGISTRY.histogram('apicode_queue_hash_seconds', 'Time spent hashing a file, by method',
+                                          ('method',), buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600))
+JOB_RESULTS = metrics.REGISTRY.histogram('apicode_queue_results', 'Matching works found per job',
+                                         buckets=(0, 1, 2, 5, 10, 20, 50, 100, 500, 1000))
+JOBS = metrics.REGISTRY.counter('apicode_queue_jobs_total', 'Jobs processed')
+FAILURES = metrics.REGISTRY.counter('apicode_queue_failures_total', 'Jobs that failed')
+
+#
+# Claims the next unprocessed job for this worker. The conditional UPDATE
+# is atomic on the row, so any number of workers, also on different hosts,
+# can drain the queue together: whoever changes the status from 0 to 1
+# owns the job, everybody else sees a rowcount of 0 and tries the next.
+#
+def claim(db):
+   candidates = db.query(Queue.id).filter_by(status=0).order_by(Queue.id).limit(10).all()
+   db.commit()
+   for (id,) in candidates:
+      claimed = db.query(Queue).filter(Queue.id==id, Queue.status==0).update({ Queue.status: 1,
+                          Queue.completed_date: datetime.utcnow() }, synchronize_session=False)
+      db.commit()
+      if claimed:
+         return db.query(Queue).filter(Queue.id==id).first()
+   return None
+
+#
+# Puts jobs that have been working for longer than timeout seconds, e.g.
+# because their worker died, back into the queue. Jobs left working by
+# the one-shot script before the daemon have no claim time and are always
+# put back.
+#
+def reclaim(db, timeout):
+   cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+   reclaimed = db.query(Queue).filter(Queue.status==1, or_(Queue.completed_date < cutoff, Queue.completed_date == None)).update({ Queue.status: 0,
+                          Queue.completed_date: None }, synchronize_session=False)
+   db.commit()
+   if reclaimed:
+      log.info("Reclaimed %d stuck jobs" % reclaimed)
+
+#
+# Marks a job that can't be processed as failed, if this worker still
+# owns it: the job is still working, and claimed at the time this worker
+# claimed it. It is not retried.
+#
+def fail(db, row, claimed):
+   db.rollback()
+   db.query(Queue).filter(Queue.id==row.id, Queue.status==1, Queue.completed_date==claimed).update({ Queue.status: 3,
+                          Queue.completed_date: datetime.utcnow() }, synchronize_session=False)
    db.commit()
-   filename = "%s/%s" % (app.config['api.queuedir'], row.queryhash)
-   mime_type = m.id_filename(filename)
-   log.debug("%d: Identified as %s" % (row.id, mime_type))
-   for k, v in hashers.items():
-       if (not mime_type in v['types']):
-            continue
-       cmd = subprocess.check_output([v['command'], filename], stderr=subprocess.DEVNULL)
-       if cmd.split()[0]:
-          type = mime_type
-          hash = cmd.split()[0]
-          log.debug("%d: Hash=%s, type=%s" % (row.id, hash, type))
+   FAILURES.inc()
+
+#
+# Searches for works matching the hashes computed for a job, as a list of
+# (method, hash). All results are written with one multi-row insert, in
+# the same transaction as the status change to done, so a job becomes
+# visible with all its results at once. If the job has been reclaimed
+# since this worker claimed it at claimed, nothing is written.
+#
+def process(db, row, claimed, hashes):
+   results = []
+   for k, hash in hashes:
+       if hash:
+          log.debug("%d: Hash=%s, type=%s" % (row.id, hash, k))
           distance = 10   # Maximum value
 
-          query = db.query(Expression, Manifestation, Fingerprint, func.hammingdistance(hash, Fingerprint.hash).label('distance')).filter(func.hammingdistance(hash, Fingerprint.hash) < distance, Manifestation.media_type.in_(hashers[k]['types']), Manifestation.id == Fingerprint.manifestation_id, Expression.id == Manifestation.expression_id ).limit(1000).all()
-          if not query:
+          try:
+             found = find_similar(db, None, hash, distance, hashers[k]['types'], 1000)
+          except ValueError:
+             log.warning("%d: Malformed hash %r from %s" % (row.id, hash, k))
+             continue
+          if not found:
              log.debug("%d: No matching works found" % row.id)
-          for result in query:
-             log.debug("%d: Identified %d as match" % (row.id, result.Expression.id))
-             d = QueueResults(qid = row.id,
-                              distance = result.distance,
-                              expression_id = result.Expression.id)
-             db.add(d)
-             db.commit()
-   db.query(Queue).filter(Queue.id==row.id).update({ Queue.status: 2,
-                          Queue.completed_date: datetime.utcnow() })
+          for result in found:
+             log.debug("%d: Identified %d as match" % (row.id, result[1]))
+             results.append({ 'qid': row.id,
+                              'distance': result[0],
+                              'expression_id': result[1] })
+   if results:
+      db.execute(QueueResults.__table__.insert(), results)
+   owned = db.query(Queue).filter(Queue.id==row.id, Queue.status==1, Queue.completed_date==claimed).update({ Queue.status: 2,
+                          Queue.completed_date: datetime.utcnow() }, synchronize_session=False)
+   if not owned:
+      db.rollback()
+      log.warning("%d: Job was reclaimed while being processed, results dropped" % row.id)
+      return
    db.commit()
-   log.debug("%d: Completed work" % row.id)
+   JOBS.inc()
+   JOB_RESULTS.observe(len(results))
+   log.debug("%d: Completed work, %d results" % (row.id, len(results)))
+
+#
+# Claims up to limit jobs, hashes all their files concurrently with the
+# hasher backend and then processes them. A job that raises an error, or
+# whose file one of its methods failed to hash, is marked failed rather
+# than done without results; the others go on. Returns the number of jobs.
+#
+def run_batch(db, m, hasher, limit):
+   rows = []
+   jobs = []
+   for i in range(limit):
+      row = claim(db)
+      if row is None:
+         break
+      claimed = row.completed_date
+      log.debug("%d: Starting identification" % row.id)
+      if row.requested_date is not None and claimed is not None:
+         JOB_WAIT.observe((claimed - row.requested_date).total_seconds())
+      filename = "%s/%s" % (app.config['api.queuedir'], row.queryhash)
+      try:
+         mime_type = m.id_filename(filename)
+      except Exception:
+         log.exception("%d: Can't identify %s" % (row.id, filename))
+         fail(db, row, claimed)
+         continue
+      log.debug("%d: Identified as %s" % (row.id, mime_type))
+      methods = [k for k, v in hashers.items() if mime_type in v['types']]
+      rows.append((row, claimed, filename, methods))
+      jobs.extend((k, filename) for k in methods)
+
+   hashes = hash_files(hasher, jobs, int(app.config['api.hasher_parallelism']),
+                       float(app.config['api.hasher_timeout']))
+   for row, claimed, filename, methods in rows:
+      if any(not hashes[(k, filename)] for k in methods):
+         log.warning("%d: Hashing %s failed" % (row.id, filename))
+         fail(db, row, claimed)
+         continue
+      try:
+         process(db, row, claimed, [(k, hashes[(k, filename)]) for k in methods])
+      except Exception:
+         log.exception("%d: Processing failed" % row.id)
+         fail(db, row, claimed)
+   return len(rows)
+
+# Wraps a hasher backend to time every file it hashes
+class TimedHasher(object):
+
+   def __init__(self, hasher):
+      self.hasher = hasher
+
+   def hash(self, method, filename, timeout=None):
+      with HASH_SECONDS.time(method=method.rsplit('/', 1)[-1]):
+         return self.hasher.hash(method, filename, timeout)
+
+   def close(self):
+      self.hasher.close()
+
+def make_hasher():
+   backend = backends[app.config['api.hasher_backend']]
+   if app.config['api.hasher_backend'] == 'pool':
+      return TimedHasher(backend(int(app.config['api.hasher_workers'])))
+   return TimedHasher(backend())
+
+# Updates the number of jobs waiting and working
+def count_jobs(db):
+   counts = dict(db.query(Queue.status, func.count(Queue.id)).filter(Queue.status < 2).group_by(Queue.status).all())
+   db.commit()
+   QUEUE_DEPTH.set(counts.get(0, 0), status='waiting')
+   QUEUE_DEPTH.set(counts.get(1, 0), status='working')
+
+#
+# Body of one daemon worker process: claims and processes batches of jobs
+# until stopping is set, sleeping poll seconds whenever the queue is empty.
+# Jobs that fail are marked failed, see run_batch(); jobs of a worker that
+# dies stay working until reclaim() puts them back.
+#
+def work(stopping, poll, events=None):
+   signal.signal(signal.SIGINT, signal.SIG_IGN)
+   signal.signal(signal.SIGTERM, signal.SIG_IGN)
+   if events is not None:
+      metrics.REGISTRY.forward(events)
+   engine.dispose()   # Don't share the parent's connections
+   db = sessionmaker(bind=engine)()
+   m = magic.Magic(flags=magic.MAGIC_MIME_TYPE)
+   hasher = make_hasher()
+   while not stopping.is_set():
+      try:
+         if not run_batch(db, m, hasher, int(app.config['api.hasher_parallelism'])):
+            stopping.wait(poll)
+      except Exception:
+         log.exception("Processing failed")
+         db.rollback()
+         stopping.wait(poll)
+   hasher.close()
+   db.close()
+
+def daemon(workers, poll, timeout):
+   stopped = []
+   def stop(signum, frame):
+      log.info("Shutting down after current jobs")
+      stopped.append(signum)
+   signal.signal(signal.SIGINT, stop)
+   signal.signal(signal.SIGTERM, stop)
+
+   stopping = multiprocessing.Event()
+   events = None
+   if int(app.config['api.queue_metrics']):
+      events = multiprocessing.Queue()
+      threading.Thread(target=metrics.REGISTRY.collect, args=(events,), name='metrics-collect', daemon=True).start()
+      metrics.serve(int(app.config['api.queue_metrics']))
+   db = sessionmaker(bind=engine)()
+   pool = []
+   last = 0
+   while not stopped:
+      if time.time() - last > max(poll, 10):
+         reclaim(db, timeout)
+         if events is not None:
+            count_jobs(db)
+         last = time.time()
+      pool = [p for p in pool if p.is_alive()]
+      while len(pool) < workers:
+         p = multiprocessing.Process(target=work, args=(stopping, poll, events))
+         p.start()
+         pool.append(p)
+      time.sleep(1)
+   stopping.set()
+   for p in pool:
+      p.join()
+   db.close()
+
+def main():
+   parser = argparse.ArgumentParser(description='Process uploaded files in the queue')
+   parser.add_argument('--daemon', action='store_true',
+                       help='keep running and process new jobs as they arrive')
+   parser.add_argument('--workers', type=int, default=int(app.config['api.queue_workers']),
+                       help='number of worker processes in daemon mode')
+   parser.add_argument('--poll', type=float, default=float(app.config['api.queue_poll']),
+                       help='seconds to wait before looking for new jobs when idle')
+   parser.add_argument('--timeout', type=int, default=int(app.config['api.queue_timeout']),
+                       help='seconds after which a working job is considered stuck')
+   args = parser.parse_args()
+
+   if args.daemon:
+      daemon(args.workers, args.poll, args.timeout)
+      return
+
+   lock_me()
+
+   db = sessionmaker(bind=engine)()
+   m = magic.Magic(flags=magic.MAGIC_MIME_TYPE)
+   hasher = make_hasher()
+   run_batch(db, m, hasher, 10)
+   hasher.close()
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,312 @@
+#! /usr/bin/python3
+#
+# Benchmarks the API and the queue worker on a synthetic corpus.
+#
+# Generates --corpus expressions, each with one manifestation and one
+# fingerprint. The fingerprints come in --clusters clusters of near
+# duplicates, within --spread bits of a random centre. The media types are
+# mixed images and videos. The corpus goes into a SQLite file (or the
+# database given with --db). SQLite gets Python versions of the
+# HammingDistance and HammingDistanceBin functions from sql.functions, and
+# a LIKE stand-in for MySQL full text search.
+#
+# Every endpoint is then driven through the WSGI app in-process, at every
+# --concurrency level, with queries drawn near the cluster centres. The
+# queue benchmark runs jobs through backend-queue.py's claim() and
+# process(), with the hashes already computed. The output is one JSON
+# document with the p50/p95/p99 latency in milliseconds, the throughput
+# and the peak RSS of the process after every run:
+#
+#   ./benchmark.py --corpus 20000 --concurrency 1,8 --output bench.json
+#
+import argparse
+import importlib.util
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import bottle
+from sqlalchemy import create_engine, event, or_
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateTable
+from sqlalchemy_fulltext import FullTextSearch
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from models import Base, Expression, Manifestation, Fingerprint, Queue, pack_hash
+from hashers import hashers
+
+IMAGE = 'http://videorooter.org/ns/blockhash'
+VIDEO = 'http://videorooter.org/ns/x-blockhash-video-cv'
+WORDS = ('river', 'bridge', 'portrait', 'harbour', 'winter', 'market', 'cathedral',
+         'garden', 'station', 'mountain', 'festival', 'library', 'lighthouse', 'street')
+
+def hammingdistance(a, b):
+   if a is None or b is None:
+      return None
+   try:
+      return bin(int(a, 16) ^ int(b, 16)).count('1')
+   except ValueError:
+      return None
+
+def hammingdistancebin(a, b):
+   if a is None or b is None or len(a) != 32 or len(b) != 32:
+      return None
+   return bin(int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).count('1')
+
+@event.listens_for(Engine, 'connect')
+def register_functions(connection, record):
+   if isinstance(connection, sqlite3.Connection):
+      connection.create_function('hammingdistance', 2, hammingdistance)
+      connection.create_function('hammingdistancebin', 2, hammingdistancebin)
+      connection.create_function('rand', 0, random.random)
+
+@compiles(FullTextSearch, 'sqlite')
+def like_search(element, compiler, **kw):
+   pattern = '%' + element.against.value + '%'
+   columns = [getattr(element.model, c) for c in element.model.__fulltext_columns__]
+   return compiler.process(or_(*[c.like(pattern) for c in columns]), **kw)
+
+#
+# Creates the tables and fills them, returns the cluster centres. On
+# SQLite the tables are created without the MySQL full text index.
+#
+def generate(engine, corpus, clusters, spread, seed):
+   if engine.dialect.name == 'sqlite':
+      with engine.begin() as conn:
+         for table in Base.metadata.sorted_tables:
+            conn.execute(CreateTable(table, if_not_exists=True))
+   else:
+      Base.metadata.create_all(engine)
+   r = random.Random(seed)
+   centres = [(r.getrandbits(256), r.choice((IMAGE, VIDEO))) for i in range(clusters)]
+   now = datetime.utcnow()
+   with engine.begin() as conn:
+      for start in range(1, corpus + 1, 1000):
+         expressions, manifestations, fingerprints = [], [], []
+         for i in range(start, min(start + 1000, corpus + 1)):
+            centre, method = r.choice(centres)
+            value = centre
+            for k in range(r.randint(0, spread)):
+               value ^= 1 << r.randrange(256)
+            hash = '%064x' % value
+            words = ' '.join(r.choice(WORDS) for k in range(3))
+            expressions.append({'id': i, 'title': 'The %s %d' % (words, i), 'description': 'A %s' % words,
+                                'credit': '<a href="http://example.com/%d">Artist %d</a>' % (i % 97, i % 97),
+                                'credit_url': 'http://example.com/%d' % (i % 97), 'source_id': 'bench-%d' % i,
+                                'rights_statement': 'http://creativecommons.org/licenses/by/4.0/', 'updated_date': now})
+            manifestations.append({'id': i, 'expression_id': i, 'url': 'http://example.com/media/%d' % i,
+                                   'media_type': r.choice(hashers[method]['types'])})
+            fingerprints.append({'id': i, 'manifestation_id': i, 'type': method, 'hash': hash,
+                                 'hash_bin': pack_hash(hash), 'updated_date': now})
+         conn.execute(Expression.__table__.insert(), expressions)
+         conn.execute(Manifestation.__table__.insert(), manifestations)
+         conn.execute(Fingerprint.__table__.insert(), fingerprints)
+   return centres
+
+def near(r, centres, flips):
+   value, method = r.choice(centres)
+   for k in range(r.randint(0, flips)):
+      value ^= 1 << r.randrange(256)
+   return '%064x' % value, method
+
+#
+# Returns a function making the nth request of the endpoint, as
+# (method, path, body).
+#
+def requests_for(name, centres, corpus, seed):
+   r = random.Random(seed)
+   lock = threading.Lock()
+   def next_request():
+      with lock:
+         if name == 'blockhash':
+            return 'GET', '/lookup/blockhash?hash=%s' % near(r, centres, 8)[0], None
+         if name == 'video':
+            return 'GET', '/lookup/video?hash=%s&distance=30' % near(r, centres, 16)[0], None
+         if name == 'hash':
+            return 'GET', '/lookup/hash?hash=%s&distance=20' % near(r, centres, 8)[0], None
+         if name == 'text':
+            return 'GET', '/lookup/text?q=%s' % r.choice(WORDS), None
+         if name == 'works':
+            return 'GET', '/works/%d' % r.randint(1, corpus), None
+         if name == 'media':
+            return 'GET', '/works/%d/media' % r.randint(1, corpus), None
+         if name == 'batch':
+            entries = [dict(zip(('hash', 'method'), near(r, centres, 8))) for i in range(50)]
+            return 'POST', '/lookup/batch', json.dumps(entries).encode('utf-8')
+         if name == 'random':
+            return 'GET', '/random', None
+         raise ValueError('unknown endpoint %s' % name)
+   return next_request
+
+# Calls the WSGI app, returns the status code
+def call(app, method, path, body):
+   path, _, query = path.partition('?')
+   body = body or b''
+   environ = {'REQUEST_METHOD': method, 'SCRIPT_NAME': '', 'PATH_INFO': path, 'QUERY_STRING': query,
+              'SERVER_NAME': 'localhost', 'SERVER_PORT': '8080', 'SERVER_PROTOCOL': 'HTTP/1.1',
+              'CONTENT_LENGTH': str(len(body)), 'CONTENT_TYPE': 'application/json',
+              'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(body),
+              'wsgi.errors': sys.stderr, 'wsgi.multithread': True, 'wsgi.multiprocess': False,
+              'wsgi.run_once': False}
+   status = []
+   result = app(environ, lambda s, h, e=None: status.append(s))
+   try:
+      for chunk in result:
+         pass
+   finally:
+      if hasattr(result, 'close'):
+         result.close()
+   return int(status[0].split()[0])
+
+def percentile(values, p):
+   values = sorted(values)
+   return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+def summary(name, concurrency, times, errors, elapsed):
+   return {'name': name, 'concurrency': concurrency, 'requests': len(times), 'errors': errors,
+           'p50_ms': round(percentile(times, 0.50) * 1000, 3),
+           'p95_ms': round(percentile(times, 0.95) * 1000, 3),
+           'p99_ms': round(percentile(times, 0.99) * 1000, 3),
+           'throughput': round(len(times) / max(elapsed, 0.000001), 1),
+           # ru_maxrss is in kilobytes on Linux
+           'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def run_endpoint(app, name, next_request, count, concurrency):
+   times = []
+   errors = []
+   def one(i):
+      method, path, body = next_request()
+      started = time.time()
+      status = call(app, method, path, body)
+      times.append(time.time() - started)
+      # 404 is a lookup without matches, not a failure
+      if status >= 500 or status not in (200, 303, 304, 404):
+         errors.append(status)
+   started = time.time()
+   with ThreadPoolExecutor(concurrency) as executor:
+      list(executor.map(one, range(count)))
+   return summary(name, concurrency, times, len(errors), time.time() - started)
+
+# Imports backend-queue.py, which can't be imported by name, on a bottle
+# app of its own
+def load_queue():
+   spec = importlib.util.spec_from_file_location('backend_queue', os.path.join(HERE, 'backend-queue.py'))
+   module = importlib.util.module_from_spec(spec)
+   bottle.default_app.push()
+   try:
+      spec.loader.exec_module(module)
+   finally:
+      bottle.default_app.pop()
+   module.log.setLevel('INFO')
+   return module
+
+def run_queue(queue, centres, count, concurrency, seed):
+   r = random.Random(seed)
+   db = queue.sessionmaker(bind=queue.engine)()
+   db.execute(Queue.__table__.insert(), [{'queryhash': 'bench-%d-%d' % (seed, i), 'status': 0,
+                                          'requested_date': datetime.utcnow()} for i in range(count)])
+   db.commit()
+   db.close()
+   jobs = [near(r, centres, 8) for i in range(count)]
+   lock = threading.Lock()
+   times = []
+   def work(i):
+      db = queue.sessionmaker(bind=queue.engine)()
+      try:
+         while True:
+            started = time.time()
+            row = queue.claim(db)
+            if row is None:
+               return
+            with lock:
+               hash, method = jobs.pop() if jobs else near(r, centres, 8)
+            queue.process(db, row, row.completed_date, [(method, hash)])
+            times.append(time.time() - started)
+      finally:
+         db.close()
+   started = time.time()
+   with ThreadPoolExecutor(concurrency) as executor:
+      list(executor.map(work, range(concurrency)))
+   return summary('queue', concurrency, times, count - len(times), time.time() - started)
+
+def main():
+   parser = argparse.ArgumentParser(description='Benchmark the API and the queue worker on a synthetic corpus')
+   parser.add_argument('--db', help='database URL (default: a new SQLite file)')
+   parser.add_argument('--corpus', type=int, default=10000, help='number of expressions')
+   parser.add_argument('--clusters', type=int, default=500, help='number of near duplicate clusters')
+   parser.add_argument('--spread', type=int, default=12, help='bits flipped at most within a cluster')
+   parser.add_argument('--requests', type=int, default=500, help='requests per endpoint and concurrency')
+   parser.add_argument('--concurrency', default='1,8', help='comma separated concurrency levels')
+   parser.add_argument('--endpoints', default='blockhash,video,hash,text,works,media,batch,random,queue',
+                       help='comma separated endpoints to run')
+   parser.add_argument('--search', default='index', help='search= for the API, index or sql')
+   parser.add_argument('--text', default='sql', help='text= for the API, sql or index')
+   parser.add_argument('--cache', default='', help='cache= for the API')
+   parser.add_argument('--seed', type=int, default=1)
+   parser.add_argument('--output', help='write the results here instead of stdout')
+   parser.add_argument('--keep', action='store_true', help='keep the working directory with the corpus')
+   args = parser.parse_args()
+   if args.output:
+      args.output = os.path.abspath(args.output)
+
+   workdir = tempfile.mkdtemp(prefix='apicode-bench-')
+   if args.keep:
+      print('Working directory is %s' % workdir, file=sys.stderr)
+   db = args.db or 'sqlite:///%s' % os.path.join(workdir, 'bench.db')
+   started = time.time()
+   centres = generate(create_engine(db), args.corpus, args.clusters, args.spread, args.seed)
+   generated = time.time() - started
+
+   # simple.py and backend-queue.py read api.conf from the working directory
+   with open(os.path.join(workdir, 'api.conf'), 'w') as f:
+      f.write('[api]\ndb=%s\nqueuedir=%s\nsearch=%s\ntext=%s\ncache=%s\nworks_cache=\nrefresh=0\ncreate_tables=no\n'
+              % (db, workdir, args.search, args.text, args.cache))
+   os.chdir(workdir)
+   started = time.time()
+   import simple
+   loaded = time.time() - started
+   # Measure with the multi-index and the text index, which are built in the background
+   while simple.search_index is not None and simple.search_index.segments[0].hmsearch is None:
+      time.sleep(0.05)
+   while args.text == 'index' and simple.text_index is None:
+      time.sleep(0.05)
+   ready = time.time() - started
+
+   endpoints = args.endpoints.split(',')
+   queue = load_queue() if 'queue' in endpoints else None
+   results = []
+   for concurrency in [int(c) for c in args.concurrency.split(',')]:
+      for name in endpoints:
+         if name == 'queue':
+            results.append(run_queue(queue, centres, args.requests, concurrency, args.seed + concurrency))
+         else:
+            next_request = requests_for(name, centres, args.corpus, args.seed)
+            results.append(run_endpoint(simple.app, name, next_request, args.requests, concurrency))
+
+   report = {'corpus': args.corpus, 'clusters': args.clusters, 'spread': args.spread, 'db': db.split('://')[0],
+             'search': args.search, 'text': args.text, 'cache': args.cache, 'generate_s': round(generated, 3),
+             'startup_s': round(loaded, 3), 'index_ready_s': round(ready, 3), 'results': results}
+   output = json.dumps(report, indent=2)
+   if args.output:
+      with open(args.output, 'w') as f:
+         f.write(output + '\n')
+   else:
+      print(output)
+   if not args.keep:
+      shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,191 @@
+#
+# The live fingerprint index of the API, kept current while it is being
+# searched.
+#
+# The index is a tuple of immutable segments. The first one holds every
+# fingerprint loaded at startup, searched with the multi-index from
+# hmsearch.py below hmsearch_max and the matrix from fpmatrix.py above.
+# Fingerprints added or changed since then go into small segments of
+# their own, searched by brute force, and a fingerprint in a later
+# segment hides its older versions in the segments before it.
+#
+# Segments are never modified once built. apply() builds a new segment
+# off to the side and then swaps in a new tuple with a single assignment,
+# so searches never wait for a refresh; a search running at the time
+# simply finishes on the tuple it started with. When there are more than
+# max_segments, the small segments are merged into one.
+#
+# The first segment can start out with only its matrix, loaded from a
+# snapshot in seconds, and get its multi-index once that has been built
+# in the background with with_hmsearch() and replace_base(). The same
+# goes for the tables of the optional approximate search in lsh.py, which
+# searches with a recall answer from where they exist and exactly
+# everywhere else.
+#
+# Since the small segments are searched by brute force, the first
+# segment is rebuilt from the database every so often and swapped in with
+# rebase(), which drops the segments it has absorbed. That also drops
+# deleted fingerprints.
+#
+import threading
+
+from fpmatrix import FingerprintMatrix
+from hmsearch import HmSearch
+from lsh import BitSamplingLSH
+from models import Expression, Manifestation, Fingerprint
+
+# How the high-water mark is written to the meta of a snapshot
+UPDATED_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+#
+# Query for the (fingerprint id, hash_bin, hash, expression id, media
+# type, updated_date) of every fingerprint the index should hold.
+#
+def fingerprint_rows(db):
+    return db.query(Fingerprint.id, Fingerprint.hash_bin, Fingerprint.hash, Expression.id, Manifestation.media_type, Fingerprint.updated_date).filter(Manifestation.id == Fingerprint.manifestation_id, Expression.id == Manifestation.expression_id)
+
+
+#
+# Builds the matrix of every fingerprint from the database. Returns it and
+# the newest updated_date among them, the high-water mark to catch up from.
+#
+def build_matrix(db):
+    newest = []
+    def rows():
+        for row in fingerprint_rows(db).yield_per(10000):
+            if row.updated_date is not None and (not newest or row.updated_date > newest[0]):
+                newest[:] = [row.updated_date]
+            yield (row[0], row.hash_bin or row.hash, row[3], row.media_type)
+    matrix = FingerprintMatrix.from_rows(rows())
+    return matrix, newest[0] if newest else None
+
+
+class Segment(object):
+
+    def __init__(self, matrix, hmsearch=None, hmsearch_max=0, lsh=None):
+        self.matrix = matrix
+        self.hmsearch = hmsearch
+        self.hmsearch_max = hmsearch_max
+        self.lsh = lsh
+        self.ids = None
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def __contains__(self, id):
+        if self.ids is None:
+            self.ids = set(self.matrix.ids.tolist())
+        return id in self.ids
+
+    # With recall, an approximate search where the segment has the tables for it
+    def search(self, hash, maximum, types=None, recall=None):
+        if self.hmsearch is not None and maximum <= self.hmsearch_max:
+            return self.hmsearch.search(hash, maximum, types)
+        if recall is not None and self.lsh is not None:
+            return self.lsh.search(hash, maximum, types, recall)
+        return self.matrix.search(hash, maximum, types)
+
+    #
+    # Queries up to hmsearch_max go through the multi-index one by one, the
+    # others through the matrix in a single pass.
+    #
+    def search_batch(self, hashes, maxima, types=None):
+        if types is None:
+            types = [None] * len(hashes)
+        found = [None] * len(hashes)
+        scan = []
+        for q, maximum in enumerate(maxima):
+            if self.hmsearch is not None and maximum <= self.hmsearch_max:
+                found[q] = self.hmsearch.search(hashes[q], maximum, types[q])
+            else:
+                scan.append(q)
+        if scan:
+            results = self.matrix.search_batch([hashes[q] for q in scan], [maxima[q] for q in scan],
+                                               [types[q] for q in scan])
+            for q, entity in zip(scan, results):
+                found[q] = entity
+        return found
+
+    # The same segment with a multi-index for distances up to hmsearch_max
+    def with_hmsearch(self, hmsearch_max):
+        return Segment(self.matrix, HmSearch(self.matrix), hmsearch_max, self.lsh)
+
+    # The same segment with BitSamplingLSH tables for approximate searches
+    def with_lsh(self, tables, bits, probes):
+        return Segment(self.matrix, self.hmsearch, self.hmsearch_max,
+                       BitSamplingLSH(self.matrix, tables, bits, probes))
+
+
+class FingerprintIndex(object):
+
+    def __init__(self, base, max_segments=8):
+        self.segments = (base,)
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(s) for s in self.segments)
+
+    # Drops results from segments[i] that a later segment has a newer version of
+    def _visible(self, segments, found):
+        results = []
+        for i, entity in enumerate(found):
+            later = segments[i + 1:]
+            results.extend(row for row in entity if not any(row[2] in s for s in later))
+        results.sort()
+        return results
+
+    #
+    # Returns a list of (distance, expression id, fingerprint id) for all
+    # fingerprints closer than `maximum` to hash, nearest first, the same
+    # as HmSearch.search().
+    #
+    def search(self, hash, maximum, types=None, recall=None):
+        segments = self.segments
+        return self._visible(segments, [s.search(hash, maximum, types, recall) for s in segments])
+
+    def search_batch(self, hashes, maxima, types=None):
+        segments = self.segments
+        found = [s.search_batch(hashes, maxima, types) for s in segments]
+        return [self._visible(segments, [f[q] for f in found]) for q in range(len(hashes))]
+
+    #
+    # Adds (fingerprint id, hash, expression id, media type) rows, which
+    # replace any earlier version of the same fingerprints.
+    #
+    def apply(self, rows):
+        segment = Segment(FingerprintMatrix.from_rows(rows))
+        if not len(segment):
+            return
+        with self.lock:
+            segments = self.segments + (segment,)
+            if len(segments) > self.max_segments:
+                segments = (segments[0], self._merge(segments[1:]))
+            self.segments = segments
+
+    # Swaps the first segment for base, which holds the same fingerprints
+    def replace_base(self, base):
+        with self.lock:
+            self.segments = (base,) + self.segments[1:]
+
+    # Number of fingerprints in the segments after the first
+    def delta(self):
+        return sum(len(s) for s in self.segments[1:])
+
+    #
+    # Swaps the first segment for base, rebuilt from the database, and
+    # drops the segments in absorbed, the ones there were when the rebuild
+    # started. Segments applied since are kept, as base may not have them.
+    #
+    def rebase(self, base, absorbed):
+        with self.lock:
+            self.segments = (base,) + tuple(s for s in self.segments[1:] if not any(s is a for a in absorbed))
+
+    # One segment with the newest version of every fingerprint in segments
+    def _merge(self, segments):
+        rows = {}
+        for segment in segments:
+            for row in segment.matrix.rows():
+                rows[row[0]] = row
+        return Segment(FingerprintMatrix.from_rows(sorted(rows.values())))
@@ -0,0 +1,248 @@
+#
+# Brute force Hamming distance search over a packed fingerprint matrix.
+#
+# Every 256-bit hash is stored as four uint64 words in one contiguous
+# (n, 4) array, next to parallel arrays with the fingerprint id, the
+# expression id and a small integer code for the manifestation media type.
+# A search XORs the query against the whole matrix and popcounts the
+# result in one vectorized pass, which does not degrade with the search
+# radius the way the multi-index in hmsearch.py does. Several queries can
+# be answered from one pass over the matrix with search_batch().
+#
+# The arrays can be saved to a directory and loaded back memory-mapped,
+# so several WSGI workers on one host share one copy of the matrix
+# through the page cache. Such a snapshot is a directory of
+#
+#   hashes.npy, ids.npy, expression_ids.npy, media_types.npy
+#   types.json      the media type of each code in media_types
+#   snapshot.json   format version, row count, CRC-32 of the arrays and
+#                   whatever else the writer passed as meta, written last
+#
+import json
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(words):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.uint16)
+else:
+    _POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(words):
+        counts = _POPCOUNT8[words.view(np.uint8)]
+        return counts.reshape(words.shape[:-1] + (-1,)).sum(axis=-1, dtype=np.uint16)
+
+
+# Number of query x fingerprint pairs compared at once by search_batch
+BLOCK = 1 << 20
+
+# Bumped whenever the snapshot layout changes; older snapshots are refused
+VERSION = 1
+
+# Number of distinct media types a matrix can code
+TYPES = 1 << 16
+
+
+# The 32 bytes of a hex hash, which unlike int(hash, 16) allows no 0x, _
+# or blanks
+def unhex(hash):
+    raw = bytes.fromhex(hash) if len(hash) == 64 else b''
+    if len(raw) != 32:
+        raise ValueError('hash must be a 256-bit hexadecimal encoded value')
+    return raw
+
+
+def pack(hashes):
+    buf = bytearray()
+    for hash in hashes:
+        buf += unhex(hash)
+    return np.frombuffer(bytes(buf), dtype='>u8').astype(np.uint64).reshape(-1, 4)
+
+
+class FingerprintMatrix(object):
+
+    def __init__(self, hashes, ids, expression_ids, media_types, type_names):
+        self.hashes = hashes
+        self.ids = ids
+        self.expression_ids = expression_ids
+        self.media_types = media_types
+        self.type_names = list(type_names)
+        self.meta = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    #
+    # Builds a matrix from (fingerprint id, hash, expression id, media type)
+    # rows, with hashes in hex or raw bytes. Rows with malformed hashes are
+    # skipped. Media types are coded as uint16, more than TYPES of them are
+    # refused rather than wrapped around.
+    #
+    @classmethod
+    def from_rows(cls, rows):
+        hashes = bytearray()
+        ids = []
+        expression_ids = []
+        media_types = []
+        codes = {}
+        for id, hash, expression_id, media_type in rows:
+            try:
+                if isinstance(hash, (bytes, bytearray)):
+                    raw = bytes(hash)
+                else:
+                    raw = bytes.fromhex(hash) if hash else b''
+            except ValueError:
+                continue
+            if len(raw) != 32:
+                continue
+            hashes += raw
+            ids.append(id)
+            expression_ids.append(expression_id)
+            media_types.append(codes.setdefault(media_type, len(codes)))
+        if len(codes) > TYPES:
+            raise ValueError('%d media types, at most %d fit in a matrix' % (len(codes), TYPES))
+        type_names = sorted(codes, key=codes.get)
+        return cls(np.frombuffer(bytes(hashes), dtype='>u8').astype(np.uint64).reshape(-1, 4),
+                   np.array(ids, dtype=np.uint32),
+                   np.array(expression_ids, dtype=np.uint32),
+                   np.array(media_types, dtype=np.uint16),
+                   type_names)
+
+    # The inverse of from_rows(), with hashes as raw bytes
+    def rows(self):
+        raw = np.asarray(self.hashes).astype('>u8')
+        for i in range(len(self)):
+            yield (int(self.ids[i]), raw[i].tobytes(), int(self.expression_ids[i]),
+                   self.type_names[self.media_types[i]])
+
+    def checksum(self):
+        crc = 0
+        for array in (self.hashes, self.ids, self.expression_ids, self.media_types):
+            array = np.ascontiguousarray(array)
+            for start in range(0, len(array), 1 << 20):
+                crc = zlib.crc32(array[start:start + (1 << 20)].tobytes(), crc)
+        return crc
+
+    #
+    # Saves a snapshot to the directory path, with meta added to
+    # snapshot.json. An existing snapshot is kept unless replace is set;
+    # replacing it does not disturb processes that have it mapped.
+    #
+    def save(self, path, meta=None, replace=False):
+        tmp = '%s.%d' % (path, os.getpid())
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, 'hashes.npy'), self.hashes)
+        np.save(os.path.join(tmp, 'ids.npy'), self.ids)
+        np.save(os.path.join(tmp, 'expression_ids.npy'), self.expression_ids)
+        np.save(os.path.join(tmp, 'media_types.npy'), self.media_types)
+        with open(os.path.join(tmp, 'types.json'), 'w') as f:
+            json.dump(self.type_names, f)
+        snapshot = dict(meta or {}, version=VERSION, rows=len(self), checksum=self.checksum())
+        with open(os.path.join(tmp, 'snapshot.json'), 'w') as f:
+            json.dump(snapshot, f)
+        if replace and os.path.exists(path):
+            old = '%s.old.%d' % (path, os.getpid())
+            os.rename(path, old)
+            os.rename(tmp, path)
+            shutil.rmtree(old)
+            return
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Somebody else saved it first
+            shutil.rmtree(tmp)
+
+    #
+    # Loads the snapshot in the directory path. Raises ValueError if it is
+    # incomplete, of another version, or (with verify) corrupt.
+    #
+    @classmethod
+    def load(cls, path, mmap=True, verify=True):
+        mode = 'r' if mmap else None
+        try:
+            with open(os.path.join(path, 'snapshot.json')) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            raise ValueError('%s is not a complete snapshot' % path)
+        if meta.get('version') != VERSION:
+            raise ValueError('%s is a version %s snapshot, not %d' % (path, meta.get('version'), VERSION))
+        with open(os.path.join(path, 'types.json')) as f:
+            type_names = json.load(f)
+        matrix = cls(np.load(os.path.join(path, 'hashes.npy'), mmap_mode=mode),
+                     np.load(os.path.join(path, 'ids.npy'), mmap_mode=mode),
+                     np.load(os.path.join(path, 'expression_ids.npy'), mmap_mode=mode),
+                     np.load(os.path.join(path, 'media_types.npy'), mmap_mode=mode),
+                     type_names)
+        if len(matrix) != meta['rows'] or (verify and matrix.checksum() != meta['checksum']):
+            raise ValueError('%s is corrupt' % path)
+        matrix.meta = meta
+        return matrix
+
+    def type_codes(self, types):
+        return [i for i, name in enumerate(self.type_names) if name in types]
+
+    def _allowed(self, types):
+        return np.isin(self.media_types, self.type_codes(types))
+
+    #
+    # Returns a list of (distance, expression id, fingerprint id) for all
+    # fingerprints closer than `maximum` to hash, nearest first, the same
+    # as HmSearch.search().
+    #
+    def search(self, hash, maximum, types=None):
+        return self.search_batch([hash], [maximum], [types])[0]
+
+    #
+    # The search() results among the given rows only, for a query packed
+    # with pack(). For indexes that narrow down the candidate rows, such as
+    # those of hmsearch.py and lsh.py.
+    #
+    def search_rows(self, rows, query, maximum, types=None):
+        d = popcount(np.asarray(self.hashes)[rows] ^ query)
+        hits = d < maximum
+        if types is not None:
+            hits &= np.isin(np.asarray(self.media_types)[rows], self.type_codes(types))
+        results = [(int(d[i]), int(self.expression_ids[rows[i]]), int(self.ids[rows[i]]))
+                   for i in np.nonzero(hits)[0]]
+        results.sort()
+        return results
+
+    #
+    # Answers many queries with a single pass over the matrix. maxima and
+    # types are per query, as for search(); the result is one list of
+    # (distance, expression id, fingerprint id) per query.
+    #
+    def search_batch(self, hashes, maxima, types=None):
+        queries = pack(hashes)
+        maxima = np.array(maxima, dtype=np.int32)
+        if types is None:
+            types = [None] * len(queries)
+        # Queries share a filter mask per distinct set of media types
+        masks = {}
+        for q, t in enumerate(types):
+            if t is None:
+                continue
+            key = frozenset(t)
+            if key not in masks:
+                masks[key] = (self._allowed(key), [])
+            masks[key][1].append(q)
+
+        found = [[] for i in range(len(queries))]
+        if not len(queries) or not len(self):
+            return found
+        step = max(1, BLOCK // len(queries))
+        for start in range(0, len(self), step):
+            block = np.asarray(self.hashes[start:start + step])
+            d = popcount(block[None, :, :] ^ queries[:, None, :])
+            hits = d < maxima[:, None]
+            for mask, rows in masks.values():
+                hits[rows] &= mask[start:start + step]
+            for q, r in zip(*np.nonzero(hits)):
+                found[q].append((int(d[q, r]), int(self.expression_ids[start + r]),
+                                 int(self.ids[start + r])))
+        for results in found:
+            results.sort()
+        return found
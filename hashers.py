@@ -0,0 +1,263 @@
+#
+# The registry of fingerprinting methods, and the backends that run them.
+#
+# hashers maps each method URI to the media types it handles, the maximum
+# search distance for it, the external command computing it, and
+# optionally a Python function computing the same hash in-process.
+#
+# A backend turns (method, filename) into a hex hash:
+#
+#   subprocess  spawns the method's command for every file
+#   python      computes the hash in-process where the method has a
+#               function (and Pillow is installed), otherwise spawns
+#   pool        hands files to a pool of long-lived worker processes,
+#               which compute them like the python backend
+#
+# All of them give up on a file after its timeout. Only the python
+# backend can't stop the hash itself, which runs on until it is done, so
+# use pool for files that may take too long. The pool kills the worker
+# of a file that times out and starts a new one in its place.
+#
+# hash_files() runs many files through a backend concurrently, with a
+# parallelism limit and a per-file timeout.
+#
+import logging
+import math
+import multiprocessing
+import queue
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+log = logging.getLogger('hashers')
+
+
+#
+# Port of the precise blockhash method (bmvbhash) of commonsmachinery
+# blockhash, which is what its blockhash command computes by default.
+# Every pixel is weighted into the bits x bits blocks it overlaps, and
+# each block becomes a 1 bit if it is brighter than the median of its
+# horizontal band of blocks.
+#
+def blockhash(im, bits=16):
+    if im.mode not in ('RGB', 'RGBA'):
+        im = im.convert('RGBA')
+    width, height = im.size
+    pixels = np.asarray(im, dtype=np.float64)
+    values = pixels[:, :, :3].sum(axis=2)
+    if im.mode == 'RGBA':
+        values[pixels[:, :, 3] == 0] = 765
+
+    block_width = float(width) / bits
+    block_height = float(height) / bits
+    rows = _weights(height, block_height, bits)
+    cols = _weights(width, block_width, bits)
+    blocks = (rows.T.dot(values).dot(cols)).ravel()
+
+    half_block_value = block_width * block_height * 256 * 3 / 2
+    bandsize = len(blocks) // 4
+    result = []
+    for i in range(4):
+        band = blocks[i * bandsize:(i + 1) * bandsize]
+        m = np.median(band)
+        for v in band:
+            result.append(v > m or (abs(v - m) < 1 and m > half_block_value))
+    return '%0*x' % (len(result) // 4, int(''.join('1' if b else '0' for b in result), 2))
+
+
+# (size, bits) matrix of how much each pixel row/column adds to each block
+def _weights(size, block_size, bits):
+    weights = np.zeros((size, bits))
+    even = size % bits == 0
+    for i in range(size):
+        if even:
+            weights[i, int(i // block_size)] = 1
+            continue
+        frac, whole = math.modf((i + 1) % block_size)
+        if whole > 0 or i + 1 == size:
+            weights[i, int(i // block_size)] = 1
+        else:
+            weights[i, int(i // block_size)] += 1 - frac
+            weights[i, int(-(-i // block_size))] += frac
+    return weights
+
+
+def blockhash_file(filename):
+    with Image.open(filename) as im:
+        return blockhash(im)
+
+
+hashers = {
+             'http://videorooter.org/ns/blockhash': {
+                'command': '/home/api/algorithms/commonsmachinery-blockhash/build/blockhash',
+                'function': blockhash_file,
+                'types': ['image/png', 'image/jpg'],
+                'distance': 10,
+              },
+             'http://videorooter.org/ns/x-blockhash-video-cv': {
+                'command': '/home/api/algorithms/jonasob-blockhash-master/build/blockhash_video',
+                'function': None,
+                'types': ['video/mp4', 'video/mpeg', 'video/ogg', 'video/webm'],
+                'distance': 40,
+              },
+          }
+
+
+#
+# Runs the method's command on filename. The commands print the hash
+# followed by the filename.
+#
+def run_command(method, filename, timeout=None):
+    out = subprocess.check_output([hashers[method]['command'], filename],
+                                  stderr=subprocess.DEVNULL, timeout=timeout)
+    fields = out.split()
+    if not fields:
+        return None
+    return fields[0].decode('ascii')
+
+
+# The timeout only applies to methods without a function, see PythonBackend
+def run_inprocess(method, filename, timeout=None):
+    function = hashers[method]['function']
+    if function is None or Image is None:
+        return run_command(method, filename, timeout)
+    return function(filename)
+
+
+class SubprocessBackend(object):
+
+    def hash(self, method, filename, timeout=None):
+        return run_command(method, filename, timeout)
+
+    def close(self):
+        pass
+
+
+class PythonBackend(object):
+
+    # With a timeout, hashes on a thread of its own and waits that long
+    def hash(self, method, filename, timeout=None):
+        if timeout is None:
+            return run_inprocess(method, filename)
+        result = []
+        def run():
+            try:
+                result.append((True, run_inprocess(method, filename, timeout)))
+            except Exception as e:
+                result.append((False, e))
+        thread = threading.Thread(target=run, name='hash', daemon=True)
+        thread.start()
+        thread.join(timeout)
+        if not result:
+            raise TimeoutError('hashing %s took longer than %s seconds' % (filename, timeout))
+        ok, value = result[0]
+        if not ok:
+            raise value
+        return value
+
+    def close(self):
+        pass
+
+
+# Body of a pool worker: hashes (method, filename, timeout) requests
+def serve_hashes(connection):
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        try:
+            connection.send((True, run_inprocess(*request)))
+        except Exception as e:
+            connection.send((False, repr(e)))
+
+
+class PoolBackend(object):
+
+    def __init__(self, workers=4):
+        self.idle = queue.Queue()
+        self.workers = workers
+        for i in range(workers):
+            self.idle.put(self._start())
+
+    def _start(self):
+        connection, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=serve_hashes, args=(child,), daemon=True)
+        process.start()
+        child.close()
+        return process, connection
+
+    def _replace(self, worker):
+        process, connection = worker
+        process.kill()
+        process.join()
+        connection.close()
+        return self._start()
+
+    def hash(self, method, filename, timeout=None):
+        worker = self.idle.get()
+        try:
+            try:
+                worker[1].send((method, filename, timeout))
+                done = worker[1].poll(timeout)
+                if done:
+                    ok, value = worker[1].recv()
+            except (EOFError, OSError):
+                worker = self._replace(worker)
+                raise RuntimeError('the hasher worker for %s died' % filename)
+            if not done:
+                worker = self._replace(worker)
+                raise TimeoutError('hashing %s took longer than %s seconds' % (filename, timeout))
+        finally:
+            self.idle.put(worker)
+        if not ok:
+            raise RuntimeError(value)
+        return value
+
+    def close(self):
+        for i in range(self.workers):
+            process, connection = self.idle.get()
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+            connection.close()
+
+
+backends = {
+    'subprocess': SubprocessBackend,
+    'python': PythonBackend,
+    'pool': PoolBackend,
+}
+
+
+#
+# Hashes every (method, filename) in jobs with backend, running up to
+# parallelism of them at a time. Returns a dict from (method, filename)
+# to the hex hash, or None if hashing failed or took longer than timeout
+# seconds.
+#
+def hash_files(backend, jobs, parallelism=4, timeout=None):
+    results = {}
+    with ThreadPoolExecutor(max(1, parallelism)) as executor:
+        futures = dict((job, executor.submit(backend.hash, job[0], job[1], timeout))
+                       for job in jobs)
+        for job, future in futures.items():
+            try:
+                results[job] = future.result()
+            except Exception as e:
+                log.warning("Hashing %s with %s failed: %r" % (job[1], job[0], e))
+                results[job] = None
+    return results
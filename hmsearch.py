@@ -0,0 +1,103 @@
+#
+# In-process nearest neighbour search over 256-bit blockhashes, using
+# multi-index hashing in the style of HmSearch.
+#
+# Every hash is split into a number of equally wide substrings, and each
+# substring position gets its own exact-match table from substring value
+# to fingerprints. If two hashes are at most D bits apart, then by the
+# pigeonhole principle at least one of their substrings is at most
+# D // chunks bits apart. A query therefore only has to look up every
+# substring variant within that many bits, and verify the (few) candidates
+# it finds against the full hash, instead of scanning every fingerprint.
+#
+# The tables are built from a fingerprint matrix (see fpmatrix.py) and
+# hold row numbers of the matrix, which has the hashes, ids and media
+# types. Like the tables in lsh.py, each is the rows ordered by their
+# substring plus where every substring value starts in that order: 4
+# bytes per fingerprint and table, and 4 * 2 ** (256 / chunks) bytes.
+#
+# Hashes are given in hex, or as the 32 raw bytes of Fingerprint.hash_bin.
+# Distances are exclusive, the same as the SQL path in simple.py:
+# search(hash, 10) returns everything with hammingdistance(hash, x) < 10.
+#
+from itertools import combinations
+
+import numpy as np
+
+from fpmatrix import unhex
+
+
+# The four big-endian 64-bit words of a hash; hex hashes are parsed by
+# unhex(), the same as for the matrix
+def parse_hash(hash):
+    if isinstance(hash, (bytes, bytearray)):
+        if len(hash) != 32:
+            raise ValueError('hash must be 32 bytes')
+        raw = bytes(hash)
+    else:
+        raw = unhex(hash)
+    return np.frombuffer(raw, dtype='>u8').astype(np.uint64)
+
+
+class HmSearch(object):
+
+    def __init__(self, matrix, chunks=16):
+        width = 256 // chunks
+        if 256 % chunks or 64 % width or width > 16:
+            raise ValueError('chunks must be 16, 32, 64, 128 or 256')
+        self.matrix = matrix
+        self.chunks = chunks
+        self.width = width
+        self.mask = (1 << width) - 1
+        self.flips = {}
+        self.orders = []
+        self.starts = []
+        hashes = np.asarray(matrix.hashes)
+        for t in range(chunks):
+            keys = self._keys(hashes, t)
+            self.orders.append(np.argsort(keys, kind='stable').astype(np.uint32))
+            # Rows with substring k are orders[t][starts[t][k]:starts[t][k + 1]]
+            self.starts.append(np.concatenate(([0], np.cumsum(np.bincount(keys, minlength=1 << width)))).astype(np.uint32))
+
+    def __len__(self):
+        return len(self.matrix)
+
+    # Substring t of every hash in hashes, an (n, 4) array of words
+    def _keys(self, hashes, t):
+        per_word = 64 // self.width
+        shift = np.uint64((t % per_word) * self.width)
+        return ((hashes[:, t // per_word] >> shift) & np.uint64(self.mask)).astype(np.int64)
+
+    # The masks flipping up to bits bits of a substring, no flip first
+    def _flips(self, bits):
+        flips = self.flips.get(bits)
+        if flips is None:
+            masks = [0]
+            for n in range(1, bits + 1):
+                for positions in combinations(range(self.width), n):
+                    masks.append(sum(1 << p for p in positions))
+            flips = self.flips[bits] = np.array(masks, dtype=np.int64)
+        return flips
+
+    #
+    # Returns a list of (distance, expression id, fingerprint id) for all
+    # fingerprints closer than `maximum` to hash, nearest first. If types
+    # is given, only fingerprints of manifestations with one of those
+    # media types are considered.
+    #
+    def search(self, hash, maximum, types=None):
+        query = parse_hash(hash)
+        if maximum <= 0 or not len(self.matrix):
+            return []
+        flips = self._flips((maximum - 1) // self.chunks)
+        found = []
+        for t in range(self.chunks):
+            variants = int(self._keys(query[None, :], t)[0]) ^ flips
+            starts = self.starts[t]
+            begin = starts[variants]
+            end = starts[variants + 1]
+            for i in np.nonzero(end > begin)[0]:
+                found.append(self.orders[t][begin[i]:end[i]])
+        if not found:
+            return []
+        return self.matrix.search_rows(np.unique(np.concatenate(found)), query, maximum, types)
@@ -0,0 +1,55 @@
+#! /usr/bin/python3
+#
+# Imports catalog records, one JSON object per line, from the given files
+# or stdin into the database. See ingest.py for the record format.
+#
+from bottle import default_app
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import argparse
+import fileinput
+import json
+import logging
+
+from models import Base
+from ingest import Importer
+
+app = default_app()
+
+app.config.load_config('api.conf')
+app.config.setdefault('api.db', 'sqlite:///:memory:')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)8s  %(message)s')
+log = logging.getLogger('import')
+
+def main():
+   parser = argparse.ArgumentParser(description='Import newline-delimited JSON catalog records')
+   parser.add_argument('files', nargs='*', help='files to read, stdin if none')
+   parser.add_argument('--batch', type=int, default=1000,
+                       help='records written per multi-row insert')
+   parser.add_argument('--commit-every', type=int, default=10,
+                       help='batches per transaction')
+   args = parser.parse_args()
+
+   engine = create_engine(app.config['api.db'], echo=False)
+   Base.metadata.create_all(engine)
+   db = sessionmaker(bind=engine)()
+
+   importer = Importer(db, args.batch, args.commit_every)
+   for n, line in enumerate(fileinput.input(args.files)):
+      line = line.strip()
+      if not line:
+         continue
+      try:
+         importer.add(json.loads(line))
+      except ValueError:
+         log.warning("Line %d is not valid JSON, skipped" % (n + 1))
+         importer.stats['skipped'] += 1
+   importer.close()
+
+   log.info("Done: %(records)d records, %(expressions)d expressions, %(manifestations)d manifestations and %(fingerprints)d fingerprints written, %(skipped)d skipped" % importer.stats)
+   log.info("%.0f records/s" % importer.rate())
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,167 @@
+#
+# Bulk import of catalog records into expression, manifestation and
+# fingerprint.
+#
+# A record is one flat JSON object per manifestation fingerprint:
+#
+#   {"source_id": "...", "title": "...", "description": "...",
+#    "rights_statement": "...", "credit": "...", "credit_url": "...",
+#    "collection_url": "...", "url": "...", "media_type": "image/png",
+#    "type": "http://videorooter.org/ns/blockhash", "hash": "..."}
+#
+# Records that are not such an object, have no source_id or have a field
+# that is neither a string nor null are counted as skipped, as are
+# fingerprints whose hash is not 256 bits of hex.
+#
+# Expressions are upserted by source_id (which has to be indexed, see
+# models.py), manifestations by expression and url, and fingerprints by
+# manifestation and type. Records are buffered and written a batch at a
+# time with multi-row inserts, so memory stays constant however large the
+# input is. Rows that already exist are only updated when something
+# changed, which keeps their updated_date (and everything cached on it)
+# intact.
+#
+# The import runs apart from the API. Every fingerprint it adds or
+# changes gets a new updated_date, which is how the refresher of the
+# API's in-process index finds it (see refresh_index() in simple.py), so
+# imports become searchable within refresh seconds of their commit.
+#
+import logging
+import time
+
+from sqlalchemy import bindparam
+
+from models import Expression, Manifestation, Fingerprint, pack_hash
+
+log = logging.getLogger('ingest')
+
+EXPRESSION_FIELDS = ('title', 'description', 'rights_statement', 'credit',
+                     'credit_url', 'collection_url')
+FIELDS = ('source_id', 'url', 'media_type', 'type', 'hash') + EXPRESSION_FIELDS
+
+
+def valid(record):
+    if not isinstance(record, dict) or not record.get('source_id'):
+        return False
+    return all(isinstance(record.get(f), (str, type(None))) for f in FIELDS)
+
+
+class Importer(object):
+
+    def __init__(self, db, batch=1000, commit_every=10):
+        self.db = db
+        self.batch = batch
+        self.commit_every = commit_every
+        self.pending = []
+        self.batches = 0
+        self.started = time.time()
+        self.stats = dict.fromkeys(('records', 'skipped', 'expressions',
+                                    'manifestations', 'fingerprints'), 0)
+
+    def add(self, record):
+        if not valid(record):
+            self.stats['skipped'] += 1
+            return
+        self.pending.append(record)
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def rate(self):
+        return self.stats['records'] / max(time.time() - self.started, 0.001)
+
+    def flush(self):
+        records = self.pending
+        self.stats['records'] += len(records)
+        self.pending = []
+        if records:
+            expressions = self._expressions(records)
+            manifestations = self._manifestations(records, expressions)
+            self._fingerprints(records, expressions, manifestations)
+        self.batches += 1
+        if self.batches % self.commit_every == 0:
+            self.commit()
+            log.info("%d records, %d skipped, %.0f records/s" % (
+                self.stats['records'], self.stats['skipped'], self.rate()))
+
+    #
+    # Inserts the rows in wanted (key -> field values) that are not in
+    # existing (key -> (id, field values)) with one multi-row insert, and
+    # updates those whose fields differ. Returns the keys of rows written.
+    #
+    def _upsert(self, model, key, fields, wanted, existing):
+        table = model.__table__
+        new = [k for k in wanted if k not in existing]
+        changed = [k for k in wanted if k in existing and
+                   any(existing[k][1].get(f) != wanted[k].get(f) for f in fields)]
+        if new:
+            self.db.execute(table.insert().values([dict(zip(key, k), **wanted[k]) for k in new]))
+        if changed:
+            update = table.update().where(table.c.id == bindparam('_id')).values(
+                         dict((f, bindparam('_' + f)) for f in fields))
+            self.db.execute(update, [dict([('_id', existing[k][0])] + [('_' + f, wanted[k].get(f)) for f in fields])
+                                     for k in changed])
+        return new + changed
+
+    def _expressions(self, records):
+        wanted = {}
+        for r in records:
+            wanted[(r['source_id'],)] = dict((f, r.get(f)) for f in EXPRESSION_FIELDS)
+        sources = [k[0] for k in wanted]
+
+        def load():
+            rows = self.db.query(Expression.id, Expression.source_id, *[getattr(Expression, f) for f in EXPRESSION_FIELDS]).filter(Expression.source_id.in_(sources)).order_by(Expression.id)
+            found = {}
+            for row in rows:
+                found.setdefault((row.source_id,), (row.id, dict((f, getattr(row, f)) for f in EXPRESSION_FIELDS)))
+            return found
+        self.stats['expressions'] += len(self._upsert(Expression, ('source_id',), EXPRESSION_FIELDS, wanted, load()))
+        return dict((k[0], v[0]) for k, v in load().items())
+
+    def _manifestations(self, records, expressions):
+        wanted = {}
+        for r in records:
+            if r.get('url'):
+                wanted[(expressions[r['source_id']], r['url'])] = {'media_type': r.get('media_type')}
+        if not wanted:
+            return {}
+        ids = set(k[0] for k in wanted)
+
+        def load():
+            rows = self.db.query(Manifestation.id, Manifestation.expression_id, Manifestation.url, Manifestation.media_type).filter(Manifestation.expression_id.in_(ids)).order_by(Manifestation.id)
+            found = {}
+            for row in rows:
+                found.setdefault((row.expression_id, row.url), (row.id, {'media_type': row.media_type}))
+            return found
+        self.stats['manifestations'] += len(self._upsert(Manifestation, ('expression_id', 'url'), ('media_type',), wanted, load()))
+        return dict((k, v[0]) for k, v in load().items())
+
+    def _fingerprints(self, records, expressions, manifestations):
+        wanted = {}
+        for r in records:
+            manifestation = manifestations.get((expressions[r['source_id']], r.get('url')))
+            if manifestation is None or not r.get('type'):
+                continue
+            hash_bin = pack_hash(r.get('hash'))
+            if hash_bin is None:
+                self.stats['skipped'] += 1
+                continue
+            wanted[(manifestation, r['type'])] = {'hash': r['hash'].lower(), 'hash_bin': hash_bin}
+        if not wanted:
+            return
+        ids = set(k[0] for k in wanted)
+
+        def load():
+            rows = self.db.query(Fingerprint.id, Fingerprint.manifestation_id, Fingerprint.type, Fingerprint.hash, Fingerprint.hash_bin).filter(Fingerprint.manifestation_id.in_(ids)).order_by(Fingerprint.id)
+            found = {}
+            for row in rows:
+                found.setdefault((row.manifestation_id, row.type), (row.id, {'hash': row.hash, 'hash_bin': row.hash_bin}))
+            return found
+        dirty = self._upsert(Fingerprint, ('manifestation_id', 'type'), ('hash', 'hash_bin'), wanted, load())
+        self.stats['fingerprints'] += len(dirty)
@@ -0,0 +1,78 @@
+#
+# Fingerprint lookups shared by simple.py and backend-queue.py.
+#
+# find_similar() answers from the in-process index when one is given (see
+# fpindex.py), and from SQL otherwise. The SQL query narrows the
+# fingerprints to the media types of the method before the distance is
+# computed, and computes it only once per fingerprint: MySQL filters on
+# the selected distance with HAVING, other databases through a subquery.
+# It joins fingerprint, manifestation and expression the same way the
+# index is loaded (see fingerprint_rows() in fpindex.py), so that both
+# skip fingerprints of manifestations without an expression. Whatever is
+# shown about the hits is fetched afterwards for just those, see titles().
+#
+import bisect
+
+from sqlalchemy import literal_column, tuple_
+
+from models import Expression, Manifestation, Fingerprint, hamming_distance
+from hashers import hashers
+
+
+#
+# Returns the hashers entry for method, given either as the full
+# namespace URI or as its last path segment (e.g. "blockhash").
+#
+def find_hasher(method):
+    if method in hashers:
+        return hashers[method]
+    for k, v in hashers.items():
+        if k.rsplit('/', 1)[-1] == method:
+            return v
+    return None
+
+
+#
+# Returns (distance, expression id, fingerprint id) tuples for the
+# fingerprints closer than distance to hash, ordered by distance and
+# expression id, and optionally limited to the given media types. If after
+# is given, only results ordered after that tuple are returned; with limit,
+# at most limit of them. With recall, the index may answer approximately,
+# finding about that fraction of them. Raises ValueError for a malformed
+# hash.
+#
+def find_similar(db, index, hash, distance, types=None, limit=None, after=None, recall=None):
+    if index is not None:
+        entity = index.search(hash, distance, types, recall)
+        start = bisect.bisect_right(entity, after) if after else 0
+        return entity[start:] if limit is None else entity[start:start + limit]
+
+    if len(hash) != 64:
+        raise ValueError('hash must be a 256-bit hexadecimal encoded value')
+    hamming = hamming_distance(hash).label('distance')
+    query = db.query(hamming, Manifestation.expression_id, Fingerprint.id).filter(Manifestation.id == Fingerprint.manifestation_id, Expression.id == Manifestation.expression_id)
+    if types is not None:
+        query = query.filter(Manifestation.media_type.in_(types))
+    if db.bind.dialect.name == 'mysql':
+        columns = (literal_column('distance'), Manifestation.expression_id, Fingerprint.id)
+        query = query.having(columns[0] < distance)
+        if after:
+            query = query.having(tuple_(*columns) > tuple_(*after))
+    else:
+        candidates = query.subquery()
+        columns = (candidates.c.distance, candidates.c.expression_id, candidates.c.id)
+        query = db.query(*columns).filter(columns[0] < distance)
+        if after:
+            query = query.filter(tuple_(*columns) > tuple_(*after))
+    query = query.order_by(*columns)
+    if limit is not None:
+        query = query.limit(limit)
+    return [tuple(row) for row in query]
+
+
+# Expression id -> title for the given expression ids, in one query
+def titles(db, ids):
+    ids = set(ids)
+    if not ids:
+        return {}
+    return dict(db.query(Expression.id, Expression.title).filter(Expression.id.in_(ids)))
@@ -0,0 +1,111 @@
+#! /usr/bin/python3
+#
+# Measures the recall and latency of the approximate video search (see
+# lsh.py) against the exact matrix scan, on the fingerprints in the
+# snapshot at matrix in api.conf (or --path), or read from the database.
+#
+# Queries are fingerprints drawn from the data with up to --flip random
+# bits flipped. For every recall target it prints one JSON line with the
+# measured recall (the fraction of exact matches found, over all
+# queries), the mean and 95th percentile latency in milliseconds of both
+# searches, and the mean number of candidates checked.
+#
+from bottle import default_app
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import argparse
+import json
+import logging
+import random
+import time
+
+from fpmatrix import FingerprintMatrix, pack
+from fpindex import build_matrix
+from hashers import hashers
+from lsh import BitSamplingLSH
+
+app = default_app()
+
+app.config.load_config('api.conf')
+app.config.setdefault('api.db', 'sqlite:///:memory:')
+app.config.setdefault('api.matrix', '')
+app.config.setdefault('api.lsh_tables', '0')
+app.config.setdefault('api.lsh_bits', '16')
+app.config.setdefault('api.lsh_probes', '1')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)8s  %(message)s')
+log = logging.getLogger('lsh-eval')
+
+def percentile(values, p):
+   values = sorted(values)
+   return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+def main():
+   parser = argparse.ArgumentParser(description='Measure approximate search recall and latency')
+   parser.add_argument('--path', default=app.config['api.matrix'],
+                       help='snapshot directory (default: matrix from api.conf, else the database)')
+   parser.add_argument('--queries', type=int, default=200)
+   parser.add_argument('--distance', type=int, default=40)
+   parser.add_argument('--flip', type=int, default=20,
+                       help='flip up to this many bits of every query')
+   parser.add_argument('--tables', type=int, default=int(app.config['api.lsh_tables']) or 16)
+   parser.add_argument('--bits', type=int, default=int(app.config['api.lsh_bits']))
+   parser.add_argument('--probes', type=int, default=int(app.config['api.lsh_probes']))
+   parser.add_argument('--recall', default='0.5,0.8,0.9,0.95,0.99',
+                       help='comma separated recall targets')
+   parser.add_argument('--all-types', action='store_true',
+                       help='search all fingerprints, not only videos')
+   parser.add_argument('--seed', type=int, default=0)
+   args = parser.parse_args()
+
+   if args.path:
+      matrix = FingerprintMatrix.load(args.path)
+   else:
+      db = sessionmaker(bind=create_engine(app.config['api.db'], echo=False))()
+      matrix, updated = build_matrix(db)
+      db.close()
+   if not len(matrix):
+      parser.error('no fingerprints')
+   types = None if args.all_types else hashers['http://videorooter.org/ns/x-blockhash-video-cv']['types']
+
+   started = time.time()
+   lsh = BitSamplingLSH(matrix, args.tables, args.bits, args.probes)
+   log.info("Built %d tables over %d fingerprints in %.1fs" % (args.tables, len(matrix), time.time() - started))
+
+   r = random.Random(args.seed)
+   rows = list(matrix.rows())
+   queries = []
+   for i in range(args.queries):
+      value = int.from_bytes(r.choice(rows)[1], 'big')
+      for k in range(r.randint(0, args.flip)):
+         value ^= 1 << r.randrange(256)
+      queries.append('%064x' % value)
+
+   exact = []
+   exact_times = []
+   for q in queries:
+      started = time.time()
+      exact.append(set(matrix.search(q, args.distance, types)))
+      exact_times.append((time.time() - started) * 1000)
+
+   for recall in [float(v) for v in args.recall.split(',')]:
+      found = 0
+      times = []
+      candidates = 0
+      plan = lsh.plan(args.distance, recall)
+      for q, expected in zip(queries, exact):
+         started = time.time()
+         approx = lsh.search(q, args.distance, types, recall)
+         times.append((time.time() - started) * 1000)
+         found += len(expected.intersection(approx))
+         candidates += len(lsh.candidates(pack([q])[0], *plan))
+      print(json.dumps({'target': recall, 'tables': plan[0], 'probes': plan[1],
+                        'recall': round(float(found) / max(1, sum(len(e) for e in exact)), 4),
+                        'matches': sum(len(e) for e in exact),
+                        'candidates': round(float(candidates) / len(queries), 1),
+                        'approx_ms': round(sum(times) / len(times), 3), 'approx_p95_ms': round(percentile(times, 0.95), 3),
+                        'exact_ms': round(sum(exact_times) / len(exact_times), 3), 'exact_p95_ms': round(percentile(exact_times, 0.95), 3)}))
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,104 @@
+#
+# Approximate Hamming distance search by bit-sampling locality sensitive
+# hashing, for large radii over large matrices (see fpmatrix.py), where
+# even the vectorized scan of every fingerprint is too slow.
+#
+# Each of `tables` tables keys every fingerprint by `bits` randomly chosen
+# bit positions of its hash. Two hashes r bits apart agree on one sampled
+# bit with probability 1 - r / 256, so near neighbours tend to share a
+# key in at least one table. A query looks up its own key in each table,
+# and with probes > 0 also the keys that differ from it in up to that many
+# bits, and checks the fingerprints found against their true distance.
+# Results are therefore never wrong, but may be incomplete.
+#
+# The tables and probes used for a query are the cheapest combination
+# whose estimated recall, for a neighbour just inside the search radius,
+# reaches the recall asked for. Nearer neighbours are found more often.
+#
+# Every table takes 4 bytes per fingerprint plus 4 * 2 ** bits bytes.
+#
+from itertools import combinations
+from math import comb
+
+import numpy as np
+
+from fpmatrix import pack
+
+
+class BitSamplingLSH(object):
+
+    def __init__(self, matrix, tables=16, bits=16, probes=1, seed=0):
+        if not 0 < bits <= 24:
+            raise ValueError('bits must be between 1 and 24')
+        self.matrix = matrix
+        self.bits = bits
+        self.probes = probes
+        random = np.random.RandomState(seed)
+        self.positions = [random.choice(256, bits, replace=False) for i in range(tables)]
+        self.orders = []
+        self.starts = []
+        hashes = np.asarray(matrix.hashes)
+        for positions in self.positions:
+            keys = self._keys(hashes, positions)
+            self.orders.append(np.argsort(keys, kind='stable').astype(np.uint32))
+            # Rows with key k are orders[t][starts[t][k]:starts[t][k + 1]]
+            self.starts.append(np.concatenate(([0], np.cumsum(np.bincount(keys, minlength=1 << bits)))).astype(np.uint32))
+
+    def _keys(self, hashes, positions):
+        keys = np.zeros(len(hashes), dtype=np.int64)
+        for j, p in enumerate(positions):
+            bit = (hashes[:, p // 64] >> np.uint64(p % 64)) & np.uint64(1)
+            keys |= bit.astype(np.int64) << j
+        return keys
+
+    #
+    # Returns the (tables, probes) to use so that a fingerprint maximum - 1
+    # bits away is found with at least the given probability, or all of
+    # them if that is out of reach.
+    #
+    def plan(self, maximum, recall):
+        agree = 1 - float(max(maximum - 1, 0)) / 256
+        best = None
+        for probes in range(self.probes + 1):
+            keys = sum(comb(self.bits, i) for i in range(probes + 1))
+            found = sum(comb(self.bits, i) * (1 - agree) ** i * agree ** (self.bits - i)
+                        for i in range(probes + 1))
+            for tables in range(1, len(self.positions) + 1):
+                if 1 - (1 - found) ** tables >= recall:
+                    if best is None or tables * keys < best[0]:
+                        best = (tables * keys, tables, probes)
+                    break
+        if best is None:
+            return len(self.positions), self.probes
+        return best[1], best[2]
+
+    def _probe_keys(self, key, probes):
+        yield key
+        for n in range(1, probes + 1):
+            for flipped in combinations(range(self.bits), n):
+                variant = key
+                for j in flipped:
+                    variant ^= 1 << j
+                yield variant
+
+    def candidates(self, query, tables, probes):
+        found = []
+        for t in range(tables):
+            key = int(self._keys(query[None, :], self.positions[t])[0])
+            starts = self.starts[t]
+            for k in self._probe_keys(key, probes):
+                if starts[k + 1] > starts[k]:
+                    found.append(self.orders[t][starts[k]:starts[k + 1]])
+        if not found:
+            return np.empty(0, dtype=np.uint32)
+        return np.unique(np.concatenate(found))
+
+    #
+    # Returns a list of (distance, expression id, fingerprint id) for
+    # fingerprints closer than `maximum` to hash, nearest first, like
+    # FingerprintMatrix.search() but only finding about recall of them.
+    #
+    def search(self, hash, maximum, types=None, recall=0.9):
+        query = pack([hash])[0]
+        tables, probes = self.plan(maximum, recall)
+        return self.matrix.search_rows(self.candidates(query, tables, probes), query, maximum, types)
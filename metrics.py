@@ -0,0 +1,351 @@
+#
+# Counters, gauges and histograms for the API and the queue worker, in the
+# Prometheus text format.
+#
+# Metrics live in a Registry, REGISTRY by default, and are kept per
+# combination of label values. render() writes all of them out for a
+# /metrics endpoint. The queue daemon's worker processes can't serve their
+# own, so forward() turns every update in a worker into a message on a
+# multiprocessing queue, which collect() applies to the registry of the
+# daemon, see backend-queue.py.
+#
+# For the API:
+#
+#   MetricsPlugin      a bottle plugin timing every route
+#   instrument(engine) times every SQL statement as the db stage
+#   stage(name)        times a block of code as a stage, less the db time
+#                      of the statements executed within it, so that an
+#                      orm stage only counts fetching rows and building
+#                      objects
+#   Profiler           samples the stacks of running requests and logs
+#                      those of requests slower than a threshold, in the
+#                      collapsed format of flamegraph.pl
+#
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+from bottle import HTTPResponse, response
+from sqlalchemy import event
+
+log = logging.getLogger('metrics')
+
+# Upper bounds of the histogram buckets, in seconds unless noted otherwise
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+    # Applies the update here, or sends it to the registry's sink
+    def _update(self, method, value, labels):
+        sink = self.registry.sink
+        if sink is not None:
+            sink.put((self.name, method, value, labels))
+            return False
+        return True
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.registry.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.append('%s%s %s' % (self.name, self._labels(key), number(value)))
+        return lines
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        if self._update('inc', value, labels):
+            key = self._key(labels)
+            with self.registry.lock:
+                self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        if self._update('set', value, labels):
+            with self.registry.lock:
+                self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(), buckets=BUCKETS):
+        Metric.__init__(self, registry, name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        if self._update('observe', value, labels):
+            key = self._key(labels)
+            with self.registry.lock:
+                entry = self.values.get(key)
+                if entry is None:
+                    entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+                for i, bound in enumerate(self.buckets):
+                    if value <= bound:
+                        entry[0][i] += 1
+                        break
+                entry[1] += value
+                entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.registry.lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (self.name, self._labels(key, [('le', number(bound))]), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, self._labels(key), number(total)))
+            lines.append('%s_count%s %d' % (self.name, self._labels(key), count))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.sink = None
+
+    # Returns the metric called name, defining it on first use
+    def _metric(self, kind, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = kind(self, name, *args, **kwargs)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._metric(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._metric(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self._metric(Histogram, name, help, labels, buckets)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+    # Sends all updates to queue from now on, see collect()
+    def forward(self, queue):
+        self.sink = queue
+
+    # Applies the updates forwarded by other processes, forever
+    def collect(self, queue):
+        while True:
+            name, method, value, labels = queue.get()
+            metric = self.metrics.get(name)
+            if metric is not None:
+                getattr(metric, method)(value, **labels)
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram('apicode_request_seconds', 'Time spent handling requests, by route',
+                                     ('method', 'route', 'status'))
+STAGE_SECONDS = REGISTRY.histogram('apicode_stage_seconds',
+                                   'Time spent in the db, orm, index, soup and json stages of requests',
+                                   ('stage',))
+
+local = threading.local()
+
+
+def db_time():
+    return getattr(local, 'db', 0.0)
+
+
+@contextmanager
+def stage(name):
+    started = time.time()
+    db = db_time()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.time() - started - (db_time() - db), stage=name)
+
+
+# Times every statement executed on engine as the db stage
+def instrument(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_started = time.time()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_metrics_started', None)
+        if started is not None:
+            elapsed = time.time() - started
+            local.db = db_time() + elapsed
+            STAGE_SECONDS.observe(elapsed, stage='db')
+
+
+#
+# Samples the stack of every thread handling a request each interval
+# seconds. When a request took slow seconds or more, its samples are
+# logged as "frame;frame;... count" lines, outermost frame first, most
+# frequent first.
+#
+class Profiler(object):
+
+    def __init__(self, slow, interval=0.005, top=20):
+        self.slow = slow
+        self.interval = interval
+        self.top = top
+        self.active = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, name='profiler', daemon=True).start()
+
+    def start(self):
+        ident = threading.get_ident()
+        with self.lock:
+            self.active[ident] = {}
+        return ident
+
+    def stop(self, ident, elapsed, label):
+        with self.lock:
+            samples = self.active.pop(ident, None)
+        if elapsed < self.slow or not samples:
+            return
+        stacks = sorted(samples.items(), key=lambda item: -item[1])[:self.top]
+        log.warning('Slow request %s took %.3fs, %d samples:\n%s' % (
+            label, elapsed, sum(samples.values()),
+            '\n'.join('%s %d' % stack for stack in stacks)))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, samples in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = collapse(frame)
+                        samples[stack] = samples.get(stack, 0) + 1
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+#
+# Times every route of a bottle app in apicode_request_seconds, labelled
+# with the route rule rather than the path, and profiles it if a Profiler
+# is given. Install it before other plugins, so that it also times them.
+# A streamed response is timed up to the start of the streaming.
+#
+class MetricsPlugin(object):
+
+    name = 'metrics'
+    api = 2
+
+    def __init__(self, profiler=None):
+        self.profiler = profiler
+
+    def apply(self, callback, route):
+        method, rule = route.method, route.rule
+        profiler = self.profiler
+
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            ident = profiler.start() if profiler is not None else None
+            status = 500
+            try:
+                body = callback(*args, **kwargs)
+                # Routes may return a response (a 304, say) instead of raising it
+                status = body.status_code if isinstance(body, HTTPResponse) else response.status_code
+                return body
+            except HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                elapsed = time.time() - started
+                REQUEST_SECONDS.observe(elapsed, method=method, route=rule, status=status)
+                if profiler is not None:
+                    profiler.stop(ident, elapsed, '%s %s' % (method, rule))
+
+        return wrapper
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+#
+# Serves registry at /metrics on host:port from a background thread, for
+# processes that have no web server of their own.
+#
+def serve(port, host='0.0.0.0', registry=REGISTRY):
+    def app(environ, start_response):
+        if environ['PATH_INFO'] != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'not found']
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE)])
+        return [registry.render().encode('utf-8')]
+
+    server = make_server(host, port, app, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,73 @@
+#! /usr/bin/python3
+#
+# Converts the hex fingerprint.hash of existing rows to the binary
+# fingerprint.hash_bin, adding the column first if needed. Runs online in
+# small batches, each in its own transaction, walking the table by id, so
+# it can be interrupted and restarted (with --start to skip ahead) at any
+# time. Rows written through the models get hash_bin set directly.
+#
+from bottle import default_app
+from sqlalchemy import create_engine, inspect, bindparam
+from sqlalchemy.orm import sessionmaker
+
+import argparse
+import logging
+import time
+
+from models import Fingerprint, pack_hash
+
+app = default_app()
+
+app.config.load_config('api.conf')
+app.config.setdefault('api.db', 'sqlite:///:memory:')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)8s  %(message)s')
+log = logging.getLogger('migrate')
+
+def add_column(engine):
+   columns = [c['name'] for c in inspect(engine).get_columns('fingerprint')]
+   if 'hash_bin' not in columns:
+      log.info("Adding column fingerprint.hash_bin")
+      with engine.begin() as conn:
+         conn.exec_driver_sql('ALTER TABLE fingerprint ADD COLUMN hash_bin BINARY(32)')
+
+def main():
+   parser = argparse.ArgumentParser(description='Convert hex fingerprints to binary')
+   parser.add_argument('--batch', type=int, default=5000,
+                       help='rows converted per transaction')
+   parser.add_argument('--pause', type=float, default=0,
+                       help='seconds to sleep between batches, to go easy on the database')
+   parser.add_argument('--start', type=int, default=0,
+                       help='only convert rows with an id above this')
+   args = parser.parse_args()
+
+   engine = create_engine(app.config['api.db'], echo=False)
+   add_column(engine)
+   db = sessionmaker(bind=engine)()
+
+   table = Fingerprint.__table__
+   # Setting updated_date to itself keeps MySQL from bumping it, as this
+   # doesn't change the fingerprint
+   update = table.update().where(table.c.id == bindparam('fid')).values(
+                hash_bin=bindparam('bin'), updated_date=table.c.updated_date)
+   last = args.start
+   converted = 0
+   started = time.time()
+   while True:
+      rows = db.query(Fingerprint.id, Fingerprint.hash).filter(Fingerprint.id > last, Fingerprint.hash_bin == None).order_by(Fingerprint.id).limit(args.batch).all()
+      if not rows:
+         break
+      last = rows[-1].id
+      values = [{'fid': row.id, 'bin': pack_hash(row.hash)} for row in rows]
+      values = [v for v in values if v['bin'] is not None]
+      if values:
+         db.execute(update, values)
+      db.commit()
+      converted += len(values)
+      log.info("Converted %d rows, up to id %d (%.0f rows/s)" % (converted, last, converted / max(time.time() - started, 0.001)))
+      if args.pause:
+         time.sleep(args.pause)
+   log.info("Done, %d rows converted" % converted)
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,132 @@
+#
+# The database models shared by simple.py, backend-queue.py and the
+# maintenance tools.
+#
+from sqlalchemy import Column, Integer, Sequence, String, func, ForeignKey, LargeBinary, BINARY, event
+from sqlalchemy.dialects.mysql import DATETIME, TIMESTAMP, TEXT, INTEGER
+from sqlalchemy.ext.declarative import declarative_base
+from datetime import datetime
+from sqlalchemy.orm import relationship
+from sqlalchemy_fulltext import FullText
+
+Base = declarative_base()
+
+class Expression(FullText, Base):
+    __tablename__ = 'expression'
+    __fulltext_columns__ = ('description', 'title', 'credit')
+    id = Column(INTEGER(unsigned=True, zerofill=True),
+                Sequence('expression_id_seq', start=1, increment=1),
+                primary_key = True)
+    title = Column(String(500))
+    description = Column(String(2048))
+    # 
+    # Allowed:  Any CC URI + defined by rightsstatements.org
+    #
+    rights_statement = Column(String(128))
+    credit = Column(String(500))
+    credit_url = Column(String(1024))
+    #
+    # http://wikimedia.org/
+    #
+    collection_url = Column(String(128))
+    #
+    # Catalog imports look expressions up by source_id, see ingest.py.
+    # Existing databases need the index added by hand:
+    #
+    # create index ix_expression_source_id on expression (source_id);
+    #
+    source_id = Column(String(256), index=True)
+    updated_date = Column(TIMESTAMP, default=datetime.utcnow,
+                          nullable=False, onupdate=datetime.utcnow)
+    manifestation = relationship('Manifestation', backref="expression")
+
+class Manifestation(Base):
+    __tablename__ = 'manifestation'
+    id = Column(INTEGER(unsigned=True, zerofill=True),
+                Sequence('manifestation_id_seq', start=1, increment=1),
+                primary_key = True)
+    url = Column(String(500))
+    # 
+    # media_type:  image/jpeg image/gif  image/png video/mpeg video/mp4
+    #              video/ogg  video/webm audio/ogg
+    #
+    media_type = Column(String(64))
+    expression_id = Column(INTEGER(unsigned=True, zerofill=True), 
+                     ForeignKey('expression.id'))
+    fingerprint = relationship('Fingerprint', backref="manifestation")
+
+class Fingerprint(Base):
+    __tablename__ = 'fingerprint'
+    id = Column(INTEGER(unsigned=True, zerofill=True),
+                Sequence('fingerprint_id_seq', start=1, increment=1),
+                primary_key = True)
+    #
+    #
+    type = Column(String(64))
+    hash = Column(String(256))
+    #
+    # The same 256-bit hash as raw bytes, decoded once when hash is set.
+    # NULL for rows that predate it, until migrate-fingerprints.py has
+    # converted them.
+    #
+    hash_bin = Column(BINARY(32))
+    updated_date = Column(TIMESTAMP, default=datetime.utcnow,
+                          nullable=False, onupdate=datetime.utcnow)
+    manifestation_id = Column(INTEGER(unsigned=True, zerofill=True), 
+                     ForeignKey('manifestation.id'))
+
+class Queue(Base):
+    __tablename__ = 'queue'
+    id = Column(INTEGER(unsigned=True, zerofill=True),
+               Sequence('queue_id_seq', start=1, increment=1),
+               primary_key = True)
+    #
+    # The SHA-256 digest of the uploaded file. Identical uploads share a
+    # job; existing databases need the constraint added by hand (after
+    # merging any duplicate jobs):
+    #
+    # create unique index ix_queue_queryhash on queue (queryhash);
+    #
+    queryhash = Column(String(256), unique=True, index=True)
+    requested_date = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
+    completed_date = Column(TIMESTAMP)
+    status = Column(INTEGER, default=0) # 0 = unprocessed, 1 = working, 2 = done, 3 = failed
+    # While status is 1, completed_date holds the time the job was claimed
+    # Comma separated addresses of everybody who uploaded the file
+    email = Column(String(256))
+    results = relationship('QueueResults', backref="queue")
+
+class QueueResults(Base):
+    __tablename__ = 'queue_results'
+    id = Column(INTEGER(unsigned=True, zerofill=True),
+               Sequence('queue_results_id_seq', start=1, increment=1),
+               primary_key = True)
+    qid = Column(INTEGER(unsigned=True, zerofill=True),
+                ForeignKey('queue.id'))
+    distance = Column(INTEGER)
+    expression_id = Column(INTEGER(unsigned=True, zerofill=True))
+
+#
+# Returns the 32 raw bytes of a 256-bit hexadecimal hash, or None if it
+# is not one.
+#
+def pack_hash(hash):
+    if not hash or len(hash) != 64:
+        return None
+    try:
+        return bytes.fromhex(hash)
+    except ValueError:
+        return None
+
+@event.listens_for(Fingerprint.hash, 'set')
+def fingerprint_hash_set(target, value, oldvalue, initiator):
+    target.hash_bin = pack_hash(value)
+
+#
+# SQL expression for the Hamming distance between hash and a fingerprint,
+# using the binary form where the row has one and the hex form (and the
+# slower HammingDistance UDF) otherwise. See sql.functions.
+#
+def hamming_distance(hash):
+    return func.coalesce(func.hammingdistancebin(pack_hash(hash), Fingerprint.hash_bin),
+                         func.hammingdistance(hash, Fingerprint.hash))
@@ -0,0 +1,136 @@
+#
+# Bounded caches for serialized API responses, with LRU eviction and a
+# time to live for every entry.
+#
+#   memory            one cache per worker process
+#   sqlite:///path    a sqlite file shared by all workers on a host, also
+#                     a stand-in for a shared cache in tests
+#   redis://host/db   shared by all workers everywhere (needs redis-py;
+#                     eviction is left to the server's maxmemory-policy)
+#
+# Keys are strings and values bytes. Callers make stale entries
+# unreachable by putting a generation into the key, rather than deleting
+# them; they are evicted like any other unused entry.
+#
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryCache(object):
+
+    def __init__(self, size=10000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SqliteCache(object):
+
+    def __init__(self, path, size=10000, ttl=300):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.local = threading.local()
+        self.sets = 0
+        self._db().execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL, used REAL)')
+        self._db().execute('CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')
+            self.local.db = db
+        return db
+
+    def get(self, key):
+        db = self._db()
+        now = time.time()
+        row = db.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            return None
+        db.execute('UPDATE cache SET used = ? WHERE key = ?', (now, key))
+        return bytes(row[0])
+
+    def set(self, key, value):
+        db = self._db()
+        now = time.time()
+        db.execute('INSERT OR REPLACE INTO cache (key, value, expires, used) VALUES (?, ?, ?, ?)',
+                   (key, value, now + self.ttl, now))
+        self.sets += 1
+        if self.sets % 100 == 0:
+            # Evict the least recently used entries beyond size
+            db.execute('DELETE FROM cache WHERE expires < ?', (now,))
+            db.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                       (self.size,))
+
+    def clear(self):
+        self._db().execute('DELETE FROM cache')
+
+
+class RedisCache(object):
+
+    def __init__(self, url, size=None, ttl=300):
+        if redis is None:
+            raise RuntimeError('redis-py is required for a redis cache')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value):
+        self.client.set(key, value, ex=self.ttl)
+
+    def clear(self):
+        self.client.flushdb()
+
+
+#
+# Returns the cache described by url (see above), or None if url is empty.
+#
+def open_cache(url, size=10000, ttl=300):
+    if not url:
+        return None
+    if url == 'memory':
+        return MemoryCache(size, ttl)
+    if url.startswith('sqlite:///'):
+        return SqliteCache(url[len('sqlite:///'):], size, ttl)
+    if url.startswith('redis://'):
+        return RedisCache(url, size, ttl)
+    raise ValueError('unknown cache %s' % url)
@@ -0,0 +1,59 @@
+#
+# Uniform random sampling of works in constant time, for /random.
+#
+# The ids of all works are kept in one array per class of works, loaded
+# by a function returning {class: iterable of ids}, and reloaded every
+# `interval` seconds (or never, if that is 0) by run() on a background
+# thread, so no request waits for a reload. Picking a work is then an index into an array instead of
+# sorting the tables by a random number. Works added since the last load
+# can't be picked yet, and removed ones may still be.
+#
+import logging
+import random
+import threading
+import time
+
+import numpy as np
+
+
+class RandomSampler(object):
+
+    def __init__(self, load, interval=300):
+        self.load = load
+        self.interval = interval
+        self.ids = None
+        self.loaded = 0
+        self.ready = threading.Event()
+
+    def refresh(self):
+        ids = dict((k, np.unique(np.fromiter(v, dtype=np.uint32)))
+                   for k, v in self.load().items())
+        self.ids = ids
+        self.loaded = time.time()
+
+    # Loads the ids, then reloads them every interval seconds, forever
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logging.exception('Loading the ids to sample from failed')
+            self.ready.set()
+            if self.interval <= 0:
+                return
+            time.sleep(self.interval)
+
+    # Until the first load has been tried, waits for it
+    def _current(self):
+        self.ready.wait()
+        return self.ids or {}
+
+    #
+    # Returns up to count distinct ids drawn uniformly from the class, in
+    # random order.
+    #
+    def sample(self, kind, count=1):
+        ids = self._current().get(kind)
+        if ids is None or not len(ids):
+            return []
+        return [int(ids[i]) for i in random.sample(range(len(ids)), min(count, len(ids)))]
@@ -1,27 +1,91 @@
 #! /usr/bin/python3
-from bottle import route, run, template, default_app, get, request, abort, response, redirect, post
+from bottle import route, run, template, default_app, get, request, abort, response, redirect, post, HTTPResponse
 from bottle.ext import sqlalchemy
-from sqlalchemy import create_engine, Column, Integer, Sequence, String, func, ForeignKey, LargeBinary
-from sqlalchemy.dialects.mysql import DATETIME, TIMESTAMP, TEXT, INTEGER
-from sqlalchemy.ext.declarative import declarative_base
-from datetime import datetime
-from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy_fulltext import FullText, FullTextSearch
-import random
-
-from json import dumps
-import string
+from sqlalchemy import create_engine, func
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy_fulltext import FullTextSearch
+import os
+import hashlib
+import tempfile
+import time
+import logging
+import threading
+
+import json
+from json import loads
+from urllib.parse import urlencode
 from bs4 import BeautifulSoup
 
+from models import Base, Expression, Manifestation, Fingerprint, Queue
+from fpmatrix import FingerprintMatrix
+from fpindex import FingerprintIndex, Segment, build_matrix, fingerprint_rows, UPDATED_FORMAT
+from hashers import hashers
+from lookup import find_hasher
+import lookup
+from resultcache import open_cache
+from sampler import RandomSampler
+from textindex import TextIndex, document
+import metrics
+from metrics import stage
+
 app = default_app()
 
 app.config.load_config('api.conf')
 app.config.setdefault('api.db', 'sqlite:///:memory:')
 app.config.setdefault('api.base', 'http://localhost:8080')
 app.config.setdefault('api.queuedir', '/tmp')
+app.config.setdefault('api.create_tables', 'yes')
+app.config.setdefault('api.search', 'index')
+app.config.setdefault('api.hmsearch_max', '32')
+app.config.setdefault('api.matrix', '')
+app.config.setdefault('api.batch_max', '5000')
+app.config.setdefault('api.page_max', '1000')
+app.config.setdefault('api.cache', '')
+app.config.setdefault('api.cache_size', '10000')
+app.config.setdefault('api.cache_ttl', '300')
+app.config.setdefault('api.cache_check', '5')
+app.config.setdefault('api.works_cache', 'memory')
+app.config.setdefault('api.refresh', '60')
+app.config.setdefault('api.refresh_overlap', '300')
+app.config.setdefault('api.rebase_at', '100000')
+app.config.setdefault('api.rebase', '86400')
+app.config.setdefault('api.lsh_tables', '0')
+app.config.setdefault('api.lsh_bits', '16')
+app.config.setdefault('api.lsh_probes', '1')
+app.config.setdefault('api.random_refresh', '300')
+app.config.setdefault('api.text', 'sql')
+app.config.setdefault('api.text_merge', '10000')
+app.config.setdefault('api.server', 'wsgiref')
+app.config.setdefault('api.threads', '16')
+app.config.setdefault('api.limit_lookup', '6')
+app.config.setdefault('api.limit_works', '6')
+app.config.setdefault('api.limit_other', '4')
+app.config.setdefault('api.busy_timeout', '10')
+app.config.setdefault('api.db_pool_size', '16')
+app.config.setdefault('api.db_pool_timeout', '10')
+app.config.setdefault('api.profile_slow', '0')
+app.config.setdefault('api.profile_interval', '0.005')
+
+# With server=asyncio requests run on up to threads threads at once, each
+# of which may hold a database connection
+engine_options = {}
+if not app.config['api.db'].startswith('sqlite'):
+    engine_options = dict(pool_size=int(app.config['api.db_pool_size']), max_overflow=0,
+                          pool_timeout=float(app.config['api.db_pool_timeout']), pool_pre_ping=True)
+engine = create_engine(app.config['api.db'], echo=False, **engine_options)
 
-Base = declarative_base()
-engine = create_engine(app.config['api.db'], echo=False)
+#
+# Every route is timed, and so are the stages of requests, see
+# metrics.py; /metrics has the numbers. With profile_slow, the stacks of
+# requests taking longer than that many seconds are logged.
+#
+metrics.instrument(engine)
+profiler = None
+if float(app.config['api.profile_slow']) > 0:
+    profiler = metrics.Profiler(float(app.config['api.profile_slow']), float(app.config['api.profile_interval']))
+app.install(metrics.MetricsPlugin(profiler))
 
 plugin = sqlalchemy.Plugin(
     engine,
@@ -32,111 +96,379 @@ plugin = sqlalchemy.Plugin(
 
 app.install(plugin)
 
-class Expression(FullText, Base):
-    __tablename__ = 'expression'
-    __fulltext_columns__ = ('description', 'title', 'credit')
-    id = Column(INTEGER(unsigned=True, zerofill=True),
-                Sequence('expression_id_seq', start=1, increment=1),
-                primary_key = True)
-    title = Column(String(500))
-    description = Column(String(2048))
-    # 
-    # Allowed:  Any CC URI + defined by rightsstatements.org
-    #
-    rights_statement = Column(String(128))
-    credit = Column(String(500))
-    credit_url = Column(String(1024))
-    #
-    # http://wikimedia.org/
-    #
-    collection_url = Column(String(128))
-    source_id = Column(String(256))
-    updated_date = Column(TIMESTAMP, default=datetime.utcnow,
-                          nullable=False, onupdate=datetime.utcnow)
-    manifestation = relationship('Manifestation', backref="expression")
-
-class Manifestation(Base):
-    __tablename__ = 'manifestation'
-    id = Column(INTEGER(unsigned=True, zerofill=True),
-                Sequence('manifestation_id_seq', start=1, increment=1),
-                primary_key = True)
-    url = Column(String(500))
-    # 
-    # media_type:  image/jpeg image/gif  image/png video/mpeg video/mp4
-    #              video/ogg  video/webm audio/ogg
-    #
-    media_type = Column(String(64))
-    expression_id = Column(INTEGER(unsigned=True, zerofill=True), 
-                     ForeignKey('expression.id'))
-    fingerprint = relationship('Fingerprint', backref="manifestation")
-
-class Fingerprint(Base):
-    __tablename__ = 'fingerprint'
-    id = Column(INTEGER(unsigned=True, zerofill=True),
-                Sequence('fingerprint_id_seq', start=1, increment=1),
-                primary_key = True)
-    #
-    #
-    type = Column(String(64))
-    hash = Column(String(256))
-    updated_date = Column(TIMESTAMP, default=datetime.utcnow,
-                          nullable=False, onupdate=datetime.utcnow)
-    manifestation_id = Column(INTEGER(unsigned=True, zerofill=True), 
-                     ForeignKey('manifestation.id'))
-
-class Queue(Base):
-    __tablename__ = 'queue'
-    id = Column(INTEGER(unsigned=True, zerofill=True),
-               Sequence('queue_id_seq', start=1, increment=1),
-               primary_key = True)
-    queryhash = Column(String(256))
-    requested_date = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
-    completed_date = Column(TIMESTAMP)
-    status = Column(INTEGER, default=0) # 0 = unprocessed, 1 = working, 2 = done
-    email = Column(String(256))
-    results = relationship('QueueResults', backref="queue")
-
-class QueueResults(Base):
-    __tablename__ = 'queue_results'
-    id = Column(INTEGER(unsigned=True, zerofill=True),
-               Sequence('queue_results_id_seq', start=1, increment=1),
-               primary_key = True)
-    qid = Column(INTEGER(unsigned=True, zerofill=True),
-                ForeignKey('queue.id'))
-    distance = Column(INTEGER)
-    expression_id = Column(INTEGER(unsigned=True, zerofill=True))
-
-Base.metadata.create_all(engine)
-
-hashers = {  
-             'http://videorooter.org/ns/blockhash': {
-                'command': '/home/api/algorithms/commonsmachinery-blockhash/build/blockhash',   
-                'types': ['image/png', 'image/jpg'],
-              },
-             'http://videorooter.org/ns/x-blockhash-video-cv': {
-                'command': '/home/api/algorithms/jonasob-blockhash-master/build/blockhash_video',
-                'types': ['video/mp4', 'video/mpeg', 'video/ogg', 'video/webm'],
-              },
-          }
+# Creating missing tables costs a round trip per table at every start,
+# set create_tables=no once the schema exists
+if app.config['api.create_tables'] != 'no':
+    Base.metadata.create_all(engine)
+
+#
+# Hamming distance searches are answered from in-process indexes over
+# all fingerprints: the multi-index in hmsearch.py for small distances,
+# and the brute force matrix scan in fpmatrix.py for distances of
+# hmsearch_max and above, where the multi-index has to probe too many
+# substring variants to pay off. Set search=sql to use the
+# HammingDistance UDF from sql.functions instead, which is only feasible
+# for small test databases.
+#
+# If matrix is set in api.conf, the matrix is memory-mapped from the
+# snapshot in that directory, so that workers start in seconds and all
+# workers on a host share it, and only the fingerprints changed since the
+# snapshot was taken are read from the database. The first worker to
+# start without one writes it; snapshot-index.py refreshes it. The
+# multi-index is built from the matrix in the background, meanwhile all
+# searches use the matrix.
+#
+# A background thread keeps the index current, see fpindex.py: every
+# refresh seconds it loads the fingerprints whose updated_date is newer
+# than the newest one it has seen. Since a transaction may commit rows
+# with an updated_date a little older than rows already committed, it
+# looks back refresh_overlap seconds and skips the rows it already has.
+# Fingerprints applied this way are searched by brute force, so once
+# there are rebase_at of them, and at least every rebase seconds, the
+# whole index is rebuilt from the database in the background and swapped
+# in, see FingerprintIndex.rebase(). Deleted fingerprints and
+# manifestations whose media type changes are only picked up then.
+# /index/status reports how far behind the index is.
+#
+def advance(updated, id=None):
+    if updated is not None and (index_state['updated'] is None or updated > index_state['updated']):
+        index_state['updated'] = updated
+    if id is not None and id > index_state['newest']:
+        index_state['newest'] = id
+
+def newest_id(matrix):
+    return int(matrix.ids.max()) if len(matrix) else None
+
+def load_snapshot(path):
+    try:
+        matrix = FingerprintMatrix.load(path)
+    except (IOError, ValueError) as e:
+        logging.warning('Not using index snapshot: %s' % e)
+        return None
+    if matrix.meta.get('updated'):
+        advance(datetime.strptime(matrix.meta['updated'], UPDATED_FORMAT))
+    advance(None, newest_id(matrix))
+    return matrix
+
+def load_index():
+    path = app.config['api.matrix']
+    matrix = None
+    if path and os.path.exists(path):
+        matrix = load_snapshot(path)
+    index = FingerprintIndex(Segment(matrix or FingerprintMatrix.from_rows([])))
+    if matrix is not None:
+        # Catch up with the changes since the snapshot
+        refresh_index(index)
+    else:
+        db = sessionmaker(bind=engine)()
+        matrix, updated = build_matrix(db)
+        db.close()
+        advance(updated, newest_id(matrix))
+        if path:
+            matrix.save(path, {'updated': updated.strftime(UPDATED_FORMAT) if updated else None},
+                        replace=os.path.exists(path))
+            matrix = FingerprintMatrix.load(path, verify=False)
+        index.replace_base(Segment(matrix))
+        index_state['refreshed'] = time.time()
+    threading.Thread(target=build_base, args=(index,), name='index-build', daemon=True).start()
+    return index
+
+# Adds the approximate search tables, if any, and the multi-index to the
+# first segment of index
+def build_base(index):
+    base = index.segments[0]
+    if int(app.config['api.lsh_tables']):
+        base = base.with_lsh(int(app.config['api.lsh_tables']), int(app.config['api.lsh_bits']), int(app.config['api.lsh_probes']))
+        index.replace_base(base)
+    index.replace_base(base.with_hmsearch(int(app.config['api.hmsearch_max'])))
+
+# Rebuilds the first segment of index from the database
+def rebase_index(index):
+    try:
+        absorbed = index.segments[1:]
+        db = sessionmaker(bind=engine)()
+        try:
+            matrix, updated = build_matrix(db)
+        finally:
+            db.close()
+        base = Segment(matrix)
+        if int(app.config['api.lsh_tables']):
+            base = base.with_lsh(int(app.config['api.lsh_tables']), int(app.config['api.lsh_bits']), int(app.config['api.lsh_probes']))
+        index.rebase(base.with_hmsearch(int(app.config['api.hmsearch_max'])), absorbed)
+        index_state['rebases'] += 1
+    except Exception:
+        logging.exception('Rebuilding the fingerprint index failed')
+    finally:
+        index_state['rebased'] = time.time()
+        index_state['rebasing'] = False
+
+def rebase_due(index):
+    if index_state['rebasing'] or index.segments[0].hmsearch is None:
+        return False
+    interval = float(app.config['api.rebase'])
+    return index.delta() >= int(app.config['api.rebase_at']) or (interval > 0 and time.time() - index_state['rebased'] > interval)
+
+#
+# Applies the fingerprints added or changed since the last refresh to
+# index. index_state['seen'] holds the ids and updated_dates of the rows
+# inside the overlap window that were applied already.
+#
+def refresh_index(index):
+    seen = index_state['seen']
+    started = time.time()
+    db = sessionmaker(bind=engine)()
+    try:
+        query = fingerprint_rows(db)
+        if index_state['updated'] is not None:
+            since = index_state['updated'] - timedelta(seconds=float(app.config['api.refresh_overlap']))
+            query = query.filter(Fingerprint.updated_date >= since)
+        rows = []
+        for row in query.order_by(Fingerprint.updated_date, Fingerprint.id):
+            if seen.get(row[0]) == row.updated_date:
+                continue
+            seen[row[0]] = row.updated_date
+            hash = row.hash_bin or row.hash
+            if hash:
+                rows.append((row[0], hash, row[3], row.media_type))
+            advance(row.updated_date, row[0])
+    finally:
+        db.close()
+    if rows:
+        index.apply(rows)
+    if index_state['updated'] is not None:
+        horizon = index_state['updated'] - timedelta(seconds=float(app.config['api.refresh_overlap']))
+        for id in [id for id, updated in seen.items() if updated is None or updated < horizon]:
+            del seen[id]
+    index_state['refreshed'] = started
+    index_state['applied'] += len(rows)
+
+def refresher():
+    while True:
+        time.sleep(float(app.config['api.refresh']))
+        try:
+            refresh_index(search_index)
+        except Exception:
+            logging.exception('Refreshing the fingerprint index failed')
+        if rebase_due(search_index):
+            index_state['rebasing'] = True
+            threading.Thread(target=rebase_index, args=(search_index,), name='index-rebase', daemon=True).start()
+
+search_index = None
+index_state = {'updated': None, 'newest': 0, 'refreshed': None, 'applied': 0, 'seen': {},
+               'rebased': time.time(), 'rebasing': False, 'rebases': 0}
+if app.config['api.search'] == 'index':
+    search_index = load_index()
+    if float(app.config['api.refresh']) > 0:
+        threading.Thread(target=refresher, name='index-refresh', daemon=True).start()
+
+# JSON serialization is timed as the json stage
+def dumps(obj):
+    with stage('json'):
+        return json.dumps(obj)
+
+#
+# Returns up to limit + 1 (distance, expression id, fingerprint id) tuples
+# for the fingerprints closer than distance to hash, ordered by distance
+# and expression id, and optionally limited to the given media types. If
+# after is given, only results ordered after that tuple are returned. The
+# one extra result tells the caller that there is another page.
+#
+def find_similar(db, hash, distance, types=None, limit=1000, after=None, recall=None):
+    try:
+        with stage('orm' if search_index is None else 'index'):
+            return lookup.find_similar(db, search_index, hash, distance, types, limit + 1, after, recall)
+    except ValueError:
+        abort(400, 'hash must be a 256-bit hexadecimal encoded value')
+
+#
+# The distance= of a lookup, at most maximum (also the default unless
+# default is given)
+#
+def query_distance(maximum, default=None):
+    if not request.query.distance:
+        return maximum if default is None else min(default, maximum)
+    try:
+        distance = int(request.query.distance)
+    except ValueError:
+        abort(400, 'distance must be an integer')
+    return min(distance, maximum)
+
+#
+# Lookups return pages of at most limit (and page_max) results. When there
+# are more, the response has a Link header with rel="next" pointing at the
+# next page, which continues after the cursor of the last result.
+#
+def paging():
+    limit = int(app.config['api.page_max'])
+    try:
+        if request.query.limit:
+            limit = max(1, min(limit, int(request.query.limit)))
+        after = None
+        if request.query.cursor:
+            after = tuple(int(v) for v in request.query.cursor.split('.'))
+            if len(after) != 3:
+                raise ValueError(request.query.cursor)
+    except ValueError:
+        abort(400, 'limit and cursor must be values given by a previous page')
+    return limit, after
+
+# Splits off the extra result from find_similar(), returns (page, cursor)
+def next_page(entity, limit):
+    if len(entity) <= limit:
+        return entity, None
+    entity = entity[:limit]
+    return entity, '%d.%d.%d' % entity[-1]
+
+def next_link(cursor):
+    params = [(k, v) for k, v in request.query.allitems() if k != 'cursor']
+    params.append(('cursor', cursor))
+    return '%s%s?%s' % (app.config['api.base'].rstrip('/'), request.path, urlencode(params))
+
+#
+# Serializes items as a JSON list piece by piece, so the response can be
+# streamed while it is written. The result is the same as dumps(items).
+# The time spent serializing is recorded once, at the end.
+#
+def stream_json(items):
+    yield '['
+    separator = ''
+    spent = 0.0
+    for item in items:
+        started = time.time()
+        piece = separator + json.dumps(item)
+        spent += time.time() - started
+        yield piece
+        separator = ', '
+    yield ']'
+    metrics.STAGE_SECONDS.observe(spent, stage='json')
+
+#
+# Lookup responses are kept in the cache given by cache= in api.conf, see
+# resultcache.py. Every key includes a generation, so entries become
+# unreachable as soon as the results may have changed. With search=index
+# that is the newest updated_date and the highest fingerprint id in the
+# index, which change when a refresh applies fingerprints to it and are
+# the same in every worker that has caught up, so workers share entries.
+# Otherwise the generation is read from the fingerprint and manifestation
+# tables, at most every cache_check seconds. Either way deletions only
+# show once the entries expire after cache_ttl seconds.
+# Fingerprint.updated_date should be indexed:
+#
+# create index fingerprint_updated_idx on fingerprint (updated_date);
+#
+result_cache = open_cache(app.config['api.cache'], int(app.config['api.cache_size']), int(app.config['api.cache_ttl']))
+cache_state = {'generation': None, 'checked': 0}
+
+def cache_generation(db):
+    if search_index is not None:
+        return 'index/%s/%s' % (index_state['updated'], index_state['newest'])
+    if time.time() - cache_state['checked'] > float(app.config['api.cache_check']):
+        fingerprints = db.query(func.max(Fingerprint.updated_date), func.max(Fingerprint.id)).one()
+        manifestation = db.query(func.max(Manifestation.id)).scalar()
+        cache_state['generation'] = '%s/%s/%s' % (fingerprints[0], fingerprints[1], manifestation)
+        cache_state['checked'] = time.time()
+    return cache_state['generation']
+
+#
+# Returns the response for key, from the cache or by calling compute(),
+# which returns the cursor of the next page (or None) and the JSON response
+# in pieces. Without a cache the pieces are streamed as they come.
+#
+def cached(db, key, compute):
+    response.content_type = 'application/json'
+    if result_cache is None:
+        cursor, body = compute()
+    else:
+        key = '%s|%s' % (cache_generation(db), '|'.join(str(k) for k in key))
+        value = result_cache.get(key)
+        if value is None:
+            cursor, body = compute()
+            body = ''.join(body).encode('utf-8')
+            result_cache.set(key, (cursor or '').encode('ascii') + b'\n' + body)
+        else:
+            cursor, body = value.split(b'\n', 1)
+            cursor = cursor.decode('ascii')
+    if cursor:
+        response.set_header('Link', '<%s>; rel="next"' % next_link(cursor))
+    return body
 
 #
 # These are videorooter specific API calls following
 #
+#
+# Copies an upload to the queue directory in chunks, without holding it
+# in memory, and stores it under the SHA-256 digest of its content, which
+# also serves as the process id. Returns the digest.
+#
+def save_upload(stream, length=None):
+    digest = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=app.config['api.queuedir'], prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while length is None or length > 0:
+                chunk = stream.read(65536 if length is None else min(65536, length))
+                if not chunk:
+                    break
+                if length is not None:
+                    length -= len(chunk)
+                digest.update(chunk)
+                f.write(chunk)
+        hash = digest.hexdigest()
+        path = "%s/%s" % (app.config['api.queuedir'], hash)
+        if os.path.exists(path):
+            os.remove(tmp)
+        else:
+            os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return hash
+
 @post('/videorooter/video')
 def videorooter_video(db):
     # Takes two arguments: email - (option) email of the user requesting
     #                      file - binary data with file
-    email = request.forms.get('email')
-    file = request.files.get('file') 
-    hash = "%032x" % random.getrandbits(128)
-    if (not file):
-      abort(400, 'file is a required parameter')
-
-    obj = Queue(queryhash = hash, email = email)
-    db.add(obj)
-    db.commit()
+    # Instead of a multipart form, the file can also be sent as the raw
+    # request body with email in the query string, which is streamed
+    # straight to disk.
+    #
+    # Identical files get the same process id, so uploading a file that
+    # has been seen before returns its existing (or pending) results
+    # instead of hashing it again. The email is added to the job's,
+    # unless the column is full, in which case it is dropped. A job that
+    # failed is queued again, in case that was a passing problem.
+    if request.content_type.startswith('multipart/'):
+        email = request.forms.get('email')
+        file = request.files.get('file')
+        if (not file):
+          abort(400, 'file is a required parameter')
+        hash = save_upload(file.file)
+    else:
+        email = request.query.email
+        if (not request.content_length):
+          abort(400, 'file is a required parameter')
+        hash = save_upload(request.environ['wsgi.input'], request.content_length)
+
+    job = db.query(Queue).filter_by(queryhash=hash).first()
+    if job is None:
+        try:
+            db.add(Queue(queryhash = hash, email = email))
+            db.commit()
+        except IntegrityError:
+            # The same file was uploaded at the same time
+            db.rollback()
+            job = db.query(Queue).filter_by(queryhash=hash).first()
+    if job is not None and job.status == 3:
+        db.query(Queue).filter(Queue.id == job.id, Queue.status == 3).update({ Queue.status: 0,
+                  Queue.requested_date: datetime.utcnow(), Queue.completed_date: None }, synchronize_session=False)
+        db.commit()
+    if job is not None and email:
+        emails = [e for e in (job.email or '').split(',') if e]
+        if email not in emails and len(','.join(emails + [email])) <= Queue.email.type.length:
+            job.email = ','.join(emails + [email])
+            db.commit()
 
-    file.save("%s/%s" % (app.config['api.queuedir'], hash))
     response.content_type = 'application/json'
     s = { "process_id": hash }
     return dumps(s)
@@ -148,6 +480,8 @@ def videorooter_results(id, db):
        abort(404, 'Sorry. Invalid process number')
     if entity.status < 2:
        abort(202, 'Your search is being processed. Check back later for the results.')
+    if entity.status == 3:
+       abort(422, 'Sorry. Your file could not be processed.')
     d = []
     for row in entity.results:
        d.append({'href': "%s/works/%s" % (app.config['api.base'], row.expression_id),
@@ -174,23 +508,93 @@ def lookup_blockhash(db):
     if len(hash) != 64:
         abort(400, 'hash must be a 256-bit hexadecimal encoded value')
 
-    distance = 10   # Maximum value
-    if (request.query.distance and int(request.query.distance) <= distance):
-        distance = int(request.query.distance)
+    distance = query_distance(10)
 
-    entity = db.query(Expression, Manifestation, Fingerprint, func.hammingdistance(hash, Fingerprint.hash).label('distance')).filter(func.hammingdistance(hash, Fingerprint.hash) < distance, Manifestation.media_type.in_(hashers['http://videorooter.org/ns/blockhash']['types']), Manifestation.id == Fingerprint.manifestation_id, Expression.id == Manifestation.expression_id ).limit(1000).all()
-    d = []
-    for row in entity:
-       d.append({'href': "%s/works/%s" % (app.config['api.base'], row.Expression.id),
-                 'distance': row.distance})
+    limit, after = paging()
+    types = hashers['http://videorooter.org/ns/blockhash']['types']
+    def compute():
+        entity, cursor = next_page(find_similar(db, hash, distance, types, limit, after), limit)
+        d = ({'href': "%s/works/%s" % (app.config['api.base'], row[1]),
+              'distance': row[0]} for row in entity)
+        return cursor, stream_json(d)
 
-    response.content_type = 'application/json'
-    return dumps(d)
+    return cached(db, ('/lookup/blockhash', hash.lower(), distance, ','.join(types), limit, request.query.cursor), compute)
+
+#
+# With text=index, text lookups are answered from the in-process BM25
+# index in textindex.py, built from the expression table in the
+# background at startup. Until it is ready they go to the database. A
+# thread keeps it current the same way as the fingerprint index: every
+# refresh seconds it loads the expressions whose updated_date is newer
+# than the newest one it has seen, looking back refresh_overlap seconds.
+#
+def text_rows(db, since=None):
+    query = db.query(Expression.id, Expression.title, Expression.description, Expression.credit, Expression.updated_date)
+    if since is not None:
+        query = query.filter(Expression.updated_date >= since)
+    return query
+
+def load_text_index():
+    db = sessionmaker(bind=engine)()
+    try:
+        documents = {}
+        for row in text_rows(db).yield_per(10000):
+            documents[row.id] = document(row.title, row.description, row.credit)
+            if text_state['updated'] is None or row.updated_date > text_state['updated']:
+                text_state['updated'] = row.updated_date
+    finally:
+        db.close()
+    return TextIndex(documents, int(app.config['api.text_merge']))
+
+def refresh_text_index(index):
+    seen = text_state['seen']
+    overlap = timedelta(seconds=float(app.config['api.refresh_overlap']))
+    since = text_state['updated'] - overlap if text_state['updated'] is not None else None
+    db = sessionmaker(bind=engine)()
+    try:
+        rows = {}
+        for row in text_rows(db, since):
+            if seen.get(row.id) == row.updated_date:
+                continue
+            seen[row.id] = row.updated_date
+            rows[row.id] = (row.title, row.description, row.credit)
+            if text_state['updated'] is None or row.updated_date > text_state['updated']:
+                text_state['updated'] = row.updated_date
+    finally:
+        db.close()
+    if rows:
+        index.apply(rows)
+    if text_state['updated'] is not None:
+        horizon = text_state['updated'] - overlap
+        for id in [id for id, updated in seen.items() if updated < horizon]:
+            del seen[id]
+
+def text_indexer():
+    global text_index
+    try:
+        index = load_text_index()
+    except Exception:
+        logging.exception('Building the text index failed')
+        return
+    text_index = index
+    while float(app.config['api.refresh']) > 0:
+        time.sleep(float(app.config['api.refresh']))
+        try:
+            refresh_text_index(text_index)
+        except Exception:
+            logging.exception('Refreshing the text index failed')
+
+text_index = None
+text_state = {'updated': None, 'seen': {}}
+if app.config['api.text'] == 'index':
+    threading.Thread(target=text_indexer, name='text-index', daemon=True).start()
 
 #
-# Does a lookup of text across the fields title, description and credit
+# Does a lookup of text across the fields title, description and credit,
+# returning at most 1000 works. From the text index they come best match
+# first, with their score.
 # 
-# NB: This requires a full text index:
+# NB: Without text=index, this requires a full text index:
 # create fulltext index fulltext_idx on expression (title, description, credit);
 #
 @get('/lookup/text')
@@ -198,10 +602,17 @@ def lookup_text(db):
     q = request.query.q
     if not q:
        abort(400, 'q is a required parameter')
-    entity = db.query(Expression).filter(FullTextSearch(q, Expression)).limit(1000).all()
     d = []
-    for row in entity:
-       d.append({'href': "%s/works/%s" % (app.config['api.base'], row.id) })
+    if text_index is not None:
+       with stage('index'):
+          found = text_index.search(q, 1000)
+       for score, id in found:
+          d.append({'href': "%s/works/%s" % (app.config['api.base'], id), 'score': round(score, 4)})
+    else:
+       with stage('orm'):
+          entity = db.query(Expression.id).filter(FullTextSearch(q, Expression)).limit(1000).all()
+       for row in entity:
+          d.append({'href': "%s/works/%s" % (app.config['api.base'], row.id) })
 
     response.content_type = 'application/json'
     return dumps(d)
@@ -216,15 +627,92 @@ def lookup_blockhash(db):
     if len(hash) != 64:
         abort(400, 'hash must be a 256-bit hexadecimal encoded value')
 
-    distance = 40   # Maximum value
-    if (request.query.distance and int(request.query.distance) <= distance):
-        distance = int(request.query.distance)
+    distance = query_distance(40)
 
-    entity = db.query(Expression, Manifestation, Fingerprint, func.hammingdistance(hash, Fingerprint.hash).label('distance')).filter(func.hammingdistance(hash, Fingerprint.hash) < distance, Manifestation.media_type.in_(hashers['http://videorooter.org/ns/x-blockhash-video-cv']['types']), Manifestation.id == Fingerprint.manifestation_id, Expression.id == Manifestation.expression_id ).limit(1000).all()
-    d = []
-    for row in entity:
-       d.append({'href': "%s/works/%s" % (app.config['api.base'], row.Expression.id),
-                 'distance': row.distance})
+    #
+    # mode=approx&recall=0.9 trades completeness for speed on large
+    # indexes, see lsh.py: about recall of the matches are found. Without
+    # lsh_tables in api.conf the search is exact anyway.
+    #
+    recall = None
+    if request.query.mode == 'approx':
+        try:
+            recall = float(request.query.recall or 0.9)
+        except ValueError:
+            recall = 0
+        if not 0 < recall <= 1:
+            abort(400, 'recall must be a number between 0 and 1')
+    elif request.query.mode not in ('', 'exact'):
+        abort(400, 'mode must be exact or approx')
+
+    limit, after = paging()
+    types = hashers['http://videorooter.org/ns/x-blockhash-video-cv']['types']
+    def compute():
+        entity, cursor = next_page(find_similar(db, hash, distance, types, limit, after, recall), limit)
+        d = ({'href': "%s/works/%s" % (app.config['api.base'], row[1]),
+              'distance': row[0]} for row in entity)
+        return cursor, stream_json(d)
+
+    return cached(db, ('/lookup/video', hash.lower(), distance, ','.join(types), limit, request.query.cursor, recall), compute)
+
+#
+# Looks up many hashes in one request. Takes a JSON list of up to
+# batch_max entries like
+#
+#   [{"hash": "...", "method": "http://videorooter.org/ns/blockhash", "distance": 5}, ...]
+#
+# where method is a key of hashers (or its last path segment, and defaults
+# to blockhash) selecting the media types to search, and distance is
+# capped at the hasher's maximum. Returns an object mapping each input
+# position to the same list /lookup/blockhash would return for it. Entries
+# the multi-index covers are looked up in it, the others are answered from
+# a single pass over the fingerprint matrix.
+#
+@post('/lookup/batch')
+def lookup_batch(db):
+    try:
+        entries = loads(request.body.read().decode('utf-8'))
+    except ValueError:
+        abort(400, 'body must be a JSON list of lookups')
+    if not isinstance(entries, list):
+        abort(400, 'body must be a JSON list of lookups')
+    if len(entries) > int(app.config['api.batch_max']):
+        abort(413, 'at most %s lookups per batch' % app.config['api.batch_max'])
+
+    hashes = []
+    distances = []
+    types = []
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get('hash'):
+            abort(400, 'hash is a required parameter (entry %d)' % i)
+        if not isinstance(entry['hash'], str) or len(entry['hash']) != 64:
+            abort(400, 'hash must be a 256-bit hexadecimal encoded value (entry %d)' % i)
+        method = entry.get('method') or 'blockhash'
+        hasher = find_hasher(method) if isinstance(method, str) else None
+        if not hasher:
+            abort(400, 'unknown method (entry %d)' % i)
+        distance = hasher['distance']
+        if entry.get('distance') is not None:
+            if not isinstance(entry['distance'], int) or isinstance(entry['distance'], bool):
+                abort(400, 'distance must be an integer (entry %d)' % i)
+            distance = min(distance, entry['distance'])
+        hashes.append(entry['hash'])
+        distances.append(distance)
+        types.append(hasher['types'])
+
+    if search_index is not None:
+        try:
+            with stage('index'):
+                found = search_index.search_batch(hashes, distances, types)
+        except ValueError:
+            abort(400, 'hash must be a 256-bit hexadecimal encoded value')
+    else:
+        found = [find_similar(db, *args) for args in zip(hashes, distances, types)]
+
+    d = {}
+    for i, entity in enumerate(found):
+        d[str(i)] = [{'href': "%s/works/%s" % (app.config['api.base'], row[1]),
+                      'distance': row[0]} for row in entity[:1000]]
 
     response.content_type = 'application/json'
     return dumps(d)
@@ -248,12 +736,63 @@ def lookup_uri(db):
     response.content_type = 'application/json'
     return dumps([])
 
-# Elog.io
-@get('/works/<id>/media')
-def get_works_media(id, db):
-    entity = db.query(Expression,Manifestation).filter_by(Expression.id==id,Manifestation.expression_id == id).first()
-    if entity:
-       d = { 'id': entity.id,
+#
+# Work documents are rendered once per version of the expression and kept
+# in the cache given by works_cache= (see resultcache.py), keyed by
+# Expression.updated_date, so edits to the expression invalidate them.
+# Both /works/<id> and /works/<id>/media are rendered at the same time and
+# served from the cache. The same version also makes the ETag, so clients
+# can revalidate with If-None-Match without getting the body again.
+#
+def render_work(entity):
+    d = { 'id': entity.Expression.id,
+          'href': "%s/works/%s" % (app.config['api.base'], entity.Expression.id),
+          'public': 'true',
+          'added_at': '2015-02-21T11:11:12.685Z',
+          'description': entity.Expression.description,
+          'owner': { 'org': { 'id': 1, 'href': 'http://example.com'}}
+        }
+
+    d['media'] = []
+    d['media'].append({ 'id': entity.Expression.id,
+                        'href': "%s/works/%s/media" % (app.config['api.base'], entity.Expression.id) })
+    d['annotations'] = []
+    d['annotations'].append({
+        'propertyName': 'title',
+        'language': 'en',
+        'titleLabel': entity.Expression.title })
+
+    d['annotations'].append({
+        'propertyName': 'identifier',
+        'identifierLink': entity.Expression.source_id })
+    d['annotations'].append({
+        'propertyName': 'locator',
+        'locatorLink': entity.Manifestation.url })
+    d['annotations'].append({
+        'propertName': 'policy',
+        'statementLink': entity.Expression.rights_statement,
+        'typeLabel': 'license',
+        'typeLink': 'http://www.w3.org/1999/xhtml/vocab#license' })
+    d['annotations'].append({
+        'propertyName': 'collection',
+        'collectionLink': entity.Expression.collection_url })
+
+    # Process artist through Soup, since it often contain HTML code
+    credit = entity.Expression.credit
+    if credit:
+        with stage('soup'):
+            credit = BeautifulSoup(credit).get_text()
+
+    d['annotations'].append({
+        'propertyName': 'creator',
+        'creatorLabel': credit })
+    d['annotations'].append({
+        'propertyName': 'copyright',
+        'holderLabel': credit })
+    return d
+
+def render_media(entity):
+    return { 'id': entity.Expression.id,
              'href': "%s/works/%s/media" % (app.config['api.base'], entity.Expression.id),
              'annotations' : [
                 {
@@ -264,60 +803,57 @@ def get_works_media(id, db):
                 }
              ]
            }
-       return d 
-    about(404, 'media not found')
+
+works_cache = open_cache(app.config['api.works_cache'], int(app.config['api.cache_size']), int(app.config['api.cache_ttl']))
+
+#
+# Returns the serialized document of the given kind ('works' or 'media')
+# for expression id, or a 304 response if the client has it already.
+#
+def work_document(db, id, kind):
+    try:
+        id = int(id)
+    except ValueError:
+        abort(404, 'id not found')
+    with stage('orm'):
+        updated = db.query(Expression.updated_date).filter(Expression.id==id).scalar()
+    if updated is None:
+        abort(404, 'id not found')
+    version = ''.join(c for c in str(updated) if c.isdigit())
+    etag = '"%d-%s"' % (id, version)
+    matches = [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]
+    if etag in matches or 'W/' + etag in matches or '*' in matches:
+        return HTTPResponse(status=304, ETag=etag)
+
+    key = '%s|%d|%s' % (kind, id, version)
+    body = works_cache.get(key) if works_cache is not None else None
+    if body is None:
+        with stage('orm'):
+            entity = db.query(Expression, Manifestation).filter(Expression.id==id, Manifestation.expression_id==id).first()
+        if not entity:
+            abort(404, 'id not found')
+        work = dumps(render_work(entity)).encode('utf-8')
+        media = dumps(render_media(entity)).encode('utf-8')
+        if works_cache is not None:
+            works_cache.set('works|%d|%s' % (id, version), work)
+            works_cache.set('media|%d|%s' % (id, version), media)
+        body = work if kind == 'works' else media
+
+    response.content_type = 'application/json'
+    response.set_header('ETag', etag)
+    return body
+
+# Elog.io
+@get('/works/<id>/media')
+def get_works_media(id, db):
+    return work_document(db, id, 'media')
 
 # Elog.io
 # Clients could select which information to return, we ignore
 # this and return everything we know.
 @get('/works/<id>')
 def get_works(id, db):
-    entity = db.query(Expression, Manifestation).filter(Expression.id==id, Manifestation.expression_id==id).first()
-    if entity:
-        d = { 'id': entity.Expression.id,
-              'href': "%s/works/%s" % (app.config['api.base'], entity.Expression.id),
-              'public': 'true',
-              'added_at': '2015-02-21T11:11:12.685Z',
-              'description': entity.Expression.description,
-              'owner': { 'org': { 'id': 1, 'href': 'http://example.com'}}
-            }
-
-        d['media'] = []
-        d['media'].append({ 'id': entity.Expression.id,
-                            'href': "%s/works/%s/media" % (app.config['api.base'], entity.Expression.id) })
-        d['annotations'] = []
-        d['annotations'].append({
-            'propertyName': 'title',
-            'language': 'en',
-            'titleLabel': entity.Expression.title })
-
-        d['annotations'].append({
-            'propertyName': 'identifier',
-            'identifierLink': entity.Expression.source_id })
-        d['annotations'].append({
-            'propertyName': 'locator',
-            'locatorLink': entity.Manifestation.url })
-        d['annotations'].append({
-            'propertName': 'policy',
-            'statementLink': entity.Expression.rights_statement,
-            'typeLabel': 'license',
-            'typeLink': 'http://www.w3.org/1999/xhtml/vocab#license' })
-        d['annotations'].append({
-            'propertyName': 'collection',
-            'collectionLink': entity.Expression.collection_url })
-
-        # Process artist through Soup, since it often contain HTML code
-        soup = BeautifulSoup(entity.Expression.credit)
-
-        d['annotations'].append({
-            'propertyName': 'creator',
-            'creatorLabel': soup.get_text() })
-        d['annotations'].append({
-            'propertyName': 'copyright',
-            'holderLabel': soup.get_text() })
-        
-        return d
-    abort(404, 'id not found')
+    return work_document(db, id, 'works')
 
 
 @get('/lookup/hash')
@@ -328,33 +864,108 @@ def lookup_blockhash(db):
     if len(hash) != 64:
         abort(400, 'hash must be a 256-bit hexadecimal encoded value')
 
-    method = request.query.method or 'blockhash'
-    distance = request.query.distance or 10
+    # method selects the media types searched, see find_hasher()
+    hasher = find_hasher(request.query.method or 'blockhash')
+    if not hasher:
+        abort(400, 'unknown method')
+    distance = query_distance(hasher['distance'], 10)
     #
-    # We should implement a flexible limit / pager here, for now a hard
-    # limit of 1000 should be enough.
+    # Results are paged, see paging()
     #
-    entity = db.query(Expression,Fingerprint,Manifestation).filter(func.hammingdistance(hash, Fingerprint.hash) < distance, Manifestation.id == Fingerprint.manifestation_id, Expression.id == Manifestation.expression_id).limit(1000).all()
+    limit, after = paging()
+    entity, cursor = next_page(find_similar(db, hash, distance, hasher['types'], limit, after), limit)
     if not entity:
         abort(404, 'no works found')
-    d = []
-    for row in entity:
-       d.append({'id': row.Expression.id, 'title': row.Expression.title})
+    with stage('orm'):
+        titles = lookup.titles(db, (row[1] for row in entity))
+    d = ({'id': row[1], 'title': titles.get(row[1])} for row in entity)
+    if cursor:
+        response.set_header('Link', '<%s>; rel="next"' % next_link(cursor))
     response.content_type = 'application/json'
-    return dumps(d)
+    return stream_json(d)
+
+#
+# Picks a random work from all works, or with type=image or type=video
+# only from works with a fingerprint of that kind, and redirects to it.
+# With count=N, returns up to N distinct random works instead. The ids
+# are sampled from arrays reloaded every random_refresh seconds, see
+# sampler.py.
+#
+random_types = {'image': hashers['http://videorooter.org/ns/blockhash']['types'],
+                'video': hashers['http://videorooter.org/ns/x-blockhash-video-cv']['types']}
+
+def random_ids():
+    db = sessionmaker(bind=engine)()
+    try:
+        ids = dict((k, []) for k in [''] + list(random_types))
+        for expression_id, media_type in db.query(Expression.id, Manifestation.media_type).filter(Expression.id == Manifestation.expression_id, Manifestation.id == Fingerprint.manifestation_id).distinct().yield_per(10000):
+            ids[''].append(expression_id)
+            for k, types in random_types.items():
+                if media_type in types:
+                    ids[k].append(expression_id)
+        return ids
+    finally:
+        db.close()
+
+random_sampler = RandomSampler(random_ids, float(app.config['api.random_refresh']))
+threading.Thread(target=random_sampler.run, name='random-refresh', daemon=True).start()
 
 @get('/random')
 def randomwork(db):
     type = request.query.type
-    entity = db.query(Expression,Manifestation,Fingerprint).order_by(func.rand()).filter(Expression.id==Manifestation.expression_id,Manifestation.id==Fingerprint.manifestation_id)
-    if type == "video":
-        entity = entity.filter(Manifestation.media_type.in_(hashers['http://videorooter.org/ns/x-blockhash-video-cv']['types']))
-    if type == "image":
-        entity = entity.filter(Manifestation.media_type.in_(hashers['http://videorooter.org/ns/blockhash']['types']))
-    entity = entity.first()
-    if not entity:
-        abort(404, 'no works found -- not a one!')
-    redirect('/works/%s' % entity.Expression.id)
+    if type not in random_types:
+        type = ''
+    if not request.query.count:
+        ids = random_sampler.sample(type)
+        if not ids:
+            abort(404, 'no works found -- not a one!')
+        redirect('/works/%s' % ids[0])
+
+    try:
+        count = int(request.query.count)
+    except ValueError:
+        abort(400, 'count must be a number')
+    if not 0 < count <= int(app.config['api.page_max']):
+        abort(400, 'count must be between 1 and %s' % app.config['api.page_max'])
+    d = [{'href': "%s/works/%s" % (app.config['api.base'], id)} for id in random_sampler.sample(type, count)]
+    response.content_type = 'application/json'
+    return dumps(d)
+
+#
+# How current the in-process index is: updated is the newest
+# Fingerprint.updated_date it has, lag the number of seconds since the
+# last refresh started (rows committed before then are searchable).
+#
+@get('/index/status')
+def index_status():
+    if search_index is None:
+        abort(404, 'search=%s does not use an index' % app.config['api.search'])
+    d = {'entries': len(search_index),
+         'segments': len(search_index.segments),
+         'hmsearch': search_index.segments[0].hmsearch is not None,
+         'lsh': search_index.segments[0].lsh is not None,
+         'updated': index_state['updated'].isoformat() if index_state['updated'] else None,
+         'applied': index_state['applied'],
+         'delta': search_index.delta(),
+         'rebases': index_state['rebases'],
+         'lag': round(time.time() - index_state['refreshed'], 3)}
+    response.content_type = 'application/json'
+    return dumps(d)
 
-run(host='0.0.0.0', port=8080)
+@get('/metrics')
+def metrics_endpoint():
+    response.content_type = metrics.CONTENT_TYPE
+    return metrics.REGISTRY.render()
+
+if __name__ == '__main__':
+    if app.config['api.server'] == 'asyncio':
+        from aioserve import AsyncioServer
+        run(server=AsyncioServer, host='0.0.0.0', port=8080,
+            threads=int(app.config['api.threads']),
+            limits={'lookup': int(app.config['api.limit_lookup']),
+                    'works': int(app.config['api.limit_works']),
+                    'other': int(app.config['api.limit_other'])},
+            busy_timeout=float(app.config['api.busy_timeout']))
+    else:
+        run(host='0.0.0.0', port=8080)
 
@@ -0,0 +1,44 @@
+#! /usr/bin/python3
+#
+# Writes a fresh snapshot of the fingerprint index to the matrix directory
+# in api.conf, replacing the one there. Workers started afterwards map the
+# new snapshot and have less to catch up with from the database; running
+# workers keep the one they have. Run it from cron, e.g. nightly.
+#
+from bottle import default_app
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import argparse
+import logging
+import time
+
+from fpindex import build_matrix, UPDATED_FORMAT
+
+app = default_app()
+
+app.config.load_config('api.conf')
+app.config.setdefault('api.db', 'sqlite:///:memory:')
+app.config.setdefault('api.matrix', '')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)8s  %(message)s')
+log = logging.getLogger('snapshot')
+
+def main():
+   parser = argparse.ArgumentParser(description='Write a snapshot of the fingerprint index')
+   parser.add_argument('--path', default=app.config['api.matrix'],
+                       help='snapshot directory (default: matrix from api.conf)')
+   args = parser.parse_args()
+   if not args.path:
+      parser.error('no snapshot directory, set matrix in api.conf or give --path')
+
+   engine = create_engine(app.config['api.db'], echo=False)
+   db = sessionmaker(bind=engine)()
+   started = time.time()
+   matrix, updated = build_matrix(db)
+   db.close()
+   matrix.save(args.path, {'updated': updated.strftime(UPDATED_FORMAT) if updated else None}, replace=True)
+   log.info("Wrote %d fingerprints up to %s to %s in %.1fs" % (len(matrix), updated, args.path, time.time() - started))
+
+if __name__ == '__main__':
+   main()
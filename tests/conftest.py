@@ -0,0 +1,200 @@
+#
+# Shared by the tests: clustered random hashes, and a sqlite database of
+# fingerprints with the hamming distance functions of sql.functions
+# defined in Python, so that the SQL path of lookup.find_similar() can be
+# compared with the in-process search.
+#
+# api is simple.py started on a database of its own and queue is
+# backend-queue.py on the same one; call() sends requests to them.
+#
+import importlib.util
+import io
+import os
+import random
+import time
+from wsgiref.util import setup_testing_defaults
+
+import bottle
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+from fpindex import build_matrix
+from models import Base, Expression, Manifestation, Fingerprint, pack_hash
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TYPES = ['image/png', 'image/jpeg', 'video/mp4', 'video/webm']
+
+
+def hammingdistance(a, b):
+    if a is None or b is None:
+        return None
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+def hammingdistancebin(a, b):
+    if a is None or b is None:
+        return None
+    return bin(int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).count('1')
+
+
+def flip(value, bits, rng):
+    for p in rng.sample(range(256), bits):
+        value ^= 1 << p
+    return value
+
+
+# Clusters of hashes within about 70 bits of each other
+def make_hashes(n, seed=1):
+    rng = random.Random(seed)
+    centres = [rng.getrandbits(256) for i in range(20)]
+    return ['%064x' % flip(rng.choice(centres), rng.randint(0, 35), rng) for i in range(n)]
+
+
+# Registers the hamming distance functions on every connection of engine
+def add_functions(engine):
+    @event.listens_for(engine, 'connect')
+    def connect(conn, record):
+        conn.create_function('hammingdistance', 2, hammingdistance)
+        conn.create_function('hammingdistancebin', 2, hammingdistancebin)
+
+
+# Creates the tables of models without the MySQL full text index
+def create_tables(conn, models):
+    for model in models:
+        conn.execute(CreateTable(model.__table__))
+        for index in model.__table__.indexes:
+            conn.execute(CreateIndex(index))
+
+
+@pytest.fixture(scope='session')
+def db():
+    engine = create_engine('sqlite://')
+    add_functions(engine)
+    with engine.begin() as conn:
+        create_tables(conn, (Expression, Manifestation, Fingerprint))
+        rng = random.Random(2)
+        for i, hash in enumerate(make_hashes(600), 1):
+            conn.execute(Expression.__table__.insert(), {'id': i, 'title': 'Work %d' % i})
+            # A few manifestations belong to no expression at all
+            expression_id = None if i % 50 == 0 else i
+            conn.execute(Manifestation.__table__.insert(),
+                         {'id': i, 'expression_id': expression_id, 'media_type': rng.choice(TYPES)})
+            # Every fifth row predates hash_bin
+            hash_bin = None if i % 5 == 0 else pack_hash(hash)
+            conn.execute(Fingerprint.__table__.insert(),
+                         {'id': i, 'hash': hash, 'hash_bin': hash_bin, 'manifestation_id': i})
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+@pytest.fixture(scope='session')
+def matrix(db):
+    return build_matrix(db)[0]
+
+
+# Three hashes of fingerprints in db and two from elsewhere
+def queries():
+    return make_hashes(5, seed=1)[:3] + make_hashes(2, seed=3)
+
+
+#
+# Works 1 to 120 with one fingerprint each, images for odd ids and videos
+# for even ones, and a fingerprinted manifestation of no work at all.
+#
+API_HASHES = make_hashes(120, seed=11)
+
+
+def fill_api_db(conn):
+    create_tables(conn, [mapper.class_ for mapper in Base.registry.mappers])
+    for i, hash in enumerate(API_HASHES, 1):
+        conn.execute(Expression.__table__.insert(), {'id': i, 'title': 'Work %d' % i,
+                                                     'credit': '<a href="http://x/">Artist %d</a>' % i})
+        conn.execute(Manifestation.__table__.insert(), {'id': i, 'expression_id': i, 'url': 'http://x/%d' % i,
+                                                        'media_type': 'image/png' if i % 2 else 'video/mp4'})
+        conn.execute(Fingerprint.__table__.insert(), {'id': i, 'hash': hash, 'hash_bin': pack_hash(hash),
+                                                      'manifestation_id': i})
+    conn.execute(Manifestation.__table__.insert(), {'id': 500, 'expression_id': None, 'media_type': 'image/png'})
+    conn.execute(Fingerprint.__table__.insert(), {'id': 500, 'hash': API_HASHES[0],
+                                                  'hash_bin': pack_hash(API_HASHES[0]), 'manifestation_id': 500})
+
+
+@pytest.fixture(scope='session')
+def api_dir(tmp_path_factory):
+    path = tmp_path_factory.mktemp('api')
+    os.mkdir(str(path / 'queue'))
+    engine = create_engine('sqlite:///%s' % (path / 'api.db'))
+    with engine.begin() as conn:
+        fill_api_db(conn)
+    engine.dispose()
+    with open(str(path / 'api.conf'), 'w') as f:
+        f.write('[api]\n'
+                'db = sqlite:///%s\n'
+                'queuedir = %s\n'
+                'create_tables = no\n'
+                'refresh = 0\n'
+                'random_refresh = 0\n'
+                'page_max = 50\n' % (path / 'api.db', path / 'queue'))
+    return path
+
+
+# Runs the script at path as a module, with the api.conf in directory and
+# a default bottle app of its own
+def load_script(name, path, directory):
+    cwd = os.getcwd()
+    os.chdir(str(directory))
+    bottle.app.push()
+    try:
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        bottle.app.pop()
+        os.chdir(cwd)
+    add_functions(module.engine)
+    module.engine.dispose()
+    return module
+
+
+@pytest.fixture(scope='session')
+def api(api_dir):
+    api = load_script('simple', os.path.join(ROOT, 'simple.py'), api_dir)
+    # Wait for the multi-index, so that small distances are searched with it
+    deadline = time.time() + 30
+    while api.search_index.segments[0].hmsearch is None and time.time() < deadline:
+        time.sleep(0.01)
+    return api
+
+
+@pytest.fixture(scope='session')
+def queue(api_dir):
+    return load_script('backend_queue', os.path.join(ROOT, 'backend-queue.py'), api_dir)
+
+
+#
+# Sends a request to a WSGI app, returns the status code, the headers and
+# the body.
+#
+def call(app, path, method='GET', body=b'', headers=None):
+    path, _, query = path.partition('?')
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query,
+               'wsgi.input': io.BytesIO(body), 'CONTENT_LENGTH': str(len(body))}
+    for name, value in (headers or {}).items():
+        name = name.upper().replace('-', '_')
+        environ[name if name == 'CONTENT_TYPE' else 'HTTP_' + name] = value
+    setup_testing_defaults(environ)
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    chunks = app(environ, start_response)
+    try:
+        body = b''.join(c if isinstance(c, bytes) else c.encode('utf-8') for c in chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return int(started[0].split()[0]), dict(started[1]), body
@@ -0,0 +1,145 @@
+#
+# The asyncio front end of aioserve.py, serving the API of conftest.py and
+# small apps of its own over real connections.
+#
+import asyncio
+import contextlib
+import http.client
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from aioserve import endpoint_class, serve
+
+from conftest import API_HASHES, call
+
+
+# Runs serve() on a free port in a thread of its own, yields the port
+@contextlib.contextmanager
+def server(app, **options):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(serve(app, '127.0.0.1', port, **options))
+
+    def run():
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        # Connections still open are closed too
+        pending = asyncio.all_tasks(loop)
+        for t in pending:
+            t.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    try:
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except ConnectionRefusedError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.01)
+        yield port
+    finally:
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join()
+
+
+def request(port, path, method='GET', body=None, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        conn.close()
+
+
+def test_responses_match_wsgi(api):
+    paths = ['/lookup/video?hash=%s&distance=40' % API_HASHES[35], '/works/7', '/works/7/media',
+             '/lookup/blockhash?hash=%s' % ('0' * 63), '/works/9999']
+    with server(api.app) as port:
+        # One connection for all of them
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        for path in paths:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            body = response.read()
+            status, headers, expected = call(api.app, path)
+            # Error pages name the server they came from
+            assert response.status == status and (status != 200 or body == expected)
+        conn.close()
+
+        body = json.dumps([{'hash': hash} for hash in API_HASHES[:5]]).encode()
+        status, headers, out = request(port, '/lookup/batch', 'POST', body, {'Content-Type': 'application/json'})
+        assert (status, out) == call(api.app, '/lookup/batch', 'POST', body, {'Content-Type': 'application/json'})[::2]
+
+        status, headers, out = request(port, '/works/7', 'HEAD')
+        assert status == 200 and out == b''
+
+
+def test_streamed_responses_are_chunked():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return (b'%d\n' % i for i in range(50000))
+
+    with server(app) as port:
+        status, headers, body = request(port, '/')
+        assert headers['Transfer-Encoding'] == 'chunked'
+        assert body == b''.join(b'%d\n' % i for i in range(50000))
+
+        # HTTP/1.0 clients get the body up to the end of the connection
+        with socket.create_connection(('127.0.0.1', port)) as s:
+            s.sendall(b'GET / HTTP/1.0\r\n\r\n')
+            data = b''
+            while True:
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        head, _, body = data.partition(b'\r\n\r\n')
+        assert b'Connection: close' in head and body == b''.join(b'%d\n' % i for i in range(50000))
+
+
+def test_classes_are_limited():
+    release = threading.Event()
+
+    def app(environ, start_response):
+        if environ['PATH_INFO'].startswith('/lookup/slow'):
+            release.wait(10)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ['PATH_INFO'].encode()]
+
+    with server(app, threads=4, limits={'lookup': 1}, busy_timeout=0.2) as port:
+        slow = []
+        thread = threading.Thread(target=lambda: slow.append(request(port, '/lookup/slow')))
+        thread.start()
+        time.sleep(0.1)
+        # The lookup class is full, the others are not
+        status, headers, body = request(port, '/lookup/fast')
+        assert status == 503 and headers['Retry-After'] == '1'
+        assert request(port, '/works/1')[::2] == (200, b'/works/1')
+        release.set()
+        thread.join()
+        assert slow[0][::2] == (200, b'/lookup/slow')
+        assert request(port, '/lookup/fast')[::2] == (200, b'/lookup/fast')
+
+
+def test_endpoint_classes():
+    assert endpoint_class('/lookup/batch') == 'lookup'
+    assert endpoint_class('/works/1/media') == 'works'
+    assert endpoint_class('/random') == 'other'
+    with pytest.raises(ValueError):
+        asyncio.run(serve(None, '127.0.0.1', 0, threads=2, limits={'lookup': 2}))
@@ -0,0 +1,238 @@
+#
+# The HTTP endpoints of simple.py, on the database of conftest.py.
+#
+import hashlib
+import json
+from datetime import datetime
+
+from sqlalchemy.orm import sessionmaker
+
+from conftest import API_HASHES, call
+from fpindex import fingerprint_rows
+from models import Expression, Fingerprint, Queue
+
+
+def test_random(api):
+    status, headers, body = call(api.app, '/random')
+    assert status in (302, 303)
+    assert 1 <= int(headers['Location'].rsplit('/', 1)[1]) <= 120
+
+    status, headers, body = call(api.app, '/random?type=image&count=50')
+    ids = [int(d['href'].rsplit('/', 1)[1]) for d in json.loads(body)]
+    assert len(set(ids)) == 50 and all(id % 2 for id in ids)
+    status, headers, body = call(api.app, '/random?type=video&count=50')
+    assert all(int(d['href'].rsplit('/', 1)[1]) % 2 == 0 for d in json.loads(body))
+
+    assert call(api.app, '/random?count=0')[0] == 400
+    assert call(api.app, '/random?count=51')[0] == 400
+    assert call(api.app, '/random?count=x')[0] == 400
+
+
+def upload(api, body, email=None):
+    path = '/videorooter/video' + ('?email=%s' % email if email else '')
+    status, headers, out = call(api.app, path, 'POST', body, {'Content-Type': 'application/octet-stream'})
+    assert status == 200
+    return json.loads(out)['process_id']
+
+
+def multipart(body, email):
+    boundary = 'xyzzy'
+    return (('--%s\r\nContent-Disposition: form-data; name="email"\r\n\r\n%s\r\n'
+             '--%s\r\nContent-Disposition: form-data; name="file"; filename="a.png"\r\n'
+             'Content-Type: image/png\r\n\r\n' % (boundary, email, boundary)).encode() +
+            body + ('\r\n--%s--\r\n' % boundary).encode(),
+            'multipart/form-data; boundary=%s' % boundary)
+
+
+def test_uploads_are_deduplicated(api, api_dir):
+    body = b'\x89PNG' + bytes(range(256)) * 1000
+    id = upload(api, body, 'a@example.com')
+    assert id == hashlib.sha256(body).hexdigest()
+    assert open(str(api_dir / 'queue' / id), 'rb').read() == body
+    assert upload(api, body, 'b@example.com') == id
+    form, content_type = multipart(body, 'c@example.com')
+    status, headers, out = call(api.app, '/videorooter/video', 'POST', form, {'Content-Type': content_type})
+    assert json.loads(out)['process_id'] == id
+    assert upload(api, body, 'a@example.com') == id
+
+    db = sessionmaker(bind=api.engine)()
+    jobs = db.query(Queue).filter_by(queryhash=id).all()
+    assert len(jobs) == 1 and jobs[0].status == 0
+    assert jobs[0].email == 'a@example.com,b@example.com,c@example.com'
+    db.close()
+    assert call(api.app, '/videorooter/results/%s' % id)[0] == 202
+    assert call(api.app, '/videorooter/results/nosuchjob')[0] == 404
+    assert call(api.app, '/videorooter/video', 'POST', b'', {'Content-Type': 'application/octet-stream'})[0] == 400
+
+
+def test_failed_uploads_are_retried(api):
+    body = b'not really a picture'
+    id = upload(api, body)
+    db = sessionmaker(bind=api.engine)()
+    db.query(Queue).filter_by(queryhash=id).update({Queue.status: 3, Queue.completed_date: datetime.utcnow()})
+    db.commit()
+    assert call(api.app, '/videorooter/results/%s' % id)[0] == 422
+
+    assert upload(api, body) == id
+    job = db.query(Queue).filter_by(queryhash=id).one()
+    assert job.status == 0 and job.completed_date is None
+    db.close()
+    assert call(api.app, '/videorooter/results/%s' % id)[0] == 202
+
+
+def test_cache_generation_is_shared(api):
+    db = sessionmaker(bind=api.engine)()
+
+    def expected():
+        rows = fingerprint_rows(db).all()
+        return 'index/%s/%s' % (max(row.updated_date for row in rows), max(row[0] for row in rows))
+
+    generation = api.cache_generation(db)
+    assert generation == expected()
+    # Workers that refreshed and rebuilt a different number of times agree
+    api.refresh_index(api.search_index)
+    api.index_state['applied'] += 5
+    api.index_state['rebases'] += 1
+    assert api.cache_generation(db) == generation
+
+    db.execute(Fingerprint.__table__.insert(), {'id': 121, 'type': 'test', 'hash': '%064x' % (1 << 200),
+                                                 'hash_bin': (1 << 200).to_bytes(32, 'big'), 'manifestation_id': 2})
+    db.commit()
+    api.refresh_index(api.search_index)
+    assert api.cache_generation(db) != generation
+    assert api.cache_generation(db) == expected()
+    db.close()
+
+
+def test_malformed_hashes(api):
+    hash = '0x' + API_HASHES[0][2:]
+    # Through the multi-index and through the matrix
+    for path in ('/lookup/blockhash?hash=%s&distance=5', '/lookup/video?hash=%s&distance=40',
+                 '/lookup/hash?hash=%s'):
+        assert call(api.app, path % hash)[0] == 400
+        assert call(api.app, path % API_HASHES[0].upper())[0] in (200, 404)
+
+
+def batch(api, entries):
+    status, headers, body = call(api.app, '/lookup/batch', 'POST', json.dumps(entries).encode(),
+                                 {'Content-Type': 'application/json'})
+    return status, json.loads(body) if status == 200 else None
+
+
+def test_batch_matches_sql(api, monkeypatch):
+    # The images through the multi-index, the videos through the matrix
+    entries = ([{'hash': hash} for hash in API_HASHES[:20]] +
+               [{'hash': hash, 'method': 'x-blockhash-video-cv', 'distance': 35} for hash in API_HASHES[:20]] +
+               [{'hash': API_HASHES[1], 'method': 'http://videorooter.org/ns/blockhash', 'distance': 99}])
+    status, found = batch(api, entries)
+    assert status == 200 and len(found) == len(entries)
+    assert sum(len(v) for v in found.values()) > len(entries)
+    monkeypatch.setattr(api, 'search_index', None)
+    assert batch(api, entries) == (200, found)
+
+
+def test_batch_errors(api):
+    assert batch(api, {'hash': API_HASHES[0]})[0] == 400
+    assert batch(api, [{'hash': API_HASHES[0]}, {}])[0] == 400
+    assert batch(api, [{'hash': 'ab'}])[0] == 400
+    assert batch(api, [{'hash': '0x' + API_HASHES[0][2:]}])[0] == 400
+    assert batch(api, [{'hash': API_HASHES[0], 'method': 'nosuchmethod'}])[0] == 400
+    assert batch(api, [{'hash': API_HASHES[0], 'distance': '5'}])[0] == 400
+    assert batch(api, [{'hash': API_HASHES[0]}] * (int(api.app.config['api.batch_max']) + 1))[0] == 413
+    assert batch(api, []) == (200, {})
+
+
+def test_works_revalidate(api):
+    status, headers, body = call(api.app, '/works/5')
+    assert status == 200
+    work = json.loads(body)
+    assert work['id'] == 5 and {'propertyName': 'creator', 'creatorLabel': 'Artist 5'} in work['annotations']
+    etag = headers['Etag']
+    status, headers, body = call(api.app, '/works/5/media')
+    assert status == 200 and headers['Etag'] == etag
+    assert json.loads(body)['annotations'][0]['property']['locatorLink'] == 'http://x/5'
+
+    for path in ('/works/5', '/works/5/media'):
+        status, headers, body = call(api.app, path, headers={'If-None-Match': 'W/"other", ' + etag})
+        assert status == 304 and body == b'' and headers['Etag'] == etag
+        assert call(api.app, path, headers={'If-None-Match': '"other"'})[0] == 200
+
+    # An edit makes a new version
+    db = sessionmaker(bind=api.engine)()
+    db.query(Expression).filter_by(id=5).update({Expression.title: 'Edited',
+                                                 Expression.updated_date: datetime(2030, 1, 1)})
+    db.commit()
+    db.close()
+    status, headers, body = call(api.app, '/works/5', headers={'If-None-Match': etag})
+    assert status == 200 and headers['Etag'] != etag
+    assert {'propertyName': 'title', 'language': 'en', 'titleLabel': 'Edited'} in json.loads(body)['annotations']
+
+    assert call(api.app, '/works/9999')[0] == 404
+    assert call(api.app, '/works/x/media')[0] == 404
+
+
+# All pages of a lookup with limit results each, by following the Link headers
+def pages(api, path, limit):
+    path = '%s&limit=%d' % (path, limit)
+    found = []
+    while path:
+        status, headers, body = call(api.app, path)
+        assert status == 200
+        page = json.loads(body)
+        assert 0 < len(page) <= limit
+        found.append(page)
+        link = headers.get('Link')
+        path = link[len('<' + api.app.config['api.base'].rstrip('/')):link.index('>')] if link else None
+    return found
+
+
+def test_lookups_page(api, monkeypatch):
+    # Work 36 has the most videos near it
+    hash = API_HASHES[35]
+    for path in ('/lookup/video?hash=%s&distance=40' % hash,
+                 '/lookup/hash?hash=%s&method=x-blockhash-video-cv&distance=40' % hash):
+        everything = pages(api, path, 50)
+        assert len(everything) == 1 and len(everything[0]) > 5
+        found = pages(api, path, 2)
+        assert len(found) > 2 and sum(found, []) == everything[0]
+
+    # The order is by distance, then expression id
+    results = [(d['distance'], int(d['href'].rsplit('/', 1)[1]))
+               for d in pages(api, '/lookup/video?hash=%s&distance=40' % hash, 50)[0]]
+    assert results == sorted(results)
+
+    for query in ('limit=x', 'cursor=1.2', 'cursor=a.b.c', 'cursor=1.2.3.4'):
+        assert call(api.app, '/lookup/video?hash=%s&%s' % (hash, query))[0] == 400
+    # limit is capped at page_max
+    monkeypatch.setitem(api.app.config, 'api.page_max', '3')
+    status, headers, body = call(api.app, '/lookup/video?hash=%s&distance=40&limit=1000' % hash)
+    assert len(json.loads(body)) == 3 and 'cursor=' in headers['Link']
+
+
+def test_distances_are_clamped(api):
+    hash = API_HASHES[35]
+    for path in ('/lookup/blockhash?hash=%s', '/lookup/video?hash=%s', '/lookup/hash?hash=%s'):
+        assert call(api.app, (path + '&distance=x') % hash)[0] == 400
+        assert call(api.app, (path + '&distance=1.5') % hash)[0] == 400
+    # At most the maximum of the method
+    assert (call(api.app, '/lookup/video?hash=%s&distance=100000' % hash)[2] ==
+            call(api.app, '/lookup/video?hash=%s&distance=40' % hash)[2] !=
+            call(api.app, '/lookup/video?hash=%s&distance=20' % hash)[2])
+    path = '/lookup/hash?hash=%s&method=x-blockhash-video-cv&distance=%d'
+    assert call(api.app, path % (hash, 100000))[2] == call(api.app, path % (hash, 40))[2]
+
+
+def test_index_matches_sql(api, monkeypatch):
+    paths = []
+    for hash in API_HASHES[:40:3] + [API_HASHES[35]]:
+        paths += ['/lookup/blockhash?hash=%s' % hash, '/lookup/video?hash=%s&distance=40' % hash,
+                  '/lookup/hash?hash=%s&method=x-blockhash-video-cv&distance=40' % hash,
+                  '/lookup/video?hash=%s&distance=40&limit=2' % hash]
+    found = [call(api.app, path) for path in paths]
+    assert sum(1 for status, headers, body in found if status == 200) > len(paths) / 2
+    monkeypatch.setattr(api, 'search_index', None)
+    assert [call(api.app, path) for path in paths] == found
+
+    # Fingerprint 500 has the same hash as work 1, but no work
+    results = json.loads(call(api.app, '/lookup/blockhash?hash=%s&distance=1' % API_HASHES[0])[2])
+    assert results == [{'href': '%s/works/1' % api.app.config['api.base'], 'distance': 0}]
@@ -0,0 +1,107 @@
+#
+# The segments of fpindex.py: lookups through the index against the SQL
+# path, and newer versions of fingerprints hiding older ones through
+# apply(), merges and rebase().
+#
+import random
+
+import lookup
+from fpindex import FingerprintIndex, Segment
+from fpmatrix import FingerprintMatrix
+
+from conftest import TYPES, make_hashes, queries
+
+
+def test_index_pages_like_sql(db, matrix):
+    index = FingerprintIndex(Segment(matrix).with_hmsearch(64))
+    hash = queries()[0]
+    for radius in (45, 70):
+        expected = lookup.find_similar(db, None, hash, radius, TYPES[1:], limit=7)
+        assert len(expected) == 7
+        assert lookup.find_similar(db, index, hash, radius, TYPES[1:], limit=7) == expected
+        after = expected[-1]
+        assert (lookup.find_similar(db, index, hash, radius, TYPES[1:], limit=7, after=after) ==
+                lookup.find_similar(db, None, hash, radius, TYPES[1:], limit=7, after=after))
+
+
+# The expected results for rows, where later rows replace earlier ones
+def brute_force(rows, hash, maximum):
+    latest = dict((row[0], row) for row in rows)
+    return FingerprintMatrix.from_rows(sorted(latest.values())).search(hash, maximum)
+
+
+def test_segments_hide_older_versions():
+    hashes = make_hashes(200, seed=4)
+    rows = [(i, hash, i, 'image/png') for i, hash in enumerate(hashes)]
+    index = FingerprintIndex(Segment(FingerprintMatrix.from_rows(rows)).with_hmsearch(32))
+    query = hashes[0]
+    assert index.search(query, 1) == [(0, 0, 0)]
+
+    # Fingerprint 0 moves away and fingerprint 7 takes its place
+    moved = '%064x' % (int(query, 16) ^ ((1 << 40) - 1))
+    changes = [(0, moved, 0, 'image/png'), (7, query, 7, 'image/png')]
+    index.apply(changes)
+    assert index.search(query, 1) == [(0, 7, 7)]
+    assert index.search(query, 41) == brute_force(rows + changes, query, 41)
+    assert index.search_batch([query, moved], [1, 1]) == [[(0, 7, 7)], [(0, 0, 0)]]
+    assert len(index.segments) == 2 and index.delta() == 2
+
+    # An empty update doesn't add a segment
+    index.apply([])
+    assert len(index.segments) == 2
+
+
+def test_segments_merge():
+    hashes = make_hashes(300, seed=5)
+    rows = [(i, hash, i, 'image/png') for i, hash in enumerate(hashes[:100])]
+    index = FingerprintIndex(Segment(FingerprintMatrix.from_rows(rows)), max_segments=3)
+    rng = random.Random(6)
+    for n in range(20):
+        # Some new fingerprints, some replaced ones
+        changes = [(id, rng.choice(hashes), n, 'image/png') for id in rng.sample(range(150), 5)]
+        index.apply(changes)
+        rows += changes
+        assert len(index.segments) <= 3
+        for hash in hashes[:5]:
+            assert index.search(hash, 50) == brute_force(rows, hash, 50)
+
+
+def test_rebase_keeps_later_segments():
+    hashes = make_hashes(100, seed=7)
+    rows = [(i, hash, i, 'image/png') for i, hash in enumerate(hashes[:50])]
+    index = FingerprintIndex(Segment(FingerprintMatrix.from_rows(rows)))
+    index.apply([(60, hashes[60], 60, 'image/png')])
+
+    # A rebuild starts: the database has fingerprint 60, and 3 is deleted
+    absorbed = index.segments[1:]
+    rebuilt = [row for row in rows if row[0] != 3] + [(60, hashes[60], 60, 'image/png')]
+    # and fingerprint 61 arrives while it runs
+    index.apply([(61, hashes[61], 61, 'image/png')])
+    index.rebase(Segment(FingerprintMatrix.from_rows(rebuilt)), absorbed)
+
+    assert len(index.segments) == 2 and index.delta() == 1
+    assert index.search(hashes[3], 1) == []
+    assert index.search(hashes[60], 1) == [(0, 60, 60)]
+    assert index.search(hashes[61], 1) == [(0, 61, 61)]
+
+
+def test_search_batch_uses_the_multi_index(matrix):
+    index = FingerprintIndex(Segment(matrix).with_hmsearch(32))
+    index.apply([(10000 + i, hash, i, 'image/png') for i, hash in enumerate(make_hashes(50, seed=8))])
+    scanned = []
+    search_batch = matrix.search_batch
+
+    def record(hashes, maxima, types=None):
+        scanned.extend(maxima)
+        return search_batch(hashes, maxima, types)
+
+    hashes = queries()[:4] * 2
+    maxima = [10, 32, 33, 64] * 2
+    types = [None] * 4 + [TYPES[:2]] * 4
+    matrix.search_batch = record
+    try:
+        found = index.search_batch(hashes, maxima, types)
+    finally:
+        del matrix.search_batch
+    assert found == [index.search(*args) for args in zip(hashes, maxima, types)]
+    assert sorted(scanned) == [33, 33, 64, 64]
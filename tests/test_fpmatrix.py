@@ -0,0 +1,95 @@
+#
+# The vectorized scan of fpmatrix.py against the SQL path of
+# lookup.find_similar() (see conftest.py), and its snapshots.
+#
+import os
+
+import numpy as np
+import pytest
+
+import lookup
+from fpmatrix import FingerprintMatrix
+
+from conftest import make_hashes, queries
+
+# Radii on both sides of a block of 64 bits
+RADII = [1, 2, 16, 17, 33, 63, 64, 65, 90]
+
+
+def test_matrix_skips_orphans(db, matrix):
+    assert len(matrix) == 600 - 600 // 50
+    assert 50 not in matrix.ids.tolist()
+
+
+@pytest.mark.parametrize('radius', RADII)
+def test_matrix_matches_sql(db, matrix, radius):
+    expected = [lookup.find_similar(db, None, hash, radius) for hash in queries()]
+    assert [matrix.search(hash, radius) for hash in queries()] == expected
+    assert matrix.search_batch(queries(), [radius] * len(queries())) == expected
+    typed = [lookup.find_similar(db, None, hash, radius, ['video/mp4']) for hash in queries()]
+    assert [matrix.search(hash, radius, ['video/mp4']) for hash in queries()] == typed
+
+
+def test_from_rows_skips_malformed_hashes():
+    hash = make_hashes(1)[0]
+    matrix = FingerprintMatrix.from_rows([(1, hash, 1, 'image/png'), (2, 'xyz', 2, 'image/png'),
+                                          (3, hash[:10], 3, 'image/png'), (4, None, 4, 'image/png'),
+                                          (5, bytes.fromhex(hash), 5, 'video/mp4')])
+    assert matrix.ids.tolist() == [1, 5]
+    assert [row[1] for row in matrix.rows()] == [bytes.fromhex(hash)] * 2
+
+
+def test_media_types_do_not_wrap():
+    hashes = make_hashes(300)
+    matrix = FingerprintMatrix.from_rows((i, hash, i, 'type/%d' % i) for i, hash in enumerate(hashes))
+    assert matrix.search(hashes[299], 1, ['type/299']) == [(0, 299, 299)]
+    assert matrix.search(hashes[299], 1, ['type/43']) == []
+
+
+def test_snapshot_round_trip(matrix, tmp_path):
+    path = str(tmp_path / 'snapshot')
+    matrix.save(path, {'updated': 'then'})
+    loaded = FingerprintMatrix.load(path)
+    assert isinstance(loaded.hashes, np.memmap)
+    assert loaded.meta['updated'] == 'then' and loaded.meta['rows'] == len(matrix)
+    assert list(loaded.rows()) == list(matrix.rows())
+    for hash in queries():
+        assert loaded.search(hash, 40, ['image/png']) == matrix.search(hash, 40, ['image/png'])
+
+    # An existing snapshot is only replaced when asked to
+    small = FingerprintMatrix.from_rows(list(matrix.rows())[:10])
+    small.save(path)
+    assert len(FingerprintMatrix.load(path)) == len(matrix)
+    small.save(path, replace=True)
+    assert len(FingerprintMatrix.load(path, mmap=False)) == 10
+    assert sorted(os.listdir(str(tmp_path))) == ['snapshot']
+
+
+def test_snapshot_rejects_corruption(matrix, tmp_path):
+    path = str(tmp_path / 'snapshot')
+    matrix.save(path)
+    ids = os.path.join(path, 'ids.npy')
+    with open(ids, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 1]))
+    with pytest.raises(ValueError, match='corrupt'):
+        FingerprintMatrix.load(path)
+    # Trusting the snapshot skips the checksum
+    assert len(FingerprintMatrix.load(path, verify=False)) == len(matrix)
+
+    os.remove(os.path.join(path, 'snapshot.json'))
+    with pytest.raises(ValueError, match='not a complete snapshot'):
+        FingerprintMatrix.load(path)
+
+
+def test_snapshot_rejects_other_versions(matrix, tmp_path):
+    path = str(tmp_path / 'snapshot')
+    matrix.save(path, {'version': 0})
+    # The version written is always the current one
+    assert FingerprintMatrix.load(path).meta['version'] != 0
+    with open(os.path.join(path, 'snapshot.json'), 'w') as f:
+        f.write('{"version": 0, "rows": %d, "checksum": 0}' % len(matrix))
+    with pytest.raises(ValueError, match='version 0'):
+        FingerprintMatrix.load(path)
@@ -0,0 +1,134 @@
+#
+# The NumPy port of blockhash against the blockhash command, and the
+# timeouts of the hasher backends.
+#
+# The command is the one in the hashers registry, or $BLOCKHASH_COMMAND;
+# the comparison is skipped where neither exists. reference_blockhash() is
+# a line by line transcription of bmvbhash() in blockhash.c, so that the
+# vectorized port is checked against the algorithm everywhere.
+#
+import math
+import os
+import time
+
+import numpy as np
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+
+import hashers
+from hashers import blockhash, blockhash_file, PoolBackend, PythonBackend, hash_files
+
+BLOCKHASH = 'http://videorooter.org/ns/blockhash'
+COMMAND = os.environ.get('BLOCKHASH_COMMAND', hashers.hashers[BLOCKHASH]['command'])
+
+
+def reference_blockhash(im, bits=16):
+    im = im.convert('RGBA')
+    width, height = im.size
+    data = [tuple(p) for p in np.asarray(im).reshape(-1, 4).tolist()]
+    even_x = width % bits == 0
+    even_y = height % bits == 0
+    block_width = float(width) / bits
+    block_height = float(height) / bits
+    blocks = [[0.0] * bits for i in range(bits)]
+
+    def split(i, block_size, even, size):
+        if even:
+            block = int(math.floor(i / block_size))
+            return block, block, 1.0, 0.0
+        frac, whole = math.modf(math.fmod(i + 1, block_size))
+        if whole > 0 or i + 1 == size:
+            first = second = int(math.floor(i / block_size))
+        else:
+            first = int(math.floor(i / block_size))
+            second = int(math.ceil(i / block_size))
+        return first, second, 1 - frac, frac
+
+    for y in range(height):
+        top, bottom, weight_top, weight_bottom = split(y, block_height, even_y, height)
+        for x in range(width):
+            left, right, weight_left, weight_right = split(x, block_width, even_x, width)
+            r, g, b, a = data[y * width + x]
+            value = 765 if a == 0 else r + g + b
+            blocks[top][left] += value * weight_top * weight_left
+            blocks[top][right] += value * weight_top * weight_right
+            blocks[bottom][left] += value * weight_bottom * weight_left
+            blocks[bottom][right] += value * weight_bottom * weight_right
+
+    flat = [v for row in blocks for v in row]
+    half_block_value = block_width * block_height * 256 * 3 / 2
+    bandsize = len(flat) // 4
+    result = []
+    for i in range(4):
+        band = flat[i * bandsize:(i + 1) * bandsize]
+        ordered = sorted(band)
+        m = (ordered[bandsize // 2 - 1] + ordered[bandsize // 2]) / 2
+        result.extend(v > m or (abs(v - m) < 1 and m > half_block_value) for v in band)
+    return ''.join('%x' % int(''.join('1' if b else '0' for b in result[i:i + 4]), 2)
+                   for i in range(0, len(result), 4))
+
+
+def sample_images():
+    random = np.random.RandomState(1)
+    yield 'noise', Image.fromarray((random.rand(48, 64, 3) * 255).astype('uint8'))
+    yield 'odd', Image.fromarray((random.rand(37, 53, 3) * 255).astype('uint8'))
+    yield 'tall', Image.fromarray((random.rand(101, 9, 3) * 255).astype('uint8'))
+    gradient = np.tile(np.linspace(0, 255, 70), (45, 1)).astype('uint8')
+    yield 'grey', Image.fromarray(gradient, 'L')
+    rgba = (random.rand(40, 40, 4) * 255).astype('uint8')
+    rgba[:20, :, 3] = 0
+    yield 'transparent', Image.fromarray(rgba, 'RGBA')
+    yield 'flat', Image.new('RGB', (32, 32), (200, 10, 10))
+
+
+@pytest.mark.parametrize('name,im', list(sample_images()))
+def test_blockhash_matches_reference(name, im):
+    assert blockhash(im) == reference_blockhash(im)
+
+
+@pytest.mark.skipif(not os.access(COMMAND, os.X_OK), reason='blockhash command not installed')
+@pytest.mark.parametrize('name,im', list(sample_images()))
+def test_blockhash_matches_command(name, im, tmp_path, monkeypatch):
+    path = str(tmp_path / ('%s.png' % name))
+    im.save(path)
+    monkeypatch.setitem(hashers.hashers[BLOCKHASH], 'command', COMMAND)
+    assert blockhash_file(path) == hashers.run_command(BLOCKHASH, path)
+
+
+@pytest.fixture
+def files(tmp_path):
+    image = str(tmp_path / 'image.png')
+    Image.new('RGB', (32, 32), (0, 100, 200)).save(image)
+    # Opening a FIFO blocks until somebody writes to it, like a hung hasher
+    fifo = str(tmp_path / 'fifo.png')
+    os.mkfifo(fifo)
+    return image, fifo
+
+
+def test_pool_kills_workers_that_time_out(files):
+    image, fifo = files
+    pool = PoolBackend(1)
+    try:
+        started = time.time()
+        with pytest.raises(TimeoutError):
+            pool.hash(BLOCKHASH, fifo, 0.5)
+        assert time.time() - started < 5
+        # The only worker was replaced, so the pool still works
+        assert pool.hash(BLOCKHASH, image, 10) == blockhash_file(image)
+        found = hash_files(pool, [(BLOCKHASH, fifo), (BLOCKHASH, image)], 2, 0.5)
+        assert found == {(BLOCKHASH, fifo): None, (BLOCKHASH, image): blockhash_file(image)}
+    finally:
+        pool.close()
+
+
+def test_python_backend_times_out(files):
+    image, fifo = files
+    started = time.time()
+    with pytest.raises(TimeoutError):
+        PythonBackend().hash(BLOCKHASH, fifo, 0.5)
+    assert time.time() - started < 5
+    assert PythonBackend().hash(BLOCKHASH, image, 10) == blockhash_file(image)
+    # Let go of the thread still waiting for the FIFO
+    with open(fifo, 'wb'):
+        pass
@@ -0,0 +1,44 @@
+#
+# The multi-index of hmsearch.py against the SQL path of
+# lookup.find_similar(), see conftest.py.
+#
+import pytest
+
+import lookup
+from fpmatrix import FingerprintMatrix
+from hmsearch import HmSearch
+
+from conftest import TYPES, queries
+
+# Around the radii where HmSearch starts looking at one more bit per chunk
+RADII = [1, 2, 16, 17, 18, 32, 33, 48, 49, 64, 65, 90]
+
+
+@pytest.mark.parametrize('radius', RADII)
+def test_hmsearch_matches_sql(db, matrix, radius):
+    index = HmSearch(matrix)
+    for hash in queries():
+        expected = lookup.find_similar(db, None, hash, radius)
+        assert index.search(hash, radius) == expected
+        assert index.search(bytes.fromhex(hash), radius) == expected
+        assert index.search(hash, radius, TYPES[:2]) == lookup.find_similar(db, None, hash, radius, TYPES[:2])
+
+
+@pytest.mark.parametrize('hash', ['0x' + 'ab' * 31, ' ' + 'a' * 63, 'a' * 63 + '\n', 'a_' * 32,
+                                  'ab ' * 21 + 'a', '+' + 'a' * 63, 'g' * 64, 'a' * 63, 'a' * 65])
+def test_malformed_hashes(matrix, hash):
+    index = HmSearch(FingerprintMatrix.from_rows([(1, 'ab' * 32, 1, 'image/png')]))
+    with pytest.raises(ValueError):
+        index.search(hash, 10)
+    with pytest.raises(ValueError):
+        matrix.search(hash, 10)
+
+
+def test_tables_cover_every_row(matrix):
+    index = HmSearch(matrix, chunks=32)
+    assert len(index) == len(matrix)
+    for t in range(index.chunks):
+        assert sorted(index.orders[t]) == list(range(len(matrix)))
+        assert index.starts[t][-1] == len(matrix)
+    with pytest.raises(ValueError):
+        HmSearch(matrix, chunks=8)
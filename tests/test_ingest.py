@@ -0,0 +1,65 @@
+#
+# The catalog import of ingest.py, on an empty sqlite database.
+#
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from ingest import Importer
+from models import Expression, Manifestation, Fingerprint
+
+from conftest import create_tables, make_hashes
+
+BLOCKHASH = 'http://videorooter.org/ns/blockhash'
+HASHES = make_hashes(3, seed=12)
+
+
+@pytest.fixture
+def db():
+    engine = create_engine('sqlite://')
+    with engine.begin() as conn:
+        create_tables(conn, (Expression, Manifestation, Fingerprint))
+    db = sessionmaker(bind=engine)()
+    yield db
+    db.close()
+
+
+def record(source_id, hash, url=None, **fields):
+    return dict(fields, source_id=source_id, url=url or 'http://x/%s.png' % source_id,
+                media_type='image/png', type=BLOCKHASH, hash=hash)
+
+
+def run(db, records, batch=2):
+    importer = Importer(db, batch, commit_every=1)
+    for r in records:
+        importer.add(r)
+    importer.close()
+    return importer.stats
+
+
+def rows(db):
+    return sorted((e.source_id, e.title, m.url, f.hash) for e, m, f in db.query(Expression, Manifestation, Fingerprint).filter(Expression.id == Manifestation.expression_id, Manifestation.id == Fingerprint.manifestation_id))
+
+
+def test_import_and_update(db):
+    stats = run(db, [record('a', HASHES[0], title='A'), record('b', HASHES[1].upper(), title='B'),
+                     record('b', HASHES[2], url='http://x/b.mp4', title='B')])
+    assert stats == {'records': 3, 'skipped': 0, 'expressions': 2, 'manifestations': 3, 'fingerprints': 3}
+    assert rows(db) == [('a', 'A', 'http://x/a.png', HASHES[0]), ('b', 'B', 'http://x/b.mp4', HASHES[2]),
+                        ('b', 'B', 'http://x/b.png', HASHES[1])]
+    assert all(f.hash_bin == bytes.fromhex(f.hash) for f in db.query(Fingerprint))
+
+    # Only what changed is written again
+    stats = run(db, [record('a', HASHES[0], title='A'), record('b', HASHES[0], title='New B')])
+    assert stats == {'records': 2, 'skipped': 0, 'expressions': 1, 'manifestations': 0, 'fingerprints': 1}
+    assert rows(db) == [('a', 'A', 'http://x/a.png', HASHES[0]), ('b', 'New B', 'http://x/b.mp4', HASHES[2]),
+                        ('b', 'New B', 'http://x/b.png', HASHES[0])]
+
+
+def test_bad_records_are_skipped(db):
+    stats = run(db, [[1, 2], 'text', None, {'title': 'no source'}, record('', HASHES[0]),
+                     record('a', 12345), record('b', HASHES[1], title=['not', 'text']),
+                     dict(record('c', HASHES[0]), url={'x': 1}),
+                     record('d', 'not a hash'), record('e', HASHES[2])])
+    assert stats['skipped'] == 9 and stats['records'] == 2
+    assert [r[0] for r in rows(db)] == ['e']
@@ -0,0 +1,51 @@
+#
+# The approximate search of lsh.py: never a wrong result, and at least the
+# recall asked for.
+#
+import random
+
+from fpindex import Segment
+from fpmatrix import FingerprintMatrix
+from lsh import BitSamplingLSH
+
+from conftest import TYPES, flip, make_hashes
+
+
+def test_lsh_recall_floor():
+    rng = random.Random(8)
+    maximum = 40
+    base = [rng.getrandbits(256) for i in range(2000)]
+    queries = base[:100]
+    # Every query has neighbours all over the search radius
+    near = [flip(q, rng.randrange(maximum), rng) for q in queries for i in range(5)]
+    hashes = ['%064x' % value for value in base + near]
+    matrix = FingerprintMatrix.from_rows((i, hash, i, 'image/png') for i, hash in enumerate(hashes))
+    lsh = BitSamplingLSH(matrix, tables=32, bits=12, probes=1)
+
+    for recall in (0.5, 0.9):
+        found = expected = 0
+        for q in queries:
+            hash = '%064x' % q
+            exact = matrix.search(hash, maximum)
+            approximate = lsh.search(hash, maximum, recall=recall)
+            # Never wrong, at worst incomplete
+            assert set(approximate) <= set(exact)
+            found += len(approximate)
+            expected += len(exact)
+        assert found >= recall * expected
+
+    # A segment with tables only answers approximately when asked to
+    segment = Segment(matrix).with_lsh(32, 12, 1)
+    hash = '%064x' % queries[0]
+    assert segment.search(hash, maximum) == matrix.search(hash, maximum)
+    assert set(segment.search(hash, maximum, recall=0.5)) <= set(matrix.search(hash, maximum))
+
+
+def test_lsh_types():
+    hashes = make_hashes(500, seed=9)
+    matrix = FingerprintMatrix.from_rows((i, hash, i, TYPES[i % 4]) for i, hash in enumerate(hashes))
+    lsh = BitSamplingLSH(matrix, tables=16, bits=8, probes=1)
+    for hash in hashes[:10]:
+        found = lsh.search(hash, 30, ['video/mp4'], recall=0.99)
+        assert all(TYPES[id % 4] == 'video/mp4' for d, e, id in found)
+        assert set(found) <= set(matrix.search(hash, 30, ['video/mp4']))
@@ -0,0 +1,114 @@
+#
+# The Prometheus text rendering of metrics.py, forwarding between
+# processes and the bottle plugin.
+#
+import queue
+import threading
+import time
+from wsgiref.util import setup_testing_defaults
+
+import bottle
+import pytest
+
+import metrics
+from metrics import Registry
+
+
+def test_render():
+    registry = Registry()
+    requests = registry.counter('test_requests_total', 'Requests', ('route', 'status'))
+    registry.gauge('test_rows', 'Rows in the index').set(12.5)
+    requests.inc(route='/lookup', status=200)
+    requests.inc(2, route='/lookup', status=200)
+    requests.inc(route='/a "quoted"\\path\n', status=404)
+    # The same name gives the same metric
+    assert registry.counter('test_requests_total', 'Other help') is requests
+
+    assert registry.render() == '\n'.join([
+        '# HELP test_requests_total Requests',
+        '# TYPE test_requests_total counter',
+        'test_requests_total{route="/a \\"quoted\\"\\\\path\\n",status="404"} 1',
+        'test_requests_total{route="/lookup",status="200"} 3',
+        '# HELP test_rows Rows in the index',
+        '# TYPE test_rows gauge',
+        'test_rows 12.5',
+    ]) + '\n'
+
+
+def test_render_histogram():
+    registry = Registry()
+    seconds = registry.histogram('test_seconds', 'Time', ('stage',), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        seconds.observe(value, stage='db')
+
+    assert registry.render().splitlines() == [
+        '# HELP test_seconds Time',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{stage="db",le="0.1"} 2',
+        'test_seconds_bucket{stage="db",le="1"} 3',
+        'test_seconds_bucket{stage="db",le="+Inf"} 4',
+        'test_seconds_sum{stage="db"} 3.65',
+        'test_seconds_count{stage="db"} 4',
+    ]
+
+
+def test_forward_and_collect():
+    daemon = Registry()
+    worker = Registry()
+    for registry in (daemon, worker):
+        registry.counter('test_jobs_total', 'Jobs', ('outcome',))
+        registry.histogram('test_job_seconds', 'Job time', buckets=(1,))
+    updates = queue.Queue()
+    worker.forward(updates)
+    threading.Thread(target=daemon.collect, args=(updates,), daemon=True).start()
+
+    worker.counter('test_jobs_total', 'Jobs').inc(outcome='done')
+    worker.counter('test_jobs_total', 'Jobs').inc(outcome='done')
+    worker.histogram('test_job_seconds', 'Job time').observe(0.5)
+    # Unknown metrics are ignored
+    updates.put(('test_unknown', 'inc', 1, {}))
+
+    deadline = time.time() + 5
+    while 'test_job_seconds_count 1' not in daemon.render() and time.time() < deadline:
+        time.sleep(0.01)
+    assert 'test_jobs_total{outcome="done"} 2' in daemon.render()
+    assert 'test_job_seconds_count 1' in daemon.render()
+    # The worker itself keeps nothing
+    assert 'outcome' not in worker.render()
+
+
+def test_plugin_times_routes(monkeypatch):
+    registry = Registry()
+    monkeypatch.setattr(metrics, 'REQUEST_SECONDS', registry.histogram(
+        'test_request_seconds', 'Requests', ('method', 'route', 'status')))
+    app = bottle.Bottle()
+    app.install(metrics.MetricsPlugin())
+
+    @app.route('/work/<id>')
+    def work(id):
+        if id == 'missing':
+            bottle.abort(404, 'no such work')
+        if id == 'cached':
+            return bottle.HTTPResponse(status=304)
+        return 'work %s' % id
+
+    for path in ('/work/1', '/work/2', '/work/missing', '/work/cached'):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path}
+        setup_testing_defaults(environ)
+        app(environ, lambda status, headers, exc_info=None: None)
+
+    rendered = registry.render()
+    assert 'test_request_seconds_count{method="GET",route="/work/<id>",status="200"} 2' in rendered
+    assert 'test_request_seconds_count{method="GET",route="/work/<id>",status="404"} 1' in rendered
+    assert 'test_request_seconds_count{method="GET",route="/work/<id>",status="304"} 1' in rendered
+
+
+def test_stage_subtracts_db_time(monkeypatch):
+    registry = Registry()
+    monkeypatch.setattr(metrics, 'STAGE_SECONDS', registry.histogram('test_stage_seconds', 'Stages', ('stage',)))
+    with metrics.stage('orm'):
+        time.sleep(0.05)
+        metrics.local.db = metrics.db_time() + 0.05
+    entry = metrics.STAGE_SECONDS.values[('orm',)]
+    assert entry[2] == 1
+    assert entry[1] == pytest.approx(0, abs=0.02)
@@ -0,0 +1,148 @@
+#
+# The queue processor of backend-queue.py: claiming, reclaiming and
+# processing jobs, on the database of conftest.py. Files are identified
+# and hashed by stand-ins.
+#
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from conftest import API_HASHES
+from models import Queue, QueueResults
+
+
+@pytest.fixture
+def db(queue):
+    db = sessionmaker(bind=queue.engine)()
+    db.query(QueueResults).delete()
+    db.query(Queue).delete()
+    db.commit()
+    yield db
+    db.close()
+
+
+class Magic(object):
+
+    def __init__(self, types):
+        self.types = types
+
+    def id_filename(self, filename):
+        return self.types[filename.rsplit('/', 1)[1]]
+
+
+class Hasher(object):
+
+    def __init__(self, hashes):
+        self.hashes = hashes
+
+    def hash(self, method, filename, timeout=None):
+        hash = self.hashes[filename.rsplit('/', 1)[1]]
+        if isinstance(hash, Exception):
+            raise hash
+        return hash
+
+
+def add_job(db, queryhash, status=0, completed_date=None):
+    job = Queue(queryhash=queryhash, status=status, completed_date=completed_date)
+    db.add(job)
+    db.commit()
+    return job.id
+
+
+def job(db, id):
+    db.expire_all()
+    row = db.query(Queue).filter_by(id=id).one()
+    return row.status, sorted((r.distance, r.expression_id) for r in row.results)
+
+
+def test_claim_takes_each_job_once(queue, db):
+    first = add_job(db, 'a')
+    second = add_job(db, 'b')
+    add_job(db, 'c', status=2)
+    claimed = [queue.claim(db), queue.claim(db), queue.claim(db)]
+    assert [row.id for row in claimed[:2]] == [first, second] and claimed[2] is None
+    assert all(row.status == 1 and row.completed_date is not None for row in claimed[:2])
+
+
+def test_reclaim_stuck_jobs(queue, db):
+    now = datetime.utcnow()
+    stuck = add_job(db, 'a', 1, now - timedelta(hours=2))
+    legacy = add_job(db, 'b', 1, None)
+    working = add_job(db, 'c', 1, now)
+    done = add_job(db, 'd', 2, now - timedelta(hours=2))
+    queue.reclaim(db, 3600)
+    assert [job(db, id)[0] for id in (stuck, legacy, working, done)] == [0, 0, 1, 2]
+
+
+def test_run_batch(queue, db):
+    ids = [add_job(db, name) for name in ('image', 'video', 'unknown')]
+    magic = Magic({'image': 'image/png', 'video': 'video/mp4', 'unknown': 'text/plain'})
+    # Works 3 and 4 have exactly these hashes
+    hasher = Hasher({'image': API_HASHES[2], 'video': API_HASHES[3]})
+    assert queue.run_batch(db, magic, hasher, 10) == 3
+
+    status, results = job(db, ids[0])
+    assert status == 2 and results[0] == (0, 3)
+    # Only images are searched for an image
+    assert all(expression_id % 2 for distance, expression_id in results)
+    status, results = job(db, ids[1])
+    assert status == 2 and results[0] == (0, 4)
+    assert all(expression_id % 2 == 0 for distance, expression_id in results)
+    # Nothing to hash it with, so nothing matches
+    assert job(db, ids[2]) == (2, [])
+    assert queue.run_batch(db, magic, hasher, 10) == 0
+
+
+def test_results_are_written_at_once(queue, db):
+    id = add_job(db, 'image')
+    row = queue.claim(db)
+    statements = []
+
+    def executed(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split()[0].upper())
+
+    def committed(conn):
+        statements.append('COMMIT')
+
+    event.listen(queue.engine, 'before_cursor_execute', executed)
+    event.listen(queue.engine, 'commit', committed)
+    try:
+        queue.process(db, row, row.completed_date, [('http://videorooter.org/ns/blockhash', API_HASHES[2]),
+                                                    ('http://videorooter.org/ns/x-blockhash-video-cv', API_HASHES[3])])
+    finally:
+        event.remove(queue.engine, 'before_cursor_execute', executed)
+        event.remove(queue.engine, 'commit', committed)
+    assert [s for s in statements if s != 'SELECT'] == ['INSERT', 'UPDATE', 'COMMIT']
+    status, results = job(db, id)
+    assert status == 2 and (0, 3) in results and (0, 4) in results
+
+
+def test_unidentified_files_fail(queue, db):
+    id = add_job(db, 'missing')
+    assert queue.run_batch(db, Magic({}), Hasher({}), 10) == 0
+    assert job(db, id) == (3, [])
+
+
+def test_results_of_reclaimed_jobs_are_dropped(queue, db):
+    id = add_job(db, 'image')
+    row = queue.claim(db)
+    claimed = row.completed_date
+    # Another worker reclaims and claims the job meanwhile
+    db.query(Queue).filter_by(id=id).update({Queue.completed_date: claimed + timedelta(seconds=1)})
+    db.commit()
+    queue.process(db, row, claimed, [('http://videorooter.org/ns/blockhash', API_HASHES[2])])
+    assert job(db, id) == (1, [])
+    queue.fail(db, row, claimed)
+    assert job(db, id) == (1, [])
+
+
+def test_hashing_failures_fail_the_job(queue, db):
+    ids = [add_job(db, name) for name in ('image', 'video', 'empty')]
+    magic = Magic({'image': 'image/png', 'video': 'video/mp4', 'empty': 'image/png'})
+    hasher = Hasher({'image': TimeoutError('hasher timed out'), 'video': API_HASHES[3], 'empty': None})
+    assert queue.run_batch(db, magic, hasher, 10) == 3
+    assert job(db, ids[0]) == (3, [])
+    assert job(db, ids[1])[0] == 2
+    assert job(db, ids[2]) == (3, [])
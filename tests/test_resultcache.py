@@ -0,0 +1,103 @@
+#
+# The result cache backends of resultcache.py. The redis one runs against
+# $REDIS_URL where that is set.
+#
+import os
+import threading
+
+import pytest
+
+import resultcache
+from resultcache import MemoryCache, SqliteCache, RedisCache, open_cache
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def cache(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryCache(size=50, ttl=60)
+    if request.param == 'sqlite':
+        return SqliteCache(str(tmp_path / 'cache.db'), size=50, ttl=60)
+    url = os.environ.get('REDIS_URL')
+    if not url or resultcache.redis is None:
+        pytest.skip('no redis server to test against')
+    cache = RedisCache(url, ttl=60)
+    cache.clear()
+    return cache
+
+
+class Clock(object):
+
+    def __init__(self, monkeypatch):
+        self.now = 1000000.0
+        monkeypatch.setattr(resultcache.time, 'time', lambda: self.now)
+
+
+def test_get_and_set(cache):
+    assert cache.get('a') is None
+    cache.set('a', b'first')
+    cache.set('b', b'\x00\xff')
+    assert cache.get('a') == b'first'
+    assert cache.get('b') == b'\x00\xff'
+    cache.set('a', b'second')
+    assert cache.get('a') == b'second'
+    cache.clear()
+    assert cache.get('a') is None and cache.get('b') is None
+
+
+@pytest.mark.parametrize('kind', [MemoryCache, SqliteCache])
+def test_entries_expire(kind, tmp_path, monkeypatch):
+    clock = Clock(monkeypatch)
+    cache = kind(size=10, ttl=5) if kind is MemoryCache else kind(str(tmp_path / 'cache.db'), size=10, ttl=5)
+    cache.set('a', b'value')
+    clock.now += 4
+    assert cache.get('a') == b'value'
+    clock.now += 2
+    assert cache.get('a') is None
+
+
+def test_memory_evicts_least_recently_used():
+    cache = MemoryCache(size=3)
+    for key in 'abc':
+        cache.set(key, key.encode())
+    cache.get('a')
+    cache.set('d', b'd')
+    assert [cache.get(key) for key in 'abcd'] == [b'a', None, b'c', b'd']
+
+
+def test_sqlite_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = Clock(monkeypatch)
+    cache = SqliteCache(str(tmp_path / 'cache.db'), size=10)
+    cache.set('kept', b'kept')
+    for i in range(99):
+        clock.now += 1
+        if i == 98:
+            cache.get('kept')
+        cache.set('key%d' % i, b'x')
+    count = cache._db().execute('SELECT count(*) FROM cache').fetchone()[0]
+    assert count == 10
+    assert cache.get('kept') == b'kept'
+    assert cache.get('key0') is None and cache.get('key98') == b'x'
+
+
+def test_sqlite_is_shared(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    SqliteCache(path).set('a', b'value')
+    other = SqliteCache(path)
+    assert other.get('a') == b'value'
+    # and usable from several threads
+    found = []
+    threads = [threading.Thread(target=lambda: found.append(other.get('a'))) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert found == [b'value'] * 4
+
+
+def test_open_cache(tmp_path):
+    assert open_cache('') is None
+    assert isinstance(open_cache('memory', 5, 1), MemoryCache)
+    cache = open_cache('sqlite:///%s' % (tmp_path / 'cache.db'), 5, 1)
+    assert isinstance(cache, SqliteCache) and cache.size == 5 and cache.ttl == 1
+    with pytest.raises(ValueError):
+        open_cache('memcached://localhost')
@@ -0,0 +1,56 @@
+import threading
+from collections import Counter
+
+from sampler import RandomSampler
+
+
+def test_sample_is_uniform_and_distinct():
+    sampler = RandomSampler(lambda: {'image': [3, 1, 2, 3], 'video': iter(range(100, 110)), 'audio': []})
+    sampler.refresh()
+    sampler.ready.set()
+    assert sorted(sampler.sample('image', 10)) == [1, 2, 3]
+    assert sampler.sample('audio') == [] and sampler.sample('text') == []
+    drawn = sampler.sample('video', 4)
+    assert len(set(drawn)) == 4 and all(100 <= id < 110 for id in drawn)
+    counts = Counter(sampler.sample('video')[0] for i in range(5000))
+    assert sorted(counts) == list(range(100, 110))
+    assert min(counts.values()) > 350
+
+
+def test_run_loads_in_the_background():
+    loaded = threading.Event()
+
+    def load():
+        loaded.wait()
+        return {'image': [7]}
+
+    sampler = RandomSampler(load, interval=3600)
+    threading.Thread(target=sampler.run, daemon=True).start()
+    found = []
+    waiting = threading.Thread(target=lambda: found.append(sampler.sample('image')))
+    waiting.start()
+    waiting.join(0.2)
+    # Requests wait for the first load
+    assert waiting.is_alive()
+    loaded.set()
+    waiting.join(5)
+    assert found == [[7]]
+
+
+def test_failed_load_samples_nothing():
+    def load():
+        raise IOError('database down')
+
+    sampler = RandomSampler(load, interval=3600)
+    threading.Thread(target=sampler.run, daemon=True).start()
+    assert sampler.sample('image') == []
+
+
+def test_interval_0_loads_once():
+    loads = []
+    sampler = RandomSampler(lambda: loads.append(1) or {'image': [1]}, interval=0)
+    thread = threading.Thread(target=sampler.run, daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive() and loads == [1]
+    assert sampler.sample('image') == [1]
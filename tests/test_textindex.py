@@ -0,0 +1,103 @@
+#
+# The BM25 search of textindex.py against scoring every document by brute
+# force, through the compressed base, the delta and merges.
+#
+import math
+import random
+
+import pytest
+
+from textindex import K1, B, TextIndex, PostingList, document, tokenize, encode, decode
+
+# Zipf distributed, so that some terms have posting lists of many blocks
+WORDS = ['w%d' % i for i in range(300)]
+WEIGHTS = [1.0 / (i + 1) for i in range(300)]
+
+QUERIES = ['w0', 'w0 w1 w2', 'w5 w250', 'w299 w0 w17 w3', 'w1 w1 w40', 'nothing', 'w0 nothing']
+
+
+def make_documents(ids, seed):
+    rng = random.Random(seed)
+    return dict((id, ' '.join(rng.choices(WORDS, WEIGHTS, k=rng.randint(1, 40)))) for id in ids)
+
+
+def brute_force(documents, query, k):
+    tokens = dict((id, tokenize(text)) for id, text in documents.items())
+    average = float(sum(len(t) for t in tokens.values())) / len(tokens)
+    scores = {}
+    for term in set(tokenize(query)):
+        df = sum(1 for t in tokens.values() if term in t)
+        idf = math.log(1 + (len(tokens) - df + 0.5) / (df + 0.5))
+        for id, t in tokens.items():
+            tf = t.count(term)
+            if tf:
+                norm = K1 * (1 - B + B * len(t) / average)
+                scores[id] = scores.get(id, 0) + idf * tf * (K1 + 1) / (tf + norm)
+    return sorted(((s, id) for id, s in scores.items()), key=lambda r: (-r[0], r[1]))[:k]
+
+
+def check(index, documents):
+    assert len(index) == len(documents)
+    for query in QUERIES:
+        for k in (1, 5, 50, 5000):
+            found = index.search(query, k)
+            expected = brute_force(documents, query, k)
+            assert [s for s, id in found] == pytest.approx([s for s, id in expected])
+            # Ids may only differ among equal scores
+            scores = dict((id, s) for s, id in brute_force(documents, query, len(documents)))
+            assert all(scores[id] == pytest.approx(s) for s, id in found)
+
+
+def rows(documents):
+    return dict((id, (text, None, None)) for id, text in documents.items())
+
+
+def test_base_matches_brute_force():
+    documents = make_documents(range(1, 1500), 1)
+    check(TextIndex(dict((id, tokenize(text)) for id, text in documents.items())), documents)
+
+
+def test_delta_and_merge_match_brute_force():
+    documents = make_documents(range(1, 800), 2)
+    index = TextIndex(dict((id, tokenize(text)) for id, text in documents.items()), merge_at=300)
+
+    # New documents go to the delta
+    added = make_documents(range(800, 900), 3)
+    index.apply(rows(added))
+    documents.update(added)
+    assert len(index.state[1]) == 100
+    check(index, documents)
+
+    # Enough of them, replacing some old ones, make a new base
+    changed = make_documents(list(range(1, 300)) + list(range(900, 1000)), 4)
+    index.apply(rows(changed))
+    documents.update(changed)
+    assert len(index.state[1]) == 0
+    check(index, documents)
+
+
+def test_delta_hides_replaced_documents():
+    index = TextIndex({1: ['apple', 'pear'], 2: ['pear']})
+    index.apply({1: ('plum', None, None)})
+    assert [id for s, id in index.search('apple')] == []
+    assert [id for s, id in index.search('plum')] == [1]
+    assert [id for s, id in index.search('pear')] == [2]
+    assert len(index) == 2
+
+
+def test_document_strips_markup():
+    assert document('A Title', None, '<a href="http://x/">Jane &amp; Joe</a>') == ['a', 'title', 'jane', 'joe']
+
+
+def test_posting_list_round_trip():
+    rng = random.Random(5)
+    ids = sorted(rng.sample(range(1, 10 ** 6), 1000))
+    postings = [(id, rng.randint(1, 300)) for id in ids]
+    plist = PostingList(postings)
+    assert list(plist) == postings
+    probe = sorted(rng.sample(ids, 50) + [0, 10 ** 7])
+    assert plist.lookup(probe) == dict((id, tf) for id, tf in postings if id in probe)
+
+    data = bytearray()
+    encode([0, 127, 128, 300, 2 ** 32], data)
+    assert decode(bytes(data), 0, 5) == ([0, 127, 128, 300, 2 ** 32], len(data))
@@ -0,0 +1,263 @@
+#
+# In-process full text search over the title, description and credit of
+# expressions, ranked with BM25, as an alternative to MySQL MATCH AGAINST.
+#
+# Documents are tokenized into lower case words, with the HTML markup
+# stripped from credit. Every term has a posting list of (expression id,
+# term frequency) in id order, compressed as variable length integers
+# with the ids delta encoded, in blocks of BLOCK postings. Each block
+# starts from an absolute id, and the last id of every block is kept, so
+# the postings of one document can be looked up by decoding a single
+# block.
+#
+# search() scores terms from the rarest to the most common, keeping an
+# accumulator per candidate document (MaxScore). Once the remaining terms
+# together can no longer lift a new document into the top k, the common
+# terms' long posting lists are only probed for the candidates already
+# found, and candidates that can't make it any more are dropped.
+#
+# Updates go into a small uncompressed delta that hides older versions of
+# the same documents in the compressed base. apply() builds a new delta
+# (and every so often a new base) off to the side and swaps it in, so
+# searches never wait. Documents are never removed.
+#
+import bisect
+import heapq
+import html
+import math
+import re
+import threading
+
+BLOCK = 128
+
+K1 = 1.2
+B = 0.75
+
+WORD = re.compile(r'[^\W_]+', re.UNICODE)
+TAG = re.compile(r'<[^>]*>')
+
+
+def tokenize(text):
+    return WORD.findall(text.lower()) if text else []
+
+
+def strip_html(text):
+    return html.unescape(TAG.sub(' ', text)) if text else text
+
+
+def document(title, description, credit):
+    return tokenize(title) + tokenize(description) + tokenize(strip_html(credit))
+
+
+def encode(numbers, out):
+    for n in numbers:
+        while n >= 0x80:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+
+
+def decode(data, start, count):
+    numbers = []
+    pos = start
+    for i in range(count):
+        n = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        numbers.append(n)
+    return numbers, pos
+
+
+class PostingList(object):
+
+    def __init__(self, postings):
+        # postings: sorted list of (id, tf)
+        self.df = len(postings)
+        self.max_tf = max(tf for id, tf in postings)
+        data = bytearray()
+        self.offsets = []
+        self.last = []
+        for start in range(0, len(postings), BLOCK):
+            block = postings[start:start + BLOCK]
+            self.offsets.append(len(data))
+            self.last.append(block[-1][0])
+            ids = [block[0][0]] + [block[i][0] - block[i - 1][0] for i in range(1, len(block))]
+            encode(ids, data)
+            encode([tf for id, tf in block], data)
+        self.data = bytes(data)
+
+    def _block(self, b):
+        count = min(BLOCK, self.df - b * BLOCK)
+        deltas, pos = decode(self.data, self.offsets[b], count)
+        tfs, pos = decode(self.data, pos, count)
+        ids = []
+        id = 0
+        for d in deltas:
+            id += d
+            ids.append(id)
+        return ids, tfs
+
+    def __iter__(self):
+        for b in range(len(self.offsets)):
+            ids, tfs = self._block(b)
+            for posting in zip(ids, tfs):
+                yield posting
+
+    # Term frequency of every id in ids (sorted) that is in the list
+    def lookup(self, ids):
+        found = {}
+        block = None
+        for id in ids:
+            b = bisect.bisect_left(self.last, id)
+            if b == len(self.last):
+                break
+            if block != b:
+                block = b
+                block_ids, tfs = self._block(b)
+            i = bisect.bisect_left(block_ids, id)
+            if i < len(block_ids) and block_ids[i] == id:
+                found[id] = tfs[i]
+        return found
+
+
+class DeltaList(object):
+
+    def __init__(self, postings):
+        self.postings = postings
+        self.df = len(postings)
+        self.max_tf = max(tf for id, tf in postings)
+        self.tfs = dict(postings)
+
+    def __iter__(self):
+        return iter(self.postings)
+
+    def lookup(self, ids):
+        return dict((id, self.tfs[id]) for id in ids if id in self.tfs)
+
+
+def term_counts(tokens):
+    counts = {}
+    for token in tokens:
+        counts[token] = counts.get(token, 0) + 1
+    return counts
+
+
+# One immutable set of documents with their posting lists and lengths
+class Segment(object):
+
+    # postings: {term: sorted list of (id, tf)}, lengths: {id: tokens}
+    def __init__(self, postings, lengths, compress=True):
+        kind = PostingList if compress else DeltaList
+        self.terms = dict((term, kind(p)) for term, p in postings.items() if p)
+        self.lengths = lengths
+        self.total = sum(lengths.values())
+
+    def __len__(self):
+        return len(self.lengths)
+
+    # documents: {expression id: list of tokens}
+    @classmethod
+    def build(cls, documents, compress=True):
+        postings = {}
+        for id in sorted(documents):
+            for token, tf in term_counts(documents[id]).items():
+                postings.setdefault(token, []).append((id, tf))
+        return cls(postings, dict((id, len(tokens)) for id, tokens in documents.items()), compress)
+
+
+class TextIndex(object):
+
+    # documents: {expression id: list of tokens}, see document()
+    def __init__(self, documents=None, merge_at=10000):
+        self.merge_at = merge_at
+        self.lock = threading.Lock()
+        # (base, delta, ids in delta hiding their base version, the total
+        # length of those base versions)
+        self.state = (Segment.build(documents or {}), Segment.build({}, False), frozenset(), 0)
+        self.documents = {}
+
+    def __len__(self):
+        base, delta, hidden, hidden_total = self.state
+        return len(base) - len(hidden) + len(delta)
+
+    #
+    # Adds or replaces documents, given as {expression id: (title,
+    # description, credit)}.
+    #
+    def apply(self, rows):
+        with self.lock:
+            base = self.state[0]
+            self.documents.update((id, document(*fields)) for id, fields in rows.items())
+            if len(self.documents) >= max(self.merge_at, len(base) // 100):
+                self.state = (self._merge(base, self.documents), Segment.build({}, False), frozenset(), 0)
+                self.documents = {}
+            else:
+                hidden = frozenset(id for id in self.documents if id in base.lengths)
+                self.state = (base, Segment.build(self.documents, False), hidden,
+                              sum(base.lengths[id] for id in hidden))
+
+    # A new base with documents replacing their versions in base
+    def _merge(self, base, documents):
+        postings = {}
+        for term, p in base.terms.items():
+            postings[term] = [(id, tf) for id, tf in p if id not in documents]
+        for id, tokens in documents.items():
+            for token, tf in term_counts(tokens).items():
+                postings.setdefault(token, []).append((id, tf))
+        for p in postings.values():
+            p.sort()
+        lengths = dict(base.lengths)
+        lengths.update((id, len(tokens)) for id, tokens in documents.items())
+        return Segment(postings, lengths)
+
+    #
+    # Returns the expression ids of the k best matches for query, as a
+    # list of (score, id), best first. Documents match if they contain
+    # any of the query terms. Until the next merge, document frequencies
+    # still count the replaced versions of documents in the delta.
+    #
+    def search(self, query, k=1000):
+        base, delta, hidden, hidden_total = self.state
+        count = len(base) - len(hidden) + len(delta)
+        if not count:
+            return []
+        average = float(base.total - hidden_total + delta.total) / count
+
+        terms = []
+        for term in set(tokenize(query)):
+            lists = [(l, s) for l, s in ((base.terms.get(term), base), (delta.terms.get(term), delta)) if l is not None]
+            if not lists:
+                continue
+            df = sum(l.df for l, s in lists)
+            idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+            max_tf = max(l.max_tf for l, s in lists)
+            bound = idf * max_tf * (K1 + 1) / (max_tf + K1 * (1 - B))
+            terms.append((bound, idf, lists))
+        terms.sort(key=lambda t: -t[0])
+
+        scores = {}
+        remaining = sum(t[0] for t in terms)
+        for bound, idf, lists in terms:
+            threshold = heapq.nlargest(k, scores.values())[-1] if len(scores) >= k else 0
+            growing = len(scores) < k or remaining > threshold
+            if not growing:
+                # Only candidates that can still reach the top k matter
+                scores = dict((id, s) for id, s in scores.items() if s + remaining >= threshold)
+            for postings, segment in lists:
+                lengths = segment.lengths
+                if growing:
+                    found = iter(postings)
+                else:
+                    found = postings.lookup(sorted(scores)).items()
+                for id, tf in found:
+                    if segment is base and id in hidden:
+                        continue
+                    norm = K1 * (1 - B + B * lengths[id] / average)
+                    scores[id] = scores.get(id, 0) + idf * tf * (K1 + 1) / (tf + norm)
+            remaining -= bound
+        return [(-s, id) for s, id in heapq.nsmallest(k, ((-s, id) for id, s in scores.items()))]